@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Export BatchRunner, analyze_keyword and read_keywords"""
+
+from .batch_runner import BatchRunner, analyze_keyword, read_keywords
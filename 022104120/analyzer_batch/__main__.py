@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Entrypoint of the batch analyzer, run with "python -m analyzer_batch" in 022104120"""
+
+import argparse
+import asyncio
+import sys
+from danmaku_db import DanmakuCache
+from .batch_runner import BatchRunner, OUTPUT_FORMATS
+
+
+def print_progress(summary: dict):
+    """Print the summary of a finished keyword"""
+    if summary['status'] == 'done':
+        print(f'“{summary["keyword"]}”：{summary["video_count"]}个视频，'
+              f'{summary["danmaku_count"]}条弹幕，获取{summary["fetch_seconds"]:.1f}秒，'
+              f'分析{summary["analysis_seconds"]:.1f}秒')
+    else:
+        print(f'“{summary["keyword"]}”失败：{summary["error"]}', file=sys.stderr)
+
+
+def main() -> int:
+    """Parse the arguments, run the batch and get the exit code"""
+    parser = argparse.ArgumentParser(description='Analyze the danmakus of many keywords')
+    parser.add_argument('keywords', help='file of keywords, one per line, or "-" for stdin')
+    parser.add_argument('--output', default='batch_output', help='output directory')
+    parser.add_argument('--n', type=int, default=10, help='count of videos per keyword')
+    parser.add_argument('--top', type=int, default=20, help='count of top danmakus')
+    parser.add_argument('--cluster', action='store_true',
+                        help='count near-duplicate variants of the top danmakus together')
+    parser.add_argument('--formats', default='top,wordcloud,snapshot',
+                        help=f'comma separated outputs among {",".join(OUTPUT_FORMATS)}')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='requests in flight, shared by all the keywords')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='analysis processes (default: CPU count, 0 for none)')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='keywords downloaded ahead of the analyses')
+    parser.add_argument('--cache', default='danmaku_cache.sqlite3',
+                        help='danmaku cache file shared with the server, "" to disable it')
+    args = parser.parse_args()
+
+    if args.keywords == '-':
+        keywords = sys.stdin.readlines()
+    else:
+        with open(args.keywords, encoding='utf-8') as keywords_file:
+            keywords = keywords_file.readlines()
+    try:
+        runner = BatchRunner(args.output, args.n, args.top, args.cluster,
+                             [output_format.strip() for output_format in args.formats.split(',')],
+                             args.concurrency, args.workers, args.prefetch,
+                             DanmakuCache(args.cache) if args.cache != '' else None,
+                             print_progress)
+    except ValueError as exception:
+        parser.error(str(exception))
+    result = asyncio.run(runner.run(keywords))
+    print(f'完成{result["done"]}个关键字，失败{result["failed"]}个，'
+          f'共{result["seconds"]:.1f}秒，结果已写入“{args.output}”')
+    return 1 if result['failed'] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
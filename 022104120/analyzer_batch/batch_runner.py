@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides BatchRunner class for analyzing the danmakus of many keywords in one process"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from danmaku_db import DanmakuDB, DanmakuCache
+from danmaku_db import segmenter as segmenter_module
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ('top', 'wordcloud', 'snapshot', 'excel')
+# 文件名中不允许出现的字符
+UNSAFE_FILENAME_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+def keyword_dirname(keyword: str) -> str:
+    """Get a directory name for the outputs of a keyword"""
+    return UNSAFE_FILENAME_RE.sub('_', keyword).strip(' .') or '_'
+
+
+def read_keywords(lines) -> list:
+    """Get the distinct keywords of the lines, skipping empty lines and "#" comments"""
+    return list(dict.fromkeys(line.strip() for line in lines
+                              if line.strip() != '' and not line.lstrip().startswith('#')))
+
+
+def _init_worker():
+    """Initialize an analysis worker process"""
+    # 已按关键字并行分析，分词不再嵌套进程池
+    segmenter_module.default_segmenter.processes = 1
+
+
+def analyze_keyword(db: DanmakuDB, keyword: str, directory: str, top_n: int = 20,
+                    cluster: bool = False, formats: tuple = ('top', 'wordcloud', 'snapshot')):
+    """Write the outputs of the specified formats for the database of a keyword to directory
+
+    Run in an analysis worker. Return the written filenames and the analysis time.
+    """
+    if len(db) == 0:
+        raise ValueError('Empty database')
+    started_at = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    if 'top' in formats:
+        if cluster:
+            top_danmakus = [{'danmaku': danmaku, 'count': count, 'variants': variants}
+                            for danmaku, count, variants in db.top_danmaku_clusters(top_n)]
+        else:
+            top_danmakus = [{'danmaku': danmaku, 'count': count}
+                            for danmaku, count in db.top_danmakus(top_n).items()]
+        files.append(os.path.join(directory, 'top_danmakus.json'))
+        with open(files[-1], 'w', encoding='utf-8') as top_file:
+            json.dump({
+                'keyword': keyword,
+                'video_bvids': db.bvids(),
+                'total_danmaku_count': sum(len(db[bvid]) for bvid in db.bvids()),
+                'top_danmakus': top_danmakus
+            }, top_file, ensure_ascii=False, indent=2)
+    if 'wordcloud' in formats:
+        files.append(os.path.join(directory, 'wordcloud.png'))
+        db.to_wordcloud().save(files[-1], 'png')
+    if 'snapshot' in formats:
+        files.append(os.path.join(directory, 'danmakus.snapshot'))
+        db.save(files[-1])
+    if 'excel' in formats:
+        files.append(os.path.join(directory, 'danmakus.xlsx'))
+        db.to_excel(files[-1])
+    return {'files': files, 'analysis_seconds': time.perf_counter() - started_at}
+
+
+class BatchRunner:
+    """BatchRunner class.
+
+    BatchRunner objects fetch the danmakus of the top n search results of each keyword
+    into a DanmakuDB of its own and write its outputs to a directory of output_dir.
+    All the fetches share the cache and at most concurrency requests in flight.
+    Analyses run in a pool of worker processes (0 for a thread of this process),
+    while up to prefetch further keywords are being downloaded.
+    """
+
+    def __init__(self, output_dir: str, n: int = 10, top_n: int = 20, cluster: bool = False,
+                 formats: tuple = ('top', 'wordcloud', 'snapshot'), concurrency: int = 8,
+                 workers: int = None, prefetch: int = 1, cache: DanmakuCache = None,
+                 progress=None):
+        """Create a BatchRunner object
+
+        progress(summary) is called after each keyword, see run for the summaries.
+        """
+        if n <= 0 or top_n <= 0:
+            raise ValueError('Invalid n number')
+        if concurrency <= 0 or prefetch < 0 or (workers is not None and workers < 0):
+            raise ValueError('Invalid concurrency')
+        if any(output_format not in OUTPUT_FORMATS for output_format in formats):
+            raise ValueError('Invalid output format')
+        self.output_dir = output_dir
+        self.n = n
+        self.top_n = top_n
+        self.cluster = cluster
+        self.formats = tuple(formats)
+        self.concurrency = concurrency
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.prefetch = prefetch
+        self.cache = cache
+        self.progress = progress
+
+    def _executor(self):
+        if self.workers == 0:
+            return ThreadPoolExecutor(1)
+        return ProcessPoolExecutor(self.workers, initializer=_init_worker)
+
+    async def _run_keyword(self, keyword: str, directory: str, semaphore: asyncio.Semaphore,
+                           slots: asyncio.Semaphore, executor) -> dict:
+        summary = {
+            'keyword': keyword,
+            'directory': directory,
+            'status': 'failed',
+            'error': None,
+            'video_count': 0,
+            'danmaku_count': 0,
+            'fetch_seconds': None,
+            'analysis_seconds': None,
+            'files': []
+        }
+        # 限制已获取但尚未分析完的关键字数，使内存占用有界
+        async with slots:
+            try:
+                db = DanmakuDB(self.concurrency, cache=self.cache)
+                started_at = time.perf_counter()
+                await db.fetch_from_search_result(keyword, self.n, semaphore=semaphore)
+                summary['fetch_seconds'] = time.perf_counter() - started_at
+                summary['video_count'] = len(db)
+                summary['danmaku_count'] = sum(len(db[bvid]) for bvid in db.bvids())
+                summary.update(await asyncio.get_running_loop().run_in_executor(
+                    executor, analyze_keyword, db, keyword, directory, self.top_n,
+                    self.cluster, self.formats))
+                summary['status'] = 'done'
+            except Exception as exception:  # pylint: disable=broad-except
+                # 单个关键字失败不影响其余关键字
+                logger.exception('Keyword "%s" failed', keyword)
+                summary['error'] = str(exception) or type(exception).__name__
+        if self.progress is not None:
+            self.progress(summary)
+        return summary
+
+    async def run(self, keywords) -> dict:
+        """Fetch and analyze the keywords, then write and return the summary of the batch
+
+        The summary of each keyword has its status ('done' or 'failed'), error,
+        video and danmaku counts, fetch and analysis time and written files.
+        """
+        keywords = read_keywords(keywords)
+        directories = {}
+        for keyword in keywords:
+            directory = name = keyword_dirname(keyword)
+            # 不同关键字可能得到相同的目录名
+            suffix = 1
+            while directory in directories.values():
+                suffix += 1
+                directory = f'{name}_{suffix}'
+            directories[keyword] = directory
+        os.makedirs(self.output_dir, exist_ok=True)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        slots = asyncio.Semaphore(max(self.workers, 1) + self.prefetch)
+        started_at = time.perf_counter()
+        executor = self._executor()
+        try:
+            summaries = await asyncio.gather(*(
+                self._run_keyword(keyword, os.path.join(self.output_dir, directories[keyword]),
+                                  semaphore, slots, executor)
+                for keyword in keywords))
+        finally:
+            executor.shutdown(cancel_futures=True)
+        result = {
+            'keywords': summaries,
+            'done': sum(summary['status'] == 'done' for summary in summaries),
+            'failed': sum(summary['status'] == 'failed' for summary in summaries),
+            'seconds': time.perf_counter() - started_at,
+            'cache_hits': self.cache.hits if self.cache is not None else None,
+            'cache_misses': self.cache.misses if self.cache is not None else None
+        }
+        with open(os.path.join(self.output_dir, 'summary.json'), 'w',
+                  encoding='utf-8') as summary_file:
+            json.dump(result, summary_file, ensure_ascii=False, indent=2)
+        return result
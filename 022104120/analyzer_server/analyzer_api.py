@@ -3,36 +3,59 @@
 
 """Provides analyzer web API"""
 
+import asyncio
+import json
 import math
+import re
+import sys
 from functools import wraps
-import io
 from aiohttp import web
-from bilibili_api import ApiException
-from danmaku_db import DanmakuDB
+from danmaku_db import DanmakuDB, DanmakuFilter
+from .wordcloud_renderer import WordcloudRenderer
+from .worker_pool import WorkerPool, PoolSaturatedError
+from .dataset_registry import DatasetRegistry
 
 ApiRoutes = web.RouteTableDef()
 
 
-def validate_param(param_dict: dict):
-    """Validate request's parameter and append them to **params before proceeding"""
+def validate_param(param_dict: dict, optional_param_dict: dict = None):
+    """Validate request's parameter and append them to **params before proceeding
+
+    optional_param_dict maps optional parameters to (type, default value).
+    """
     def decorator(handler):
         @wraps(handler)
         async def wrapper(request: web.Request):
             params = {}
-            for param, type_class in param_dict.items():
+            checked_param_dict = dict(param_dict)
+            for param, (type_class, default) in (optional_param_dict or {}).items():
+                if param in request.query and request.query[param] != '':
+                    checked_param_dict[param] = type_class
+                else:
+                    params[param] = default
+            for param, type_class in checked_param_dict.items():
                 if param not in request.query or request.query[param] == '':
                     return web.Response(status=400, text="Bad request")
                 if (type_class == bool and not request.query[param].lower() == 'true'
                         and not request.query[param].lower() == 'false'):
                     return web.Response(status=400, text="Bad request")
                 try:
-                    params[param] = type_class(request.query[param])
+                    if type_class == bool:
+                        params[param] = request.query[param].lower() == 'true'
+                    else:
+                        params[param] = type_class(request.query[param])
                 except ValueError:
                     return web.Response(status=400, text="Bad request")
             try:
                 return await handler(request, **params)
-            except ApiException as exception:
-                return web.Response(status=500, text=exception.msg)
+            except PoolSaturatedError:
+                return ApiHelper.response(5)
+            except Exception as exception:
+                # bilibili_api按需导入，未导入时不可能抛出其异常
+                bapi = sys.modules.get('bilibili_api')
+                if bapi is not None and isinstance(exception, bapi.ApiException):
+                    return web.Response(status=500, text=exception.msg)
+                raise
         return wrapper
     return decorator
 
@@ -46,8 +69,17 @@ class ApiHelper:
         'empty database',
         'bvid does not exist',
         'invalid page number',
-        'invalid n number'
+        'invalid n number',
+        'server busy',
+        'dataset does not exist',
+        'job does not exist',
+        'invalid query',
+        'no words'
     ]
+    # 非默认状态码的错误码
+    status_codes = {
+        5: 503
+    }
 
     @classmethod
     def response(cls, code: int = 0, data=None):
@@ -63,97 +95,334 @@ class ApiHelper:
         }
         if code == 0:
             return web.json_response(json_data)
-        return web.json_response(json_data, status=403)
+        return web.json_response(json_data, status=cls.status_codes.get(code, 403))
 
 
 class ApiHandler:
     """ApiHandler class.
 
     ApiHandler contains API request handlers"""
-    db = DanmakuDB()
+    # 由AnalyzerServer在创建时打开，未打开时不使用磁盘缓存
+    cache = None
+    # 每个数据集拥有独立的DanmakuDB，共用同一个磁盘缓存
+    registry = DatasetRegistry(lambda: DanmakuDB(cache=ApiHandler.cache))
+    # 计算密集的任务在工作池中运行，避免阻塞事件循环
+    pool = WorkerPool()
+    # 由AnalyzerServer在启动时创建，预先加载遮罩图片
+    renderer = None
+    # 未指定数据集时使用最近获取的数据集
+    optional_dataset = {'dataset': (str, None)}
+
+    @staticmethod
+    def dataset_db(dataset: str):
+        """Get the DanmakuDB of the dataset, or the error response if it is missing or empty"""
+        found = ApiHandler.registry.get(dataset)
+        if found is None:
+            return None, ApiHelper.response(1 if dataset is None else 6)
+        if len(found.db) == 0:
+            return None, ApiHelper.response(1)
+        return found.db, None
 
     @staticmethod
     @ApiRoutes.get('/api/fetch')
-    @validate_param({'keyword': str, 'n': int})
+    @validate_param({'keyword': str, 'n': int},
+                    {**optional_dataset, 'wait': (bool, False), 'refresh': (bool, False),
+                     'max_age': (float, 300.0)})
     async def fetch(_request: web.Request, **params):
-        """Request handler for fetching videos' danmakus from search results"""
-        ApiHandler.db.clear()
-        await ApiHandler.db.fetch_from_search_result(params['keyword'], params['n'])
-        return ApiHelper.response()
+        """Request handler for fetching videos' danmakus from search results
+
+        The fetch runs in the background and the job id is returned at once.
+        If wait is true, the job info is returned once the job is done or cancelled.
+        If refresh is true, only the videos that are new or were fetched more than
+        max_age seconds ago are fetched into the existing dataset.
+        """
+        if params['n'] <= 0:
+            return ApiHelper.response(4)
+        fetch_args = (params['keyword'], params['n'], params['dataset'],
+                      params['refresh'], params['max_age'])
+        if params['wait']:
+            job = await ApiHandler.registry.fetch(*fetch_args)
+            return ApiHelper.response(data=job.info())
+        job = ApiHandler.registry.start_fetch(*fetch_args)
+        return ApiHelper.response(data={'dataset': job.dataset, 'job': job.id})
+
+    @staticmethod
+    @ApiRoutes.get('/api/fetch_status')
+    @validate_param({'job': str})
+    async def fetch_status(_request: web.Request, **params):
+        """Request handler for getting the progress of a fetch job"""
+        job = ApiHandler.registry.jobs.get(params['job'])
+        if job is None:
+            return ApiHelper.response(7)
+        return ApiHelper.response(data=job.info())
+
+    @staticmethod
+    @ApiRoutes.get('/api/fetch_events')
+    @validate_param({'job': str}, {'interval': (float, 0.5)})
+    async def fetch_events(request: web.Request, **params):
+        """Request handler for streaming the progress of a fetch job as Server-Sent Events"""
+        job = ApiHandler.registry.jobs.get(params['job'])
+        if job is None:
+            return ApiHelper.response(7)
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                               'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        while True:
+            await response.write(f'event: progress\ndata: {json.dumps(job.info())}\n\n'
+                                 .encode('utf-8'))
+            if job.finished:
+                break
+            # 限制推送频率，超时无更新时也推送一次作为心跳
+            await asyncio.sleep(max(params['interval'], 0.05))
+            await job.wait_update(15)
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    @ApiRoutes.get('/api/fetch_cancel')
+    @validate_param({'job': str})
+    async def fetch_cancel(_request: web.Request, **params):
+        """Request handler for cancelling a fetch job"""
+        job = ApiHandler.registry.jobs.get(params['job'])
+        if job is None:
+            return ApiHelper.response(7)
+        job.cancel()
+        return ApiHelper.response(data=job.info())
+
+    @staticmethod
+    @ApiRoutes.get('/api/datasets')
+    async def datasets(_request: web.Request):
+        """Request handler for listing the datasets"""
+        return ApiHelper.response(data={'datasets': ApiHandler.registry.infos()})
 
     @staticmethod
     @ApiRoutes.get('/api/wordcloud')
-    async def wordcloud(_request: web.Request):
-        """Request handler for generating word cloud image"""
-        if len(ApiHandler.db) == 0:
-            return ApiHelper.response(1)
-        image = ApiHandler.db.to_wordcloud()
-        image_buf = io.BytesIO()
-        image.save(image_buf, 'png')
-        image_buf.seek(0)
-        return web.Response(body=image_buf.read(), content_type="image/png")
+    @validate_param({}, optional_dataset)
+    async def wordcloud(request: web.Request, **params):
+        """Request handler for generating word cloud image
+
+        The image is cached by the database content and revalidated by its ETag.
+        """
+        db, error = ApiHandler.dataset_db(params['dataset'])
+        if db is None:
+            return error
+        if ApiHandler.renderer is None:
+            ApiHandler.renderer = WordcloudRenderer(pool=ApiHandler.pool)
+        try:
+            etag, png = await ApiHandler.renderer.render(db)
+        except ValueError:
+            # 所有词均为停用词，或数据库在渲染前被清空
+            return ApiHelper.response(9)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=png, content_type="image/png", headers=headers)
 
     @staticmethod
     @ApiRoutes.get('/api/top_danmakus')
-    @validate_param({'n': int})
+    @validate_param({'n': int}, {**optional_dataset, 'cluster': (bool, False)})
     async def top_danmakus(_request: web.Request, **params):
-        """Request handler for getting top danmakus"""
+        """Request handler for getting top danmakus
+
+        If cluster is true, near-duplicate variants are counted together.
+        """
         if params['n'] <= 0:
             return ApiHelper.response(4)
-        if len(ApiHandler.db) == 0:
-            return ApiHelper.response(1)
+        db, error = ApiHandler.dataset_db(params['dataset'])
+        if db is None:
+            return error
+        if params['cluster']:
+            data = {
+                'top_danmakus': [{
+                    'danmaku': danmaku,
+                    'count': count,
+                    'variants': variants
+                } for danmaku, count, variants in await ApiHandler.pool.run(
+                    'top_danmaku_clusters', db.top_danmaku_clusters, params['n'])]
+            }
+            return ApiHelper.response(data=data)
         data = {
             'top_danmakus': [{
                 'danmaku': danmaku,
                 'count': count
-            } for danmaku, count in ApiHandler.db.top_danmakus(params['n']).items()]
+            } for danmaku, count in (await ApiHandler.pool.run(
+                'top_danmakus', db.top_danmakus, params['n'])).items()]
+        }
+        return ApiHelper.response(data=data)
+
+    @staticmethod
+    @ApiRoutes.get('/api/search')
+    @validate_param({'words': str}, {**optional_dataset, 'match_all': (bool, True),
+                                     'limit': (int, 100)})
+    async def search(_request: web.Request, **params):
+        """Request handler for searching the danmakus containing comma separated words
+
+        Videos are sorted by the count of matching danmakus, and at most limit
+        danmaku indexes are returned for each video.
+        """
+        if params['limit'] <= 0:
+            return ApiHelper.response(4)
+        db, error = ApiHandler.dataset_db(params['dataset'])
+        if db is None:
+            return error
+        words = [word for word in params['words'].split(',') if word != '']
+        result = await ApiHandler.pool.run('search', db.search, words, params['match_all'])
+        data = {
+            'videos': [{
+                'bvid': bvid,
+                'count': len(indexes),
+                'indexes': indexes[:params['limit']]
+            } for bvid, indexes in sorted(result.items(), key=lambda item: -len(item[1]))],
+            'total_count': sum(len(indexes) for indexes in result.values())
+        }
+        return ApiHelper.response(data=data)
+
+    @staticmethod
+    @ApiRoutes.get('/api/cooccurrence')
+    @validate_param({'word': str, 'n': int}, optional_dataset)
+    async def cooccurrence(_request: web.Request, **params):
+        """Request handler for getting the top words appearing together with a word"""
+        if params['n'] <= 0:
+            return ApiHelper.response(4)
+        db, error = ApiHandler.dataset_db(params['dataset'])
+        if db is None:
+            return error
+        data = {
+            'words': [{
+                'word': word,
+                'count': count
+            } for word, count in (await ApiHandler.pool.run(
+                'cooccurrence', db.cooccurring_words, params['word'], params['n'])).items()]
         }
         return ApiHelper.response(data=data)
 
+    @staticmethod
+    @ApiRoutes.get('/api/density')
+    @validate_param({}, {**optional_dataset, 'bvid': (str, None), 'bucket': (float, 10.0),
+                         'unit': (str, None), 'cyclic': (bool, False)})
+    async def density(_request: web.Request, **params):
+        """Request handler for getting danmaku counts over playback progress or send time
+
+        Counts are per bucket seconds of playback progress, or per unit ('hour' or 'day')
+        of send time if unit is given. Queries needing more than 100000 buckets of
+        playback progress are invalid.
+        """
+        db, error = ApiHandler.dataset_db(params['dataset'])
+        if db is None:
+            return error
+        if params['bvid'] is not None and params['bvid'] not in db:
+            return ApiHelper.response(2)
+        if (not math.isfinite(params['bucket']) or params['bucket'] <= 0
+                or params['unit'] not in (None, 'hour', 'day')):
+            return ApiHelper.response(8)
+        if params['unit'] is None:
+            try:
+                counts = await ApiHandler.pool.run('playback_density', db.playback_density,
+                                                   params['bucket'], params['bvid'])
+            except ValueError:
+                # 桶数超出上限
+                return ApiHelper.response(8)
+            data = {'bucket_seconds': params['bucket'], 'counts': counts}
+        else:
+            start, counts = await ApiHandler.pool.run(
+                'send_time_activity', db.send_time_activity, params['unit'], params['bvid'],
+                params['cyclic'])
+            data = {'unit': params['unit'], 'start': start, 'counts': counts}
+        return ApiHelper.response(data=data)
+
     @staticmethod
     @ApiRoutes.get('/api/export_excel')
-    @validate_param({'filename': str})
+    @validate_param({'filename': str}, optional_dataset)
     async def export_excel(_request: web.Request, **params):
         """Request handler for exporting Excel sheets"""
-        if len(ApiHandler.db) == 0:
-            return ApiHelper.response(1)
-        ApiHandler.db.to_excel(params['filename'])
+        db, error = ApiHandler.dataset_db(params['dataset'])
+        if db is None:
+            return error
+        await ApiHandler.pool.run('to_excel', db.to_excel, params['filename'])
         return ApiHelper.response()
 
+    @staticmethod
+    @ApiRoutes.get('/api/worker_stats')
+    async def worker_stats(_request: web.Request):
+        """Request handler for getting worker pool state and job timing metrics"""
+        return ApiHelper.response(data=ApiHandler.pool.stats())
+
     @staticmethod
     @ApiRoutes.get('/api/db_info')
-    async def db_info(_request: web.Request):
+    @validate_param({}, optional_dataset)
+    async def db_info(_request: web.Request, **params):
         """Request handler for getting database info"""
+        found = ApiHandler.registry.get(params['dataset'])
+        if found is None and params['dataset'] is not None:
+            return ApiHelper.response(6)
+        db = found.db if found is not None else DanmakuDB()
         data = {
-            'total_video_count': len(ApiHandler.db),
-            'video_bvids': ApiHandler.db.bvids(),
+            'dataset': found.name if found is not None else None,
+            'total_video_count': len(db),
+            'video_bvids': db.bvids(),
             'video_danmaku_count': {},
             'total_danmaku_count': 0
         }
-        for bvid in ApiHandler.db.bvids():
-            data['video_danmaku_count'][bvid] = len(ApiHandler.db[bvid])
-            data['total_danmaku_count'] += len(ApiHandler.db[bvid])
+        for bvid in db.bvids():
+            data['video_danmaku_count'][bvid] = len(db[bvid])
+            data['total_danmaku_count'] += len(db[bvid])
         return ApiHelper.response(data=data)
 
     @staticmethod
     @ApiRoutes.get('/api/db_data')
-    @validate_param({'bvid': str, 'size': int, 'page': int})
+    @validate_param({'bvid': str, 'size': int, 'page': int}, optional_dataset)
     async def db_data(_request: web.Request, **param):
         """Request handler for getting database info"""
-        if param['bvid'] not in ApiHandler.db.bvids():
+        found = ApiHandler.registry.get(param['dataset'])
+        if found is None and param['dataset'] is not None:
+            return ApiHelper.response(6)
+        if found is None or param['bvid'] not in found.db:
             return ApiHelper.response(2)
         if param['page'] <= 0:
             return ApiHelper.response(3)
-        danmaku_count = len(ApiHandler.db[param['bvid']])
+        db = found.db
+        danmaku_count = len(db[param['bvid']])
         # 参数标准化
         size = min(danmaku_count if param['size'] <= 0 else param['size'], danmaku_count)
-        page_count = math.ceil(danmaku_count / size)
+        # 没有弹幕的视频只有空的第0页
+        page_count = math.ceil(danmaku_count / size) if size > 0 else 0
         page = min(param['page'], page_count)
         data = {
-            'data': ApiHandler.db[param['bvid']][((page - 1) * size):page * size],
+            'data': db[param['bvid']][((page - 1) * size):page * size],
             'page_size': size,
             'page_count': page_count,
             'total_count': danmaku_count
         }
         data['page_size'] = len(data['data'])
         return ApiHelper.response(data=data)
+
+    @staticmethod
+    @ApiRoutes.get('/api/danmakus')
+    @validate_param({'bvid': str}, {
+        **optional_dataset, 'cursor': (int, 0), 'limit': (int, 100),
+        'sort': (str, 'index'), 'descending': (bool, False),
+        'contains': (str, None), 'regex': (str, None),
+        'progress_from': (float, None), 'progress_to': (float, None),
+        'ctime_from': (int, None), 'ctime_to': (int, None),
+        'mode': (int, None), 'color': (int, None), 'part': (int, None)})
+    async def danmakus(_request: web.Request, **params):
+        """Request handler for querying a video's danmakus with filters and cursor pagination"""
+        found = ApiHandler.registry.get(params['dataset'])
+        if found is None and params['dataset'] is not None:
+            return ApiHelper.response(6)
+        if found is None or params['bvid'] not in found.db:
+            return ApiHelper.response(2)
+        danmaku_filter = DanmakuFilter(**{field: params[field] for field in DanmakuFilter._fields})
+        try:
+            danmakus, total_count, next_cursor = await ApiHandler.pool.run(
+                'query', found.db.query, params['bvid'], danmaku_filter, params['sort'],
+                params['descending'], params['cursor'], min(params['limit'], 1000))
+        except (ValueError, re.error):
+            return ApiHelper.response(8)
+        data = {
+            'data': [{'index': index, 'danmaku': danmaku, **attr._asdict()}
+                     for index, danmaku, attr in danmakus],
+            'total_count': total_count,
+            'next_cursor': next_cursor
+        }
+        return ApiHelper.response(data=data)
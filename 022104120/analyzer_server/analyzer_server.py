@@ -3,9 +3,18 @@
 
 """Serves UI pages and API"""
 
+import asyncio
+import logging
 from os import path
 from aiohttp import web
-from .analyzer_api import ApiRoutes
+from danmaku_db import DanmakuCache, metrics
+from .analyzer_api import ApiRoutes, ApiHandler
+from .server_metrics import metrics_middleware, metrics_handler, collect_server_metrics, \
+    ProfileHandler
+from .wordcloud_renderer import WordcloudRenderer
+from .worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
 
 
 class AnalyzerServer:
@@ -16,13 +25,38 @@ class AnalyzerServer:
     """
     ui_path = path.join('visualizer_ui', 'dist')
 
-    def __init__(self):
-        """Create a AnalyzerServer object"""
+    def __init__(self, pool_kind: str = 'thread', max_workers: int = 2, max_queue: int = 8,
+                 memory_budget: int = 1024 * 1024 * 1024, profiling: bool = False,
+                 warm_up: bool = True, cache_filename: str = 'danmaku_cache.sqlite3'):
+        """Create a AnalyzerServer object
+
+        Heavy analysis jobs run in a worker pool of the specified kind ('thread' or 'process'),
+        which rejects jobs once max_queue jobs are waiting for max_workers workers.
+        Process pools copy the dataset to the worker for every job, see WorkerPool.
+        Idle datasets are evicted once they take more than memory_budget bytes.
+        Metrics are served on /metrics, without the stages of the jobs run in a process pool.
+        If profiling is true, stack samples can be captured on /debug/profile.
+        If warm_up is true, the heavy analysis modules, the segmentation model, the font
+        and the mask are loaded in the background once the server is listening.
+        Fetched danmakus are cached in the SQLite file cache_filename ('' for no cache).
+        """
         if not path.exists(path.join(self.ui_path, 'index.html')):
             raise FileNotFoundError('"index.html" not found')
-        self.app_server = web.Application()
+        ApiHandler.pool = WorkerPool(pool_kind, max_workers, max_queue)
+        ApiHandler.registry.memory_budget = memory_budget
+        ApiHandler.cache = DanmakuCache(cache_filename) if cache_filename != '' else None
+        self.warm_up = warm_up
+        self.warm_up_task = None
+        # 启动时加载云图遮罩，供所有请求复用
+        ApiHandler.renderer = WordcloudRenderer(pool=ApiHandler.pool)
+        if collect_server_metrics not in metrics.collectors:
+            metrics.add_collector(collect_server_metrics)
+        self.app_server = web.Application(middlewares=[metrics_middleware])
         # 初始化路由
         self.app_server.router.add_routes(ApiRoutes)
+        self.app_server.router.add_get('/metrics', metrics_handler)
+        if profiling:
+            self.app_server.router.add_get('/debug/profile', ProfileHandler().handle)
         self.app_server.router.add_static('/ui/assets', path=path.join(self.ui_path, 'assets'))
         self.app_server.router.add_get('/ui/{path:.*}', self._index)
 
@@ -36,3 +70,14 @@ class AnalyzerServer:
         await runner.setup()
         site = web.TCPSite(runner, 'localhost', port)
         await site.start()
+        if self.warm_up:
+            self.warm_up_task = asyncio.ensure_future(self._warm_up())
+
+    @staticmethod
+    async def _warm_up():
+        """Warm up the renderer in a thread, so that the first requests are not slowed down"""
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, ApiHandler.renderer.warm_up)
+        except Exception:  # pylint: disable=broad-except
+            # 预热失败不影响服务，首次使用时会再次加载
+            logger.exception('Warm-up failed')
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides DatasetRegistry class for managing the DanmakuDB of each dataset"""
+
+import asyncio
+import time
+from danmaku_db import DanmakuDB
+from .fetch_job import FetchJob
+
+
+class Dataset:
+    """Dataset class.
+
+    Dataset objects hold a named DanmakuDB, where its danmakus come from
+    and the job fetching them.
+    """
+
+    def __init__(self, name: str, db: DanmakuDB, keyword: str = '', n: int = 0,
+                 job: FetchJob = None):
+        """Create a Dataset object"""
+        self.name = name
+        self.db = db
+        self.keyword = keyword
+        self.n = n
+        self.job = job
+        self.created_at = time.time()
+        self.accessed_at = self.created_at
+
+    def info(self) -> dict:
+        """Get the dataset info"""
+        return {
+            'dataset': self.name,
+            'keyword': self.keyword,
+            'n': self.n,
+            'job': self.job.id if self.job is not None else None,
+            'status': self.job.status if self.job is not None else 'done',
+            'video_count': len(self.db),
+            'bytes': self.db.nbytes(),
+            'created_at': self.created_at,
+            'accessed_at': self.accessed_at
+        }
+
+
+class DatasetRegistry:
+    """DatasetRegistry class.
+
+    DatasetRegistry objects map dataset names to datasets, so that clients analyzing
+    different keywords do not share a database. Fetches run as background jobs,
+    concurrent fetches of the same dataset are coalesced into a single job, and
+    the least recently used datasets are evicted once their total size exceeds
+    memory_budget bytes. At most max_jobs jobs are remembered.
+    """
+
+    def __init__(self, db_factory=DanmakuDB, memory_budget: int = 1024 * 1024 * 1024,
+                 max_jobs: int = 100):
+        """Create a DatasetRegistry object creating empty databases with db_factory"""
+        if memory_budget <= 0:
+            raise ValueError('Invalid memory budget')
+        self.db_factory = db_factory
+        self.memory_budget = memory_budget
+        self.datasets = {}
+        self.latest = None
+        self.jobs = {}
+        self.max_jobs = max_jobs
+        self._fetching = {}
+
+    @staticmethod
+    def dataset_name(keyword: str, n: int) -> str:
+        """Get the default dataset name of a fetch"""
+        return f'{keyword}:{n}'
+
+    def get(self, name: str = None):
+        """Get the dataset of the specified name, or the latest fetched one, None if missing"""
+        dataset = self.datasets.get(self.latest if name is None else name)
+        if dataset is not None:
+            dataset.accessed_at = time.time()
+        return dataset
+
+    def start_fetch(self, keyword: str, n: int, name: str = None,
+                    refresh: bool = False, max_age: float = 300.0) -> FetchJob:
+        """Start fetching danmakus from search results into a new database in the background
+
+        The dataset is replaced right away, so the danmakus fetched so far can be used
+        while the job is running or after it is cancelled. If refresh is true and the
+        dataset exists, its database is kept and only the new or stale videos are fetched.
+        If the same keyword and n are being fetched into the dataset already, the running
+        job is returned instead of starting another one. A running job fetching other
+        search results into the dataset is cancelled, since its database is replaced.
+        """
+        if name is None:
+            name = self.dataset_name(keyword, n)
+        job = self._fetching.get(name)
+        if job is not None:
+            if job.keyword == keyword and job.n == n:
+                return job
+            job.cancel()
+        job = FetchJob(name, keyword, n)
+        dataset = self.datasets.get(name)
+        if refresh and dataset is not None:
+            db = dataset.db
+            dataset.job = job
+        else:
+            db = self.db_factory()
+            self.datasets[name] = Dataset(name, db, keyword, n, job)
+        self.latest = name
+        self.jobs[job.id] = job
+        self._fetching[name] = job
+        job.task = asyncio.ensure_future(self._run(job, db, refresh and dataset is not None,
+                                                   max_age))
+        job.task.add_done_callback(lambda _t: self._job_done(job))
+        self._prune_jobs()
+        return job
+
+    async def fetch(self, keyword: str, n: int, name: str = None,
+                    refresh: bool = False, max_age: float = 300.0) -> FetchJob:
+        """Fetch danmakus from search results into a new database and wait for the job
+
+        If the job is cancelled, it is returned as well, with the danmakus fetched so far
+        in its dataset. If it fails, its exception is raised.
+        """
+        job = self.start_fetch(keyword, n, name, refresh, max_age)
+        await asyncio.shield(job.task)
+        if job.exception is not None:
+            raise job.exception
+        return job
+
+    async def _run(self, job: FetchJob, db: DanmakuDB, refresh: bool, max_age: float):
+        try:
+            if refresh:
+                await db.refresh_from_search_result(job.keyword, job.n, max_age, job.update)
+            else:
+                await db.fetch_from_search_result(job.keyword, job.n, job.update)
+        except asyncio.CancelledError:
+            job.finish('cancelled')
+        except Exception as exception:  # pylint: disable=broad-except
+            job.exception = exception
+            job.finish('failed', str(exception))
+        else:
+            job.finish('done')
+        self.evict()
+
+    def _job_done(self, job: FetchJob):
+        """Forget a finished job, unless another job of its dataset has replaced it"""
+        # 任务在开始运行前被取消时，_run不会标记其状态
+        if not job.finished:
+            job.finish('cancelled')
+        if self._fetching.get(job.dataset) is job:
+            del self._fetching[job.dataset]
+
+    def _prune_jobs(self):
+        """Forget the oldest finished jobs when there are more than max_jobs"""
+        finished = [job for job in self.jobs.values() if job.finished]
+        for job in finished[:max(len(self.jobs) - self.max_jobs, 0)]:
+            del self.jobs[job.id]
+
+    def evict(self):
+        """Evict the least recently used datasets until the total size fits in the budget
+
+        The latest fetched dataset and the datasets being fetched are never evicted.
+        """
+        fetching = {job.dataset for job in self._fetching.values()}
+        sizes = {name: dataset.db.nbytes() for name, dataset in self.datasets.items()}
+        total_bytes = sum(sizes.values())
+        for dataset in sorted(self.datasets.values(), key=lambda d: d.accessed_at):
+            if total_bytes <= self.memory_budget:
+                break
+            if dataset.name == self.latest or dataset.name in fetching:
+                continue
+            del self.datasets[dataset.name]
+            total_bytes -= sizes[dataset.name]
+
+    def infos(self) -> list:
+        """Get the info of all the datasets"""
+        return [dataset.info() for dataset in self.datasets.values()]
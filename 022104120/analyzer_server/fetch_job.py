@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides FetchJob class for tracking background fetches"""
+
+import asyncio
+import time
+import uuid
+
+
+class FetchJob:
+    """FetchJob class.
+
+    FetchJob objects track the progress of a fetch running in the background.
+    Waiters are woken up on every progress update through wait_update.
+    """
+
+    def __init__(self, dataset: str, keyword: str, n: int):
+        """Create a FetchJob object"""
+        self.id = uuid.uuid4().hex
+        self.dataset = dataset
+        self.keyword = keyword
+        self.n = n
+        self.status = 'running'
+        self.error = None
+        self.exception = None
+        self.videos_done = 0
+        self.videos_scheduled = 0
+        self.danmakus = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        self.task = None
+        self._updated = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        """Whether the job is not running anymore"""
+        return self.status != 'running'
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def update(self, videos_done: int, videos_scheduled: int, danmakus: int):
+        """Update the progress, used as the progress callback of fetch_from_search_result"""
+        self.videos_done = videos_done
+        self.videos_scheduled = videos_scheduled
+        self.danmakus = danmakus
+        self._notify()
+
+    def finish(self, status: str, error: str = None):
+        """Mark the job as finished with the specified status"""
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+        self._notify()
+
+    async def wait_update(self, timeout: float = None) -> bool:
+        """Wait for the next update, return False if timed out"""
+        if self.finished:
+            return True
+        try:
+            await asyncio.wait_for(self._updated.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def cancel(self) -> bool:
+        """Cancel the job, the danmakus fetched so far stay in the dataset"""
+        if self.finished or self.task is None:
+            return False
+        return self.task.cancel()
+
+    def info(self) -> dict:
+        """Get the job state and progress"""
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            'job': self.id,
+            'dataset': self.dataset,
+            'keyword': self.keyword,
+            'n': self.n,
+            'status': self.status,
+            'error': self.error,
+            'videos_done': self.videos_done,
+            'videos_scheduled': self.videos_scheduled,
+            'danmakus': self.danmakus,
+            'elapsed_seconds': elapsed,
+            'videos_per_second': self.videos_done / elapsed if elapsed > 0 else 0.0,
+            'danmakus_per_second': self.danmakus / elapsed if elapsed > 0 else 0.0
+        }
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides SamplingProfiler class for capturing stack samples of a running server"""
+
+import sys
+import threading
+import time
+from collections import Counter
+from os import path
+
+# 线程空闲等待时所在的函数，默认不计入采样
+IDLE_FUNCTIONS = frozenset({
+    ('threading.py', 'wait'),
+    ('selectors.py', 'select'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('process.py', '_queue_management_worker'),
+    ('connection.py', 'wait')
+})
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is being captured"""
+
+
+def _frame_key(frame) -> tuple:
+    code = frame.f_code
+    return path.basename(code.co_filename), code.co_name, code.co_firstlineno
+
+
+class SamplingProfiler:
+    """SamplingProfiler class.
+
+    SamplingProfiler objects sample the Python stacks of all the threads of the process
+    every interval seconds, without tracing calls, so the overhead stays low enough for
+    production. Jobs run in worker processes are not sampled.
+    """
+
+    def __init__(self, max_seconds: float = 60.0, max_depth: int = 64):
+        """Create a SamplingProfiler object
+
+        Profiles last at most max_seconds and stacks are truncated to max_depth frames.
+        """
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+
+    def profile(self, seconds: float, interval: float = 0.005, idle: bool = False) -> tuple:
+        """Sample the stacks for seconds and get (sample count, Counter of stacks)
+
+        Each stack is a tuple of the thread name and the (file name, function name,
+        first line) of its frames from the outermost one. Stacks of idle threads
+        are skipped unless idle is true. This call blocks, so run it in a thread.
+        """
+        if not 0 < seconds <= self.max_seconds or interval <= 0:
+            raise ValueError('Invalid profile duration')
+        # 非阻塞获取锁，已有采样时立即报错，无法使用with语句
+        if not self._lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+            raise ProfilerBusyError('A profile is already being captured')
+        try:
+            own_ident = threading.get_ident()
+            thread_names = {}
+            stacks = Counter()
+            samples = 0
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                # pylint: disable=protected-access
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    frames = []
+                    while frame is not None and len(frames) < self.max_depth:
+                        frames.append(_frame_key(frame))
+                        frame = frame.f_back
+                    if not idle and frames and frames[0][:2] in IDLE_FUNCTIONS:
+                        continue
+                    if ident not in thread_names:
+                        thread_names.update((thread.ident, thread.name)
+                                            for thread in threading.enumerate())
+                    frames.append(thread_names.get(ident, str(ident)))
+                    stacks[tuple(reversed(frames))] += 1
+                samples += 1
+                time.sleep(interval)
+            return samples, stacks
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def collapsed(stacks: Counter) -> str:
+        """Format the stacks in the collapsed format read by flame graph tools"""
+        return ''.join(
+            ';'.join([stack[0]] + [f'{function} ({filename}:{line})'
+                                   for filename, function, line in stack[1:]])
+            + f' {count}\n' for stack, count in stacks.most_common())
+
+    @staticmethod
+    def top_functions(stacks: Counter, max_n: int = 50) -> list:
+        """Get (function, self samples, total samples) of the top n functions by self samples"""
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in stacks.items():
+            if len(stack) > 1:
+                self_counts[stack[-1]] += count
+            # 递归调用的函数只计一次
+            for frame in set(stack[1:]):
+                total_counts[frame] += count
+        return [(f'{function} ({filename}:{line})', self_count,
+                 total_counts[(filename, function, line)])
+                for (filename, function, line), self_count in self_counts.most_common(max_n)]
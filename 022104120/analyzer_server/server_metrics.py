@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides the metrics middleware and the metrics and profile request handlers"""
+
+import asyncio
+import time
+from aiohttp import web
+from danmaku_db import metrics
+from .analyzer_api import ApiHandler, ApiHelper, validate_param
+from .sampling_profiler import SamplingProfiler, ProfilerBusyError
+
+HTTP_SECONDS = metrics.histogram(
+    'analyzer_http_request_duration_seconds', 'Latency of HTTP requests by route',
+    ('method', 'route', 'status'))
+HTTP_IN_FLIGHT = metrics.gauge(
+    'analyzer_http_requests_in_flight', 'HTTP requests being handled by route', ('route',))
+
+
+def _route_name(request: web.Request) -> str:
+    """Get the route pattern of a request, so that metrics have few label values"""
+    route = request.match_info.route
+    # 未匹配的路径不作为标签，避免标签取值无限增长
+    if route.resource is None:
+        return 'unmatched'
+    return route.resource.canonical
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    """Record the latency and in-flight count of the requests of each route"""
+    route = _route_name(request)
+    status = 500
+    started_at = time.perf_counter()
+    HTTP_IN_FLIGHT.inc(route=route)
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exception:
+        status = exception.status
+        raise
+    finally:
+        HTTP_IN_FLIGHT.dec(route=route)
+        HTTP_SECONDS.observe(time.perf_counter() - started_at, method=request.method,
+                             route=route, status=status)
+
+
+def collect_server_metrics() -> list:
+    """Get the metric families of the worker pool and the datasets"""
+    stats = ApiHandler.pool.stats()
+    jobs = stats['jobs'].items()
+    infos = ApiHandler.registry.infos()
+    return [
+        ('analyzer_worker_pending_jobs', 'gauge', 'Jobs running or waiting in the worker pool',
+         [({}, stats['pending'])]),
+        ('analyzer_worker_jobs_total', 'counter', 'Jobs finished in the worker pool',
+         [({'job': name}, job['count']) for name, job in jobs]),
+        ('analyzer_worker_job_failures_total', 'counter', 'Jobs failed in the worker pool',
+         [({'job': name}, job['failures']) for name, job in jobs]),
+        ('analyzer_worker_job_rejections_total', 'counter',
+         'Jobs rejected by the saturated worker pool',
+         [({'job': name}, job['rejected']) for name, job in jobs]),
+        ('analyzer_worker_job_seconds_total', 'counter', 'Running time of the worker pool jobs',
+         [({'job': name}, job['total_seconds']) for name, job in jobs]),
+        ('analyzer_datasets', 'gauge', 'Datasets in the registry', [({}, len(infos))]),
+        ('analyzer_dataset_bytes', 'gauge', 'Estimated memory used by the datasets',
+         [({'dataset': info['dataset']}, info['bytes']) for info in infos])
+    ]
+
+
+async def metrics_handler(_request: web.Request):
+    """Request handler for the metrics in the Prometheus text format"""
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
+
+class ProfileHandler:
+    """ProfileHandler class.
+
+    ProfileHandler objects capture stack samples of the server with a SamplingProfiler
+    and respond with collapsed stacks or a table of the top functions.
+    """
+
+    def __init__(self, profiler: SamplingProfiler = None):
+        """Create a ProfileHandler object"""
+        self.profiler = profiler if profiler is not None else SamplingProfiler()
+        self._handler = validate_param({}, {
+            'seconds': (float, 5.0), 'interval': (float, 0.005), 'format': (str, 'collapsed'),
+            'idle': (bool, False), 'n': (int, 50)})(self._profile)
+
+    async def handle(self, request: web.Request):
+        """Request handler for capturing a profile"""
+        return await self._handler(request)
+
+    async def _profile(self, _request: web.Request, **params):
+        if params['format'] not in ('collapsed', 'top'):
+            return web.Response(status=400, text="Bad request")
+        try:
+            samples, stacks = await asyncio.get_running_loop().run_in_executor(
+                None, self.profiler.profile, params['seconds'], params['interval'],
+                params['idle'])
+        except ValueError:
+            return web.Response(status=400, text="Bad request")
+        except ProfilerBusyError:
+            return ApiHelper.response(5)
+        if params['format'] == 'collapsed':
+            return web.Response(text=self.profiler.collapsed(stacks))
+        lines = [f'# {samples} samples', f'{"self":>8}{"total":>8}  function']
+        lines += [f'{self_count:>8}{total_count:>8}  {function}' for function, self_count,
+                  total_count in self.profiler.top_functions(stacks, params['n'])]
+        return web.Response(text='\n'.join(lines) + '\n')
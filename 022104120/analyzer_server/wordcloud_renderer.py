@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides WordcloudRenderer class for rendering and caching word cloud images"""
+
+import asyncio
+import hashlib
+import io
+from collections import OrderedDict
+from os import path
+from danmaku_db import DanmakuDB, warm_up
+from danmaku_db.danmaku_metrics import STAGE_SECONDS, CACHE_REQUESTS
+from .worker_pool import WorkerPool
+
+
+def _render_png(db: DanmakuDB, font_path: str, mask_path: str, mask, scale: float) -> tuple:
+    """Render the word cloud of the database and get its (ETag, PNG bytes)"""
+    image = db.to_wordcloud(font_path, mask_path, mask=mask, scale=scale)
+    image_buf = io.BytesIO()
+    with STAGE_SECONDS.time(stage='png_encode'):
+        image.save(image_buf, 'png')
+    png = image_buf.getvalue()
+    return f'"{hashlib.sha1(png).hexdigest()}"', png
+
+
+class WordcloudRenderer:
+    """WordcloudRenderer class.
+
+    WordcloudRenderer objects render word cloud PNGs of DanmakuDB objects in a worker pool
+    and cache them by the database content version and the render parameters.
+    The mask image is loaded once, on first use or by warm_up.
+    """
+
+    def __init__(self, font_path: str = path.join('danmaku_db', 'fzht.ttf'),
+                 mask_path: str = path.join('danmaku_db', 'earth.png'),
+                 max_entries: int = 16, pool: WorkerPool = None):
+        """Create a WordcloudRenderer object"""
+        for file_path in (font_path, mask_path):
+            if not path.exists(file_path):
+                raise FileNotFoundError(f'"{file_path}" not found')
+        if max_entries <= 0:
+            raise ValueError('Invalid max entries')
+        self.font_path = font_path
+        self.mask_path = mask_path
+        self._mask = None
+        self.max_entries = max_entries
+        self.pool = pool
+        self._cache = OrderedDict()
+        self._rendering = {}
+
+    def _load_mask(self):
+        if self._mask is None:
+            from imageio.v2 import imread  # pylint: disable=import-outside-toplevel
+            self._mask = imread(self.mask_path)
+        return self._mask
+
+    @property
+    def mask(self):
+        """Mask image array, loaded on first use"""
+        return self._load_mask()
+
+    def warm_up(self):
+        """Load the mask, the font, the segmentation model and the rendering modules"""
+        warm_up(font_path=self.font_path)
+        self._load_mask()
+
+    def cached(self, db: DanmakuDB, scale: float = 1):
+        """Get the cached (ETag, PNG bytes) of the current database content, or None"""
+        key = (id(db), db.version, self.font_path, self.mask_path, scale)
+        result = self._cache.get(key)
+        if result is not None:
+            self._cache.move_to_end(key)
+        return result
+
+    async def render(self, db: DanmakuDB, scale: float = 1) -> tuple:
+        """Get the (ETag, PNG bytes) of the word cloud of the database
+
+        Concurrent requests for the same content share a single render.
+        """
+        key = (id(db), db.version, self.font_path, self.mask_path, scale)
+        result = self.cached(db, scale)
+        CACHE_REQUESTS.inc(kind='wordcloud', result='miss' if result is None else 'hit')
+        if result is not None:
+            return result
+        future = self._rendering.get(key)
+        if future is None:
+            args = (db, self.font_path, self.mask_path, self.mask, scale)
+            if self.pool is None:
+                future = asyncio.get_running_loop().run_in_executor(None, _render_png, *args)
+            else:
+                future = asyncio.ensure_future(self.pool.run('wordcloud', _render_png, *args))
+            self._rendering[key] = future
+            future.add_done_callback(lambda _f: self._rendering.pop(key, None))
+        result = await asyncio.shield(future)
+        self._cache[key] = result
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return result
+
+    def clear(self):
+        """Remove all the cached images"""
+        self._cache.clear()
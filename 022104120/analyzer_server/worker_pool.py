@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides WorkerPool class for running CPU-bound jobs off the event loop"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturatedError(Exception):
+    """Raised when a job is submitted to a WorkerPool whose queue is full"""
+
+
+class JobMetrics:
+    """JobMetrics class.
+
+    JobMetrics objects accumulate the timing of the jobs of the same name.
+    """
+
+    def __init__(self):
+        """Create an empty JobMetrics object"""
+        self.count = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+        self.total_wait_seconds = 0.0
+
+    def record(self, wait_seconds: float, run_seconds: float, failed: bool):
+        """Record a finished job"""
+        self.count += 1
+        self.failures += int(failed)
+        self.total_seconds += run_seconds
+        self.max_seconds = max(self.max_seconds, run_seconds)
+        self.last_seconds = run_seconds
+        self.total_wait_seconds += wait_seconds
+
+    def to_dict(self) -> dict:
+        """Get the metrics as a dict"""
+        return {
+            'count': self.count,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'total_seconds': self.total_seconds,
+            'mean_seconds': self.total_seconds / self.count if self.count > 0 else 0.0,
+            'max_seconds': self.max_seconds,
+            'last_seconds': self.last_seconds,
+            'mean_wait_seconds': self.total_wait_seconds / self.count if self.count > 0 else 0.0
+        }
+
+
+def _timed_call(func, args: tuple, submitted_at: float) -> tuple:
+    """Call func in a worker and measure the queueing and running time"""
+    started_at = time.time()
+    result = func(*args)
+    return result, started_at - submitted_at, time.time() - started_at
+
+
+class WorkerPool:
+    """WorkerPool class.
+
+    WorkerPool objects run jobs in a thread or process pool. At most max_workers jobs run
+    at the same time and at most max_queue jobs wait for a worker, further jobs are rejected
+    with PoolSaturatedError. A job keeps its slot until it finishes, even if its caller
+    is cancelled. Jobs submitted to a process pool must be picklable, and their arguments
+    are pickled for every job: a bound method of a DanmakuDB copies the whole database
+    to the worker, and the indexes the worker builds are lost. Process pools thus only
+    suit jobs of small arguments, not the per-dataset analyses of the API.
+    """
+
+    def __init__(self, kind: str = 'thread', max_workers: int = 2, max_queue: int = 8):
+        """Create a WorkerPool object of the specified kind ('thread' or 'process')"""
+        if kind not in ('thread', 'process'):
+            raise ValueError('Invalid pool kind')
+        if max_workers <= 0 or max_queue < 0:
+            raise ValueError('Invalid pool size')
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.metrics = {}
+        if kind == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='analyzer-worker')
+        else:
+            self.executor = ProcessPoolExecutor(max_workers)
+
+    async def run(self, name: str, func, *args):
+        """Run func(*args) as a job of the specified name in the pool and return its result"""
+        metrics = self.metrics.get(name)
+        if metrics is None:
+            metrics = self.metrics[name] = JobMetrics()
+        if self.pending >= self.max_workers + self.max_queue:
+            metrics.rejected += 1
+            raise PoolSaturatedError(f'Worker pool is saturated, rejected job "{name}"')
+        self.pending += 1
+        submitted_at = time.time()
+        loop = asyncio.get_running_loop()
+        future = self.executor.submit(_timed_call, func, args, submitted_at)
+        # 等待的协程被取消时任务可能仍在运行，任务结束后才释放名额
+        future.add_done_callback(lambda _future: self._release(loop))
+        try:
+            result, wait_seconds, run_seconds = await asyncio.wrap_future(future)
+        except Exception:
+            metrics.record(0.0, time.time() - submitted_at, True)
+            raise
+        metrics.record(wait_seconds, run_seconds, False)
+        logger.info('Job "%s" finished in %.3fs after waiting %.3fs', name, run_seconds,
+                    wait_seconds)
+        return result
+
+    def _release(self, loop: asyncio.AbstractEventLoop):
+        """Release the slot of a finished job, called from the worker"""
+        try:
+            loop.call_soon_threadsafe(self._decrement_pending)
+        except RuntimeError:
+            # 事件循环已关闭
+            self._decrement_pending()
+
+    def _decrement_pending(self):
+        self.pending -= 1
+
+    def stats(self) -> dict:
+        """Get the pool state and the metrics of each job name"""
+        return {
+            'kind': self.kind,
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'pending': self.pending,
+            'jobs': {name: metrics.to_dict() for name, metrics in self.metrics.items()}
+        }
+
+    def shutdown(self):
+        """Shut down the pool, waiting for the running jobs"""
+        self.executor.shutdown()
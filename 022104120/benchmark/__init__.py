@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Export SyntheticCorpus, FixedCorpus, StubBilibili, BenchmarkRunner and run_benchmarks"""
+
+from .synthetic_corpus import SyntheticCorpus, FixedCorpus
+from .stub_bilibili import StubBilibili, StubDanmaku, install_character_model
+from .benchmark_runner import BenchmarkRunner, run_benchmarks, compare_results, save_results
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Entrypoint of the benchmarks, run with "python -m benchmark" in the 022104120 directory"""
+
+import argparse
+import asyncio
+import json
+from danmaku_db import Segmenter
+from . import SyntheticCorpus, install_character_model, run_benchmarks, compare_results, \
+    save_results
+
+
+def main():
+    """Parse the arguments, run the benchmarks and write the results"""
+    parser = argparse.ArgumentParser(description='Benchmark DanmakuDB and the web API offline')
+    parser.add_argument('--videos', type=int, default=100, help='count of videos')
+    parser.add_argument('--danmakus', type=int, default=1000, help='count of danmakus per video')
+    parser.add_argument('--vocabulary', type=int, default=5000, help='count of distinct words')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic corpus')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds waited before each stub response')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrency of fetches')
+    parser.add_argument('--model', default='character',
+                        help='pkuseg model name, or "character" for an offline character model')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='trace the peak memory of each step, which slows the steps down')
+    parser.add_argument('--output', default='benchmark_results.json', help='results JSON file')
+    parser.add_argument('--compare', help='results JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    model_name = install_character_model() if args.model == 'character' else args.model
+    segmenter = Segmenter(model_name)
+    corpus = SyntheticCorpus(args.videos, args.danmakus, args.vocabulary, seed=args.seed)
+    try:
+        results = asyncio.run(run_benchmarks(corpus, segmenter, args.latency, args.concurrency,
+                                             args.trace_memory))
+    finally:
+        segmenter.close()
+    save_results(results, args.output)
+    print(f'结果已写入“{args.output}”')
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        for name, seconds, baseline_seconds, ratio in compare_results(results, baseline):
+            print(f'{name:<32}{baseline_seconds * 1000:>12.2f} ms ->{seconds * 1000:>12.2f} ms'
+                  + (f'{ratio:>8.2f}x' if ratio is not None else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides BenchmarkRunner class and the benchmarks of DanmakuDB and the web API"""
+
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from danmaku_db import DanmakuDB, DanmakuFilter, Segmenter
+from analyzer_server.analyzer_api import ApiRoutes, ApiHandler
+from analyzer_server.dataset_registry import DatasetRegistry
+from analyzer_server.wordcloud_renderer import WordcloudRenderer
+from .synthetic_corpus import SyntheticCorpus
+from .stub_bilibili import StubBilibili
+
+try:
+    import resource
+except ImportError:
+    # Windows上没有resource模块
+    resource = None
+
+KEYWORD = 'benchmark'
+
+
+def max_rss_bytes():
+    """Get the peak resident set size of the process so far, None if unavailable"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS以字节为单位，其他系统以KiB为单位
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class BenchmarkRunner:
+    """BenchmarkRunner class.
+
+    BenchmarkRunner objects time benchmark steps and record their wall time, their throughput
+    and the peak resident set size of the process so far. If trace_memory is true, the peak
+    of the memory allocated during each step is traced too, which slows the steps down.
+    """
+
+    def __init__(self, trace_memory: bool = False, verbose: bool = True):
+        """Create a BenchmarkRunner object"""
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.results = []
+
+    def _start(self) -> tuple:
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            return time.perf_counter(), tracemalloc.get_traced_memory()[0]
+        return time.perf_counter(), 0
+
+    def _record(self, name: str, started: tuple, items: int):
+        seconds = time.perf_counter() - started[0]
+        peak_bytes = tracemalloc.get_traced_memory()[1] - started[1] if self.trace_memory else None
+        result = {
+            'name': name,
+            'seconds': seconds,
+            'peak_bytes': peak_bytes,
+            'items': items,
+            'items_per_second': items / seconds if items is not None and seconds > 0 else None,
+            'max_rss_bytes': max_rss_bytes()
+        }
+        self.results.append(result)
+        if self.verbose:
+            print(f'{name:<32}{seconds * 1000:>12.2f} ms'
+                  + (f'{peak_bytes / 1024 / 1024:>12.2f} MiB' if peak_bytes is not None else ''))
+        return result
+
+    def measure(self, name: str, func, *args, items: int = None):
+        """Time a call of func and return its result"""
+        started = self._start()
+        result = func(*args)
+        self._record(name, started, items)
+        return result
+
+    async def measure_async(self, name: str, coro_factory, items: int = None):
+        """Time an await of the coroutine created by coro_factory and return its result"""
+        started = self._start()
+        result = await coro_factory()
+        self._record(name, started, items)
+        return result
+
+    def to_dict(self, config: dict) -> dict:
+        """Get the results with the configuration and environment of the run"""
+        return {
+            'config': config,
+            'environment': {
+                'python': sys.version,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'time': time.time()
+            },
+            'results': self.results
+        }
+
+
+async def benchmark_danmaku_db(runner: BenchmarkRunner, corpus: SyntheticCorpus,
+                               segmenter: Segmenter, concurrency: int, work_dir: str):
+    """Benchmark the DanmakuDB operations on the corpus"""
+    danmaku_count = corpus.danmaku_count()
+    danmaku_db = DanmakuDB(concurrency=concurrency, segmenter=segmenter)
+    await runner.measure_async('fetch_from_search_result',
+                               lambda: danmaku_db.fetch_from_search_result(
+                                   KEYWORD, corpus.video_count), items=danmaku_count)
+    runner.measure('top_danmakus_cold', danmaku_db.top_danmakus, 20, items=danmaku_count)
+    runner.measure('top_danmakus_warm', danmaku_db.top_danmakus, 20)
+    runner.measure('top_danmaku_clusters', danmaku_db.top_danmaku_clusters, 20,
+                   items=danmaku_count)
+    bvid = corpus.bvid(0)
+    runner.measure('query_progress_range', danmaku_db.query, bvid,
+                   DanmakuFilter(progress_from=30.0, progress_to=90.0), 'progress')
+    runner.measure('search', danmaku_db.search, ['哈'], items=danmaku_count)
+    runner.measure('playback_density', danmaku_db.playback_density, 10.0, items=danmaku_count)
+    runner.measure('send_time_activity', danmaku_db.send_time_activity, 'hour',
+                   items=danmaku_count)
+    runner.measure('to_wordcloud', danmaku_db.to_wordcloud, items=danmaku_count)
+    excel_filename = os.path.join(work_dir, 'benchmark.xlsx')
+    runner.measure('to_excel', danmaku_db.to_excel, excel_filename, items=danmaku_count)
+    runner.measure('read_excel', DanmakuDB(segmenter=segmenter).read_excel, excel_filename,
+                   items=danmaku_count)
+    snapshot_filename = os.path.join(work_dir, 'benchmark.snapshot')
+    runner.measure('save_snapshot', danmaku_db.save, snapshot_filename, items=danmaku_count)
+    runner.measure('load_snapshot', DanmakuDB(segmenter=segmenter).load, snapshot_filename,
+                   items=danmaku_count)
+
+
+async def benchmark_api(runner: BenchmarkRunner, corpus: SyntheticCorpus,
+                        segmenter: Segmenter, concurrency: int, work_dir: str):
+    """Benchmark the API endpoints on the corpus"""
+    danmaku_count = corpus.danmaku_count()
+    # 基准测试替换ApiHandler的类属性，结束后恢复
+    originals = {name: getattr(ApiHandler, name)
+                 for name in ('cache', 'registry', 'pool', 'renderer')}
+    ApiHandler.cache = None
+    ApiHandler.registry = DatasetRegistry(lambda: DanmakuDB(concurrency=concurrency,
+                                                            segmenter=segmenter))
+    ApiHandler.renderer = WordcloudRenderer(pool=ApiHandler.pool)
+    app = web.Application()
+    app.router.add_routes(ApiRoutes)
+    excel_filename = os.path.join(work_dir, 'api_benchmark.xlsx')
+    try:
+        async with TestClient(TestServer(app)) as client:
+            async def request(url: str) -> bytes:
+                response = await client.get(url)
+                body = await response.read()
+                if response.status not in (200, 304):
+                    raise RuntimeError(f'{url} responded {response.status}')
+                return body
+
+            body = await runner.measure_async(
+                'api_fetch',
+                lambda: request(f'/api/fetch?keyword={KEYWORD}&n={corpus.video_count}&wait=true'),
+                items=danmaku_count)
+            job = json.loads(body)['job']
+            endpoints = [
+                ('fetch_status', f'/api/fetch_status?job={job}', None),
+                ('datasets', '/api/datasets', None),
+                ('top_danmakus', '/api/top_danmakus?n=20', None),
+                ('top_danmakus_cluster', '/api/top_danmakus?n=20&cluster=true', danmaku_count),
+                ('wordcloud', '/api/wordcloud', danmaku_count),
+                ('wordcloud_cached', '/api/wordcloud', None),
+                ('danmakus', f'/api/danmakus?bvid={corpus.bvid(0)}&sort=progress&limit=100',
+                 None),
+                ('search', '/api/search?words=哈', danmaku_count),
+                ('cooccurrence', '/api/cooccurrence?word=哈&n=20', None),
+                ('density', '/api/density?bucket=10', danmaku_count),
+                ('db_info', '/api/db_info', None),
+                ('db_data', f'/api/db_data?bvid={corpus.bvid(0)}&size=100&page=1', None),
+                ('export_excel', f'/api/export_excel?filename={excel_filename}',
+                 danmaku_count),
+            ]
+            for name, url, items in endpoints:
+                await runner.measure_async(f'api_{name}', lambda url=url: request(url),
+                                           items=items)
+    finally:
+        for name, value in originals.items():
+            setattr(ApiHandler, name, value)
+
+
+async def run_benchmarks(corpus: SyntheticCorpus, segmenter: Segmenter, latency: float = 0.0,
+                         concurrency: int = 8, trace_memory: bool = False,
+                         verbose: bool = True) -> dict:
+    """Run all the benchmarks with the corpus served offline and get the results"""
+    runner = BenchmarkRunner(trace_memory, verbose)
+    # 预先生成XML，不计入获取的耗时
+    for i in range(corpus.video_count):
+        corpus.danmaku_xml(corpus.bvid(i))
+    stub = StubBilibili(corpus, latency)
+    with stub, tempfile.TemporaryDirectory() as work_dir:
+        await benchmark_danmaku_db(runner, corpus, segmenter, concurrency, work_dir)
+        await benchmark_api(runner, corpus, segmenter, concurrency, work_dir)
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return runner.to_dict({
+        'video_count': corpus.video_count,
+        'danmakus_per_video': corpus.danmakus_per_video,
+        'seed': corpus.seed,
+        'latency': latency,
+        'concurrency': concurrency,
+        'model': segmenter.model_name,
+        'trace_memory': trace_memory,
+        'requests': stub.requests,
+        'max_in_flight': stub.max_in_flight
+    })
+
+
+def compare_results(results: dict, baseline: dict) -> list:
+    """Get (name, seconds, baseline seconds, ratio) of the steps found in both runs"""
+    baseline_seconds = {result['name']: result['seconds'] for result in baseline['results']}
+    return [(result['name'], result['seconds'], baseline_seconds[result['name']],
+             result['seconds'] / baseline_seconds[result['name']]
+             if baseline_seconds[result['name']] > 0 else None)
+            for result in results['results'] if result['name'] in baseline_seconds]
+
+
+def save_results(results: dict, filename: str):
+    """Write the results to a JSON file"""
+    with open(filename, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, ensure_ascii=False, indent=2)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides offline stand-ins of bilibili_api calls and of the segmentation model"""
+
+import asyncio
+import bilibili_api as bapi
+from danmaku_db import register_model
+from danmaku_db.danmaku_xml import DanmakuAttr, parse_danmaku_xml
+
+
+class StubDanmaku:
+    """StubDanmaku class.
+
+    StubDanmaku objects stand in for bilibili_api.utils.danmaku.Danmaku,
+    as returned by Video.get_danmakus.
+    """
+
+    def __init__(self, text: str, attr: DanmakuAttr):
+        """Create a StubDanmaku object from parsed danmaku attributes"""
+        self.text = text
+        self.dm_time = attr.progress
+        self.mode = attr.mode
+        self.color = f'{attr.color:x}'
+        self.send_time = attr.ctime
+        self.id_ = attr.row_id
+
+
+class StubBilibili:
+    """StubBilibili class.
+
+    StubBilibili objects serve a corpus (SyntheticCorpus or FixedCorpus) in place of
+    bilibili_api.video.Video and bilibili_api.search.search_by_type while installed,
+    waiting latency seconds before each response. Videos have a part of each of durations
+    seconds, with cids from 100. Searched pages, fetched bvids and part cids are recorded,
+    as well as the maximum of video requests in flight.
+    """
+
+    def __init__(self, corpus, latency: float = 0.0, durations: tuple = (600,)):
+        """Create a StubBilibili object"""
+        self.corpus = corpus
+        self.latency = latency
+        self.durations = durations
+        self.requests = 0
+        self.searched_pages = []
+        self.fetched_bvids = []
+        self.fetched_parts = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._originals = None
+
+    async def respond(self, value_factory, counted: bool = True):
+        """Get the value of value_factory after the latency, counting the request
+
+        Requests in flight are tracked unless counted is false.
+        """
+        self.requests += 1
+        if counted:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            if counted:
+                self.in_flight -= 1
+        return value_factory()
+
+    async def search_by_type(self, _keyword, _search_type, _order_type, page=1, **_kwargs):
+        """Stand-in of bilibili_api.search.search_by_type"""
+        self.searched_pages.append(page)
+        # 搜索请求不受DanmakuDB的并发限制，不计入并发数
+        return await self.respond(lambda: self.corpus.search_page(page), False)
+
+    def video(self, bvid: str, **_kwargs):
+        """Stand-in of the bilibili_api.video.Video constructor"""
+        stub = self
+
+        class StubVideo:
+            """Stand-in of bilibili_api.video.Video"""
+            async def _fetch(self, cid: int) -> str:
+                danmaku_xml = await stub.respond(lambda: stub.corpus.danmaku_xml(bvid))
+                stub.fetched_bvids.append(bvid)
+                stub.fetched_parts.append(cid)
+                return danmaku_xml
+
+            async def get_pages(self):
+                """Stand-in of Video.get_pages"""
+                return await stub.respond(lambda: [
+                    {'cid': 100 + i, 'page': i + 1, 'duration': duration}
+                    for i, duration in enumerate(stub.durations)])
+
+            async def get_danmaku_xml(self, page_index=None, cid=None):
+                """Stand-in of Video.get_danmaku_xml"""
+                return await self._fetch(cid if cid is not None else 100 + page_index)
+
+            async def get_danmakus(self, page_index=0, date=None, cid=None):
+                """Stand-in of Video.get_danmakus"""
+                del date
+                danmaku_xml = await self._fetch(cid if cid is not None else 100 + page_index)
+                return [StubDanmaku(text, attr) for text, attr in parse_danmaku_xml(danmaku_xml)]
+        return StubVideo()
+
+    def install(self):
+        """Replace the bilibili_api calls with the stand-ins"""
+        if self._originals is None:
+            self._originals = (bapi.search.search_by_type, bapi.video.Video)
+            bapi.search.search_by_type = self.search_by_type
+            bapi.video.Video = self.video
+
+    def uninstall(self):
+        """Restore the bilibili_api calls"""
+        if self._originals is not None:
+            bapi.search.search_by_type, bapi.video.Video = self._originals
+            self._originals = None
+
+    def __enter__(self):
+        """Install the stand-ins in a with statement"""
+        self.install()
+        return self
+
+    def __exit__(self, *_exc_info):
+        """Uninstall the stand-ins at the end of a with statement"""
+        self.uninstall()
+
+
+class CharacterModel:
+    """CharacterModel class.
+
+    Offline stand-in of a pkuseg model, cutting texts into single characters.
+    """
+
+    def cut(self, text: str) -> list:
+        """Cut a text into its characters"""
+        return list(text)
+
+
+def install_character_model(model_name: str = 'benchmark') -> str:
+    """Register a CharacterModel under model_name for Segmenter objects and return the name"""
+    register_model(model_name, CharacterModel)
+    return model_name
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides SyntheticCorpus class for generating danmaku XML and search results"""
+
+import random
+from xml.sax.saxutils import escape
+
+# 常见的弹幕，使高频弹幕与近似弹幕的分布接近真实情况
+COMMON_DANMAKUS = ['哈哈哈哈', '哈哈哈哈哈', '2333', '23333', '前方高能', '前方高能！',
+                   'awsl', 'ＡＷＳＬ', '泪目', '来了来了', '好家伙', '？？？', '妙啊',
+                   '下次一定']
+# 用于生成词汇表的常用字
+CHARACTERS = ('的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要她出'
+              '也得里后自以会家可下而过天去能对小多然于心学么之都好看起发当没成只如'
+              '事把还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动方期'
+              '它头经长儿回位分爱老因很给名法间斯知世什两次使身者被高已亲其进')
+
+
+class SyntheticCorpus:
+    """SyntheticCorpus class.
+
+    SyntheticCorpus objects generate the danmaku XML of video_count videos and the search
+    results listing them, deterministically from seed. Danmaku texts are made of words
+    drawn from a Zipf-like distribution, mixed with common danmakus and their variants.
+    """
+
+    def __init__(self, video_count: int = 100, danmakus_per_video: int = 1000,
+                 vocabulary_size: int = 5000, page_size: int = 20, seed: int = 1):
+        """Create a SyntheticCorpus object"""
+        if video_count <= 0 or danmakus_per_video < 0 or vocabulary_size <= 0:
+            raise ValueError('Invalid corpus size')
+        self.video_count = video_count
+        self.danmakus_per_video = danmakus_per_video
+        self.page_size = page_size
+        self.seed = seed
+        rng = random.Random(seed)
+        self.vocabulary = list(dict.fromkeys(
+            ''.join(rng.choice(CHARACTERS) for _i in range(rng.randint(1, 3)))
+            for _j in range(vocabulary_size)))
+        # 按排名的倒数加权，近似齐普夫分布
+        self.weights = [1 / (rank + 1) for rank in range(len(self.vocabulary))]
+        self._xml_cache = {}
+
+    def bvid(self, index: int) -> str:
+        """Get the bvid of the video at the index of the search results"""
+        return f'BVsynth{index:06d}'
+
+    def video_index(self, bvid: str) -> int:
+        """Get the index of the video of the bvid in the search results"""
+        return int(bvid[len('BVsynth'):])
+
+    def search_page(self, page: int) -> dict:
+        """Get a page of the search results, in the format of search_by_type"""
+        start = (page - 1) * self.page_size
+        end = min(start + self.page_size, self.video_count)
+        return {
+            'numResults': self.video_count,
+            'result': [{'bvid': self.bvid(i)} for i in range(start, end)]
+        }
+
+    def danmakus(self, bvid: str) -> list:
+        """Generate the (text, p attribute) of the danmakus of a video"""
+        index = self.video_index(bvid)
+        rng = random.Random(self.seed * 1000003 + index)
+        words = rng.choices(self.vocabulary, self.weights, k=self.danmakus_per_video * 3)
+        duration = rng.randint(60, 3600)
+        danmakus = []
+        for i in range(self.danmakus_per_video):
+            if rng.random() < 0.2:
+                text = rng.choice(COMMON_DANMAKUS)
+            else:
+                text = ''.join(words[i * 3:i * 3 + rng.randint(1, 3)])
+            # p属性依次为：出现时间、模式、字号、颜色、发送时间戳、
+            # 弹幕池、用户哈希、弹幕ID、屏蔽等级
+            p_attr = (f'{rng.uniform(0, duration):.3f},{rng.choice((1, 1, 1, 4, 5))},25,'
+                      f'{rng.choice((16777215, 16777215, 16711680))},'
+                      f'{1690000000 + rng.randrange(30 * 24 * 3600)},0,{rng.getrandbits(32):08x},'
+                      f'{index * 10000000 + i + 1},10')
+            danmakus.append((text, p_attr))
+        return danmakus
+
+    def danmaku_xml(self, bvid: str) -> str:
+        """Get the danmaku XML of a video, in the format of get_danmaku_xml"""
+        danmaku_xml = self._xml_cache.get(bvid)
+        if danmaku_xml is None:
+            danmaku_xml = self._xml_cache[bvid] = (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<i><chatserver>chat.bilibili.com</chatserver>'
+                + ''.join(f'<d p="{p_attr}">{escape(text)}</d>'
+                          for text, p_attr in self.danmakus(bvid))
+                + '</i>')
+        return danmaku_xml
+
+    def danmaku_count(self) -> int:
+        """Count of the danmakus of all the videos"""
+        return self.video_count * self.danmakus_per_video
+
+
+class FixedCorpus:
+    """FixedCorpus class.
+
+    FixedCorpus objects serve the same danmaku XML for each of video_count videos,
+    with the interface of SyntheticCorpus. video_count and xml can be changed at any time.
+    """
+
+    def __init__(self, video_count: int, xml: str, page_size: int = 20,
+                 bvid_prefix: str = 'BVstub'):
+        """Create a FixedCorpus object"""
+        self.video_count = video_count
+        self.xml = xml
+        self.page_size = page_size
+        self.bvid_prefix = bvid_prefix
+
+    def bvid(self, index: int) -> str:
+        """Get the bvid of the video at the index of the search results"""
+        return f'{self.bvid_prefix}{index}'
+
+    def search_page(self, page: int) -> dict:
+        """Get a page of the search results, in the format of search_by_type"""
+        start = (page - 1) * self.page_size
+        end = min(start + self.page_size, self.video_count)
+        return {
+            'numResults': self.video_count,
+            'result': [{'bvid': self.bvid(i)} for i in range(start, end)]
+        }
+
+    def danmaku_xml(self, _bvid: str) -> str:
+        """Get the danmaku XML of a video, in the format of get_danmaku_xml"""
+        return self.xml
@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-"""Export DanmakuDB"""
+"""Export DanmakuDB, DanmakuCache, DanmakuFilter, Segmenter, register_model, load_stopwords,
+metrics and warm_up
+"""
 
-from .danmaku_db import DanmakuDB
+from .danmaku_db import DanmakuDB, warm_up
+from .danmaku_cache import DanmakuCache
+from .danmaku_query import DanmakuFilter
+from .segmenter import Segmenter, register_model
+from .stopwords import load_stopwords
+from .danmaku_metrics import MetricsRegistry, metrics
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides DanmakuCache class for caching fetched danmakus and search results on disk"""
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class DanmakuCache:
+    """DanmakuCache class.
+
+    DanmakuCache objects store parsed danmakus per bvid and search results
+    per (keyword, page) in a SQLite database as compressed blobs.
+    Entries expire after their TTL, and the least recently used entries are evicted
+    once the total size of the blobs exceeds max_bytes.
+    """
+
+    def __init__(self, filename: str, ttl: float = 24 * 3600, search_ttl: float = 3600,
+                 max_bytes: int = 512 * 1024 * 1024, purge_interval: float = 60):
+        """Create a DanmakuCache object backed by the specified SQLite file
+
+        Expired entries are removed from the file at most once every purge_interval seconds.
+        """
+        if filename == '':
+            raise ValueError('Empty filename')
+        if max_bytes <= 0:
+            raise ValueError('Invalid max bytes')
+        self.ttl = ttl
+        self.search_ttl = search_ttl
+        self.max_bytes = max_bytes
+        self.purge_interval = purge_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS danmakus ('
+                               'bvid TEXT PRIMARY KEY, fetched_at REAL, accessed_at REAL, '
+                               'size INTEGER, data BLOB)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS searches ('
+                               'keyword TEXT, page INTEGER, fetched_at REAL, accessed_at REAL, '
+                               'size INTEGER, data BLOB, PRIMARY KEY (keyword, page))')
+            for table in ('danmakus', 'searches'):
+                for column in ('fetched_at', 'accessed_at'):
+                    self._conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column} '
+                                       f'ON {table} ({column})')
+            self._bytes = self._total_bytes()
+        self._purged_at = 0.0
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        return zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def _decode(data: bytes):
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+
+    def _get(self, table: str, where: str, key: tuple, ttl: float):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(f'SELECT fetched_at, data FROM {table} WHERE {where}',
+                                     key).fetchone()
+            if row is None or now - row[0] > ttl:
+                self.misses += 1
+                return None
+            self._conn.execute(f'UPDATE {table} SET accessed_at = ? WHERE {where}', (now, *key))
+            self.hits += 1
+        return self._decode(row[1])
+
+    def _put(self, table: str, columns: str, where: str, key: tuple, value):
+        now = time.time()
+        data = self._encode(value)
+        with self._lock, self._conn:
+            row = self._conn.execute(f'SELECT size FROM {table} WHERE {where}', key).fetchone()
+            self._conn.execute(f'INSERT OR REPLACE INTO {table} ({columns}, fetched_at, '
+                               f'accessed_at, size, data) VALUES '
+                               f'({", ".join("?" * len(key))}, ?, ?, ?, ?)',
+                               (*key, now, now, len(data), data))
+            self._bytes += len(data) - (row[0] if row is not None else 0)
+            # 过期条目至多每purge_interval秒清理一次，超出容量时才按最近使用时间淘汰
+            if now - self._purged_at >= self.purge_interval:
+                self._purge(now)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _purge(self, now: float):
+        """Remove expired entries and recount the total size"""
+        self._conn.execute('DELETE FROM danmakus WHERE fetched_at < ?', (now - self.ttl,))
+        self._conn.execute('DELETE FROM searches WHERE fetched_at < ?', (now - self.search_ttl,))
+        # 重新统计，以计入共用缓存文件的其他进程的写入
+        self._bytes = self._total_bytes()
+        self._purged_at = now
+
+    def _evict(self):
+        """Remove the least recently used entries until under max_bytes"""
+        entries = self._conn.execute('SELECT accessed_at, size, 0, bvid, NULL FROM danmakus '
+                                     'UNION ALL SELECT accessed_at, size, 1, keyword, page '
+                                     'FROM searches ORDER BY accessed_at')
+        evicted = []
+        for _accessed_at, size, is_search, key, page in entries:
+            if self._bytes <= self.max_bytes:
+                break
+            evicted.append((is_search, key, page))
+            self._bytes -= size
+        entries.close()
+        self._conn.executemany('DELETE FROM searches WHERE keyword = ? AND page = ?',
+                               [(key, page) for is_search, key, page in evicted if is_search])
+        self._conn.executemany('DELETE FROM danmakus WHERE bvid = ?',
+                               [(key,) for is_search, key, _page in evicted if not is_search])
+
+    def _total_bytes(self) -> int:
+        return sum(self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM ' + table).fetchone()[0]
+                   for table in ('danmakus', 'searches'))
+
+    def get_danmakus(self, bvid: str):
+        """Get cached [danmaku list, attribute columns] of the bvid
+
+        Return None if the entry is missing or expired.
+        """
+        return self._get('danmakus', 'bvid = ?', (bvid,), self.ttl)
+
+    def put_danmakus(self, bvid: str, danmaku_list: list, attr_columns: list):
+        """Cache the danmaku list and attribute columns of the specified bvid"""
+        self._put('danmakus', 'bvid', 'bvid = ?', (bvid,), [danmaku_list, attr_columns])
+
+    def get_search(self, keyword: str, page: int):
+        """Get the cached search result page, or None if missing or expired"""
+        return self._get('searches', 'keyword = ? AND page = ?', (keyword, page), self.search_ttl)
+
+    def put_search(self, keyword: str, page: int, search_result: dict):
+        """Cache the search result page"""
+        self._put('searches', 'keyword, page', 'keyword = ? AND page = ?', (keyword, page),
+                  search_result)
+
+    def total_bytes(self) -> int:
+        """Total size of the cached blobs in bytes"""
+        with self._lock:
+            self._bytes = self._total_bytes()
+            return self._bytes
+
+    def clear(self):
+        """Remove all cached entries"""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM danmakus')
+            self._conn.execute('DELETE FROM searches')
+            self._bytes = 0
+
+    def close(self):
+        """Close the underlying database"""
+        with self._lock:
+            self._conn.close()
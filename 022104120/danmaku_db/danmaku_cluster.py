@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides normalization and MinHash/LSH clustering of near-duplicate danmakus"""
+
+import re
+import unicodedata
+import numpy as np
+
+# 连续重复的片段，如“哈哈哈”、“23333”、“awslawsl”
+REPEAT_RE = re.compile(r'(.+?)\1+')
+# 空白与标点
+SEPARATOR_RE = re.compile(r'[\W_]+')
+# 模2^31-1的线性哈希函数族，乘积不超过uint64
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a danmaku text for exact grouping of its variants
+
+    Full-width characters are folded to half-width, letters are lowercased,
+    whitespace and punctuation are removed and repeated runs are collapsed.
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    # 只由标点组成的弹幕（如“？？？”）保留标点
+    text = SEPARATOR_RE.sub('', text) or text.strip()
+    # 没有重复字符的文本不可能有重复片段
+    if len(set(text)) == len(text):
+        return text
+    return REPEAT_RE.sub(r'\1', text)
+
+
+def minhash_signatures(texts: list, num_hashes: int = 20, seed: int = 1) -> np.ndarray:
+    """Get the MinHash signatures of the character bigrams of the texts
+
+    Texts must have at least 2 characters. Return a (num_hashes, len(texts)) array,
+    the bigrams of all the texts being hashed in vectorized passes.
+    """
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    if (lengths < 2).any():
+        raise ValueError('Texts must have at least 2 characters')
+    # 以NUL分隔的所有码位，每个文本的第i个二元组为其第i与i+1个码位
+    code_points = np.frombuffer('\x00'.join(texts).encode('utf-32-le'), dtype=np.uint32)
+    starts = np.r_[0, np.cumsum(lengths + 1)[:-1]]
+    bigram_counts = lengths - 1
+    offsets = np.r_[0, np.cumsum(bigram_counts)[:-1]]
+    positions = (np.arange(bigram_counts.sum()) + np.repeat(starts - offsets, bigram_counts))
+    hashes = (code_points[positions].astype(np.uint64) << np.uint64(21)
+              | code_points[positions + 1]) % np.uint64(MERSENNE_PRIME)
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(1, MERSENNE_PRIME, num_hashes, dtype=np.uint64)
+    increments = rng.integers(0, MERSENNE_PRIME, num_hashes, dtype=np.uint64)
+    signatures = np.empty((num_hashes, len(texts)), dtype=np.uint64)
+    # 逐个哈希函数计算，避免一次生成num_hashes倍的中间数组
+    for i in range(num_hashes):
+        signatures[i] = np.minimum.reduceat(
+            (multipliers[i] * hashes + increments[i]) % np.uint64(MERSENNE_PRIME), offsets)
+    return signatures
+
+
+def lsh_clusters(signatures: np.ndarray, bands: int = 4) -> np.ndarray:
+    """Group the columns of the signatures sharing all the rows of at least one band
+
+    Return the cluster label of each column, the smallest column index of its cluster.
+    Grouping is transitive, and no pair of columns is ever compared.
+    """
+    num_hashes, count = signatures.shape
+    if bands <= 0 or num_hashes % bands != 0:
+        raise ValueError('Invalid band count')
+    rows = num_hashes // bands
+    rng = np.random.default_rng(0)
+    band_groups = []
+    for band in range(bands):
+        # 将分段的各行合成一个64位的桶键，溢出回绕
+        weights = rng.integers(1, 1 << 63, rows, dtype=np.uint64)[:, None] | np.uint64(1)
+        bucket_keys = (signatures[band * rows:(band + 1) * rows] * weights).sum(
+            axis=0, dtype=np.uint64)
+        _keys, inverse = np.unique(bucket_keys, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0])
+        band_groups.append((inverse, order, starts))
+
+    # 在各分段的桶中传播最小标签，直到不再变化
+    labels = np.arange(count)
+    while True:
+        previous = labels
+        for inverse, order, starts in band_groups:
+            bucket_min = np.minimum.reduceat(labels[order], starts)
+            labels = np.minimum(labels, bucket_min[inverse])
+            labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def cluster_text_counts(text_counts, num_hashes: int = 20, bands: int = 4,
+                        min_length: int = 4) -> list:
+    """Fold the variants of the (text, count) pairs together
+
+    Texts with the same normalized form, or whose normalized forms of at least min_length
+    characters are likely near-duplicates by MinHash/LSH, form a cluster.
+    Return (representative, count, variant count) of each cluster sorted by count
+    in descending order, where the representative is the most frequent text of the cluster
+    and count is the sum of the counts of its texts.
+    """
+    text_counts = list(text_counts)
+    key_indexes = {}
+    text_keys = [key_indexes.setdefault(normalize_text(text), len(key_indexes))
+                 for text, _count in text_counts]
+    keys = list(key_indexes)
+    labels = np.arange(len(keys))
+    # 过短的文本二元组太少，只按规范化形式分组
+    long_keys = np.flatnonzero(np.fromiter(map(len, keys), dtype=np.int64,
+                                           count=len(keys)) >= max(min_length, 2))
+    if len(long_keys) > 0:
+        signatures = minhash_signatures([keys[i] for i in long_keys], num_hashes)
+        labels[long_keys] = long_keys[lsh_clusters(signatures, bands)]
+    clusters = {}
+    for (text, count), key in zip(text_counts, text_keys):
+        label = labels[key]
+        cluster = clusters.get(label)
+        if cluster is None:
+            clusters[label] = [text, count, count, 1]
+        else:
+            cluster[2] += count
+            cluster[3] += 1
+            if count > cluster[1]:
+                cluster[0], cluster[1] = text, count
+    return sorted(((text, total, variants) for text, _count, total, variants
+                   in clusters.values()), key=lambda cluster: -cluster[1])
@@ -1,21 +1,89 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-"""Provides DanmakuDB class for fetching and managing danmakus"""
+"""Provides DanmakuDB class for fetching and managing danmakus
 
-import xml.etree.ElementTree as xmlReader
-import io
-import json
-import string
+bilibili_api, wordcloud, PIL, imageio, pandas and openpyxl take most of the import time
+and are only imported on first use, see warm_up.
+"""
+# pylint: disable=import-outside-toplevel
+
+import asyncio
+import math
+import time
+from functools import lru_cache
 from os import path
-from wordcloud import WordCloud
-import spacy_pkuseg as pkuseg
-from PIL import Image
-import pandas as pd
-from imageio.v2 import imread
-import bilibili_api as bapi
-from bilibili_api.search import SearchObjectType
-from bilibili_api.search import OrderVideo
+import numpy as np
+from .danmaku_cache import DanmakuCache
+from .danmaku_xml import DanmakuAttr, DanmakuAttrColumns, parse_danmaku_xml, parse_danmaku_object
+from .danmaku_store import DanmakuStore, DanmakuView
+from .danmaku_query import DanmakuFilter, DanmakuQueryIndex
+from .text_index import TextIndex
+from .segmenter import Segmenter, default_segmenter
+from .stopwords import load_stopwords
+from .snapshot import write_snapshot, read_snapshot
+from .density import DEFAULT_UTC_OFFSET, playback_histogram, send_time_histogram
+from .danmaku_cluster import cluster_text_counts
+from .danmaku_metrics import STAGE_SECONDS, API_REQUESTS, VIDEOS_FETCHED, \
+    XML_BYTES_DOWNLOADED, DANMAKUS_PARSED, CACHE_REQUESTS
+
+DEFAULT_FONT_PATH = path.join('danmaku_db', 'fzht.ttf')
+DEFAULT_MASK_PATH = path.join('danmaku_db', 'earth.png')
+# 分段的protobuf接口每段覆盖的视频时长
+SEGMENT_SECONDS = 360
+
+
+@lru_cache(maxsize=None)
+def _retryable_exceptions() -> tuple:
+    """Get the retryable network exceptions, other ones (e.g. missing videos) are raised"""
+    import httpx
+    from bilibili_api.exceptions import NetworkException
+    return asyncio.TimeoutError, NetworkException, httpx.TransportError
+
+
+def warm_up(segmenter: Segmenter = None, font_path: str = DEFAULT_FONT_PATH):
+    """Import the lazily imported modules, load the segmentation model and the font
+
+    Blocks for a few seconds, so run it in a thread after the server starts.
+    """
+    import bilibili_api
+    import openpyxl
+    import pandas
+    from PIL import ImageFont
+    from imageio.v2 import imread
+    import wordcloud
+    del bilibili_api, openpyxl, pandas, imread, wordcloud
+    _retryable_exceptions()
+    (segmenter if segmenter is not None else default_segmenter).warm_up()
+    ImageFont.truetype(font_path, 12)
+
+
+async def _with_retry(coro_factory, timeout: float, retries: int, backoff: float):
+    """Await the coroutine created by coro_factory with timeout and exponential backoff retry"""
+    for attempt in range(retries + 1):
+        try:
+            with STAGE_SECONDS.time(stage='network'):
+                result = await asyncio.wait_for(coro_factory(), timeout)
+            API_REQUESTS.inc(result='success')
+            return result
+        except _retryable_exceptions():
+            if attempt == retries:
+                API_REQUESTS.inc(result='error')
+                raise
+            API_REQUESTS.inc(result='retry')
+            await asyncio.sleep(backoff * (2 ** attempt))
+    return None
+
+
+def _parse_xml(danmaku_xml: str, part: int = 0) -> list:
+    """Parse the (text, attributes) of the danmakus of a downloaded XML, counting them"""
+    XML_BYTES_DOWNLOADED.inc(len(danmaku_xml.encode('utf-8')))
+    with STAGE_SECONDS.time(stage='parse'):
+        danmakus = list(parse_danmaku_xml(danmaku_xml))
+        if part != 0:
+            danmakus = [(text, attr._replace(part=part)) for text, attr in danmakus]
+    DANMAKUS_PARSED.inc(len(danmakus))
+    return danmakus
 
 
 class DanmakuDB:
@@ -25,184 +93,536 @@ class DanmakuDB:
     and exporting them to an Excel sheet.
     """
 
-    def __init__(self):
-        """Create a DanmakuDB object"""
-        self.danmaku_dict = {}
+    def __init__(self, concurrency: int = 8, timeout: float = 20.0,
+                 retries: int = 3, backoff: float = 0.5, cache: DanmakuCache = None,
+                 segmenter: Segmenter = None, stopwords: frozenset = None,
+                 parts: tuple = (0,), segmented_duration: float = 1800.0):
+        """Create a DanmakuDB object
+
+        concurrency limits the number of simultaneous requests when fetching,
+        timeout is applied to each request, which is retried up to retries times
+        with an exponential backoff starting from backoff seconds.
+        Fetched danmakus and search results are served from cache if one is given.
+        Word clouds are segmented with segmenter, or the shared default one,
+        and exclude stopwords, or the default stopword list.
+        parts are the indexes of the parts fetched from each video, None for all the parts.
+        Unless only the first part is fetched, parts longer than segmented_duration seconds
+        are fetched from the segmented protobuf endpoint instead of the XML one.
+        """
+        if concurrency <= 0:
+            raise ValueError('Invalid concurrency')
+        self.store = DanmakuStore()
+        self.query_index = DanmakuQueryIndex(self.store)
+        self.text_index = TextIndex(self.store)
+        # 范围（None表示整个数据库） -> (数据库版本, 近似弹幕聚类)
+        self._clusters = {}
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.segmenter = segmenter if segmenter is not None else default_segmenter
+        self.stopwords = stopwords if stopwords is not None else load_stopwords()
+        self.parts = tuple(parts) if parts is not None else None
+        self.segmented_duration = segmented_duration
+        # 各视频弹幕最近一次从网络获取的时间
+        self.fetched_at = {}
+
+    def __getstate__(self) -> dict:
+        """Get the state for pickling, e.g. to run jobs in another process
+
+        The cache is not pickled and the default segmenter is replaced with
+        the default one of the other process.
+        """
+        state = self.__dict__.copy()
+        state['cache'] = None
+        if self.segmenter is default_segmenter:
+            state['segmenter'] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        """Restore the state from pickling"""
+        self.__dict__.update(state)
+        if self.segmenter is None:
+            self.segmenter = default_segmenter
+
+    async def _request(self, coro_factory, semaphore: asyncio.Semaphore = None,
+                       timeout: float = None):
+        """Send an API request with the configured timeout and retry policy
+
+        The request waits for semaphore if one is given. timeout overrides
+        the configured one if given.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if semaphore is None:
+            return await _with_retry(coro_factory, timeout, self.retries, self.backoff)
+        async with semaphore:
+            return await _with_retry(coro_factory, timeout, self.retries, self.backoff)
 
     def __len__(self) -> int:
         """Size of danmaku bvids"""
-        return len(self.danmaku_dict)
+        return len(self.store.videos)
 
-    def __getitem__(self, bvid) -> list:
-        """Get the danmaku list of the video of the specified bvid"""
-        return self.danmaku_dict[bvid]
+    def __contains__(self, bvid) -> bool:
+        """Check whether the video of the specified bvid is in the database"""
+        return bvid in self.store.videos
+
+    def __getitem__(self, bvid) -> DanmakuView:
+        """Get the danmaku list view of the video of the specified bvid"""
+        return DanmakuView(self.store, bvid)
 
     def __setitem__(self, bvid: str, danmaku_list: list):
         """Set the danmaku list of the video of the specified bvid"""
-        self.danmaku_dict[bvid] = danmaku_list
+        self.store.set_video(bvid, danmaku_list)
+
+    @property
+    def version(self) -> int:
+        """Version of the database content, changed on every modification
+
+        Versions are unique across all the databases.
+        """
+        return self.store.version
+
+    def nbytes(self) -> int:
+        """Estimate the memory used by the danmakus in bytes"""
+        return self.store.nbytes()
+
+    def attrs(self, bvid: str) -> DanmakuAttrColumns:
+        """Get the danmaku attributes of the video of the specified bvid"""
+        return self.store.videos[bvid].attrs
+
+    async def _run_cache(self, func, *args):
+        """Run a blocking call of the cache in the default executor, off the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _cache_key(self, bvid: str) -> str:
+        """Get the cache key of the danmakus of a video, depending on the fetched parts"""
+        if self.parts == (0,):
+            return bvid
+        return f'{bvid}:{"all" if self.parts is None else ",".join(map(str, self.parts))}'
+
+    async def _fetch_part(self, video, part: int, cid: int, duration: float,
+                          semaphore: asyncio.Semaphore) -> list:
+        """Fetch the (text, attributes) of the danmakus of a part of a video"""
+        if duration > self.segmented_duration:
+            # 长视频使用分段的protobuf接口，避免一次性下载巨大的XML
+            # 一次调用依次下载所有分段，超时按分段数放大
+            segments = max(1, math.ceil(duration / SEGMENT_SECONDS))
+            danmakus = await self._request(lambda: video.get_danmakus(cid=cid), semaphore,
+                                           self.timeout * segments)
+            with STAGE_SECONDS.time(stage='parse'):
+                danmakus = [parse_danmaku_object(danmaku, part) for danmaku in danmakus]
+            DANMAKUS_PARSED.inc(len(danmakus))
+            return danmakus
+        danmaku_xml = await self._request(lambda: video.get_danmaku_xml(cid=cid), semaphore)
+        return _parse_xml(danmaku_xml, part)
+
+    async def _fetch_parts(self, bvid: str, semaphore: asyncio.Semaphore) -> list:
+        """Fetch the (text, attributes) of the danmakus of the configured parts of a video"""
+        import bilibili_api as bapi
+        video = bapi.video.Video(bvid)
+        if self.parts == (0,):
+            danmaku_xml = await self._request(lambda: video.get_danmaku_xml(page_index=0),
+                                              semaphore)
+            return _parse_xml(danmaku_xml)
+        pages = await self._request(video.get_pages, semaphore)
+        indexes = range(len(pages)) if self.parts is None else \
+            [part for part in self.parts if 0 <= part < len(pages)]
+        # 各分P并行获取，共用同一并发限制
+        part_danmakus = await asyncio.gather(*(
+            self._fetch_part(video, part, pages[part]['cid'], pages[part].get('duration', 0),
+                             semaphore)
+            for part in indexes))
+        return [danmaku for danmakus in part_danmakus for danmaku in danmakus]
+
+    async def fetch_from_video(self, bvid: str, merge: bool = False,
+                               semaphore: asyncio.Semaphore = None) -> int:
+        """Fetch danmakus from the configured parts of specific video and add them to the database
 
-    async def fetch_from_video(self, bvid: str):
-        """Fetch danmakus from specific video and add them to the database"""
+        If merge is true, the cache is bypassed and only the danmakus the video
+        does not have yet are added. Requests wait for semaphore if one is given,
+        otherwise at most self.concurrency requests are sent at once.
+        Return the count of added danmakus.
+        """
         if bvid == '':
             raise ValueError('Empty bvid')
-        video = bapi.video.Video(bvid)
-        danmaku_xml = await video.get_danmaku_xml(page_index=0)
-        xml_tree = xmlReader.parse(io.StringIO(danmaku_xml))
-        xml_root = xml_tree.getroot()
-        danmaku_list = [d.text for d in xml_root.findall('./d')]
-        for i, _d in enumerate(danmaku_list):
-            # 特殊处理高级弹幕，其内容为一个数组，弹幕实际内容在4号元素
-            try:
-                advanced_danmaku = json.loads(danmaku_list[i])
-                if isinstance(advanced_danmaku, list):
-                    danmaku_list[i] = advanced_danmaku[4]
-            except json.decoder.JSONDecodeError:
-                pass
-        self.danmaku_dict[bvid] = danmaku_list
-
-    async def fetch_from_search_result(self, keyword: str, max_n: int):
-        """Fetch danmakus from videos in the search result and add them to the database"""
+        cache_key = self._cache_key(bvid)
+        if self.cache is not None and not merge:
+            cached = await self._run_cache(self.cache.get_danmakus, cache_key)
+            CACHE_REQUESTS.inc(kind='danmakus', result='miss' if cached is None else 'hit')
+            if cached is not None:
+                return len(self.store.set_video(bvid, cached[0], DanmakuAttrColumns(cached[1])))
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+        danmaku_list = []
+        attrs = DanmakuAttrColumns()
+        for danmaku, attr in await self._fetch_parts(bvid, semaphore):
+            danmaku_list.append(danmaku)
+            attrs.append(attr)
+        self.fetched_at[bvid] = time.time()
+        VIDEOS_FETCHED.inc()
+        if merge:
+            added = self.store.merge_video(bvid, danmaku_list, attrs)
+            with self.store.lock:
+                danmaku_list = list(self[bvid])
+                attrs = self.attrs(bvid)
+        else:
+            added = len(self.store.set_video(bvid, danmaku_list, attrs))
+        if self.cache is not None:
+            await self._run_cache(self.cache.put_danmakus, cache_key, danmaku_list,
+                                  attrs.to_lists())
+        return added
+
+    async def _search(self, keyword: str, page: int) -> dict:
+        """Get a page of video search result"""
+        if self.cache is not None:
+            search_result = await self._run_cache(self.cache.get_search, keyword, page)
+            CACHE_REQUESTS.inc(kind='search', result='miss' if search_result is None else 'hit')
+            if search_result is not None:
+                return search_result
+        import bilibili_api as bapi
+        from bilibili_api.search import SearchObjectType, OrderVideo
+        search_result = await self._request(lambda: bapi.search.search_by_type(
+            keyword, SearchObjectType.VIDEO, OrderVideo.TOTALRANK, page=page))
+        if self.cache is not None:
+            # 只缓存用到的字段
+            await self._run_cache(self.cache.put_search, keyword, page, {
+                'numResults': search_result['numResults'],
+                'result': [{'bvid': v['bvid']} for v in search_result.get('result') or []]
+            })
+        return search_result
+
+    async def fetch_from_search_result(self, keyword: str, max_n: int, progress=None,
+                                       semaphore: asyncio.Semaphore = None):
+        """Fetch danmakus from videos in the search result and add them to the database
+
+        Videos are fetched concurrently with at most self.concurrency requests in flight,
+        or waiting for semaphore if one is given, e.g. to share the limit between databases.
+        The next search page is prefetched while the current page is being downloaded.
+        progress(videos_done, videos_scheduled, danmakus_fetched) is called after each video.
+        """
+        # 跳过数据库中已有数量的搜索结果
+        await self._fetch_search_pages(keyword, max_n, set(self.bvids()),
+                                       lambda bvid, semaphore: self.fetch_from_video(
+                                           bvid, semaphore=semaphore), progress, semaphore)
+
+    async def refresh_from_search_result(self, keyword: str, max_n: int,
+                                         max_age: float = 300.0, progress=None):
+        """Fetch the danmakus of the videos in the search result that are new or stale
+
+        Videos not in the database are fetched, and videos not fetched from the network
+        within max_age seconds have their new danmakus merged by row id. Other videos
+        are skipped. progress is called as in fetch_from_search_result, counting the
+        added danmakus.
+        """
+        now = time.time()
+
+        async def refresh_video(bvid: str, semaphore: asyncio.Semaphore) -> int:
+            if bvid not in self:
+                return await self.fetch_from_video(bvid, semaphore=semaphore)
+            if now - self.fetched_at.get(bvid, 0) > max_age:
+                return await self.fetch_from_video(bvid, True, semaphore)
+            return 0
+
+        await self._fetch_search_pages(keyword, max_n, set(), refresh_video, progress)
+
+    async def _fetch_search_pages(self, keyword: str, max_n: int, known_bvids: set,
+                                  fetch_video, progress, semaphore: asyncio.Semaphore = None):
+        """Fetch search results until max_n distinct videos including known_bvids are fetched
+
+        Videos of known_bvids and videos appearing again on a later page are skipped.
+        fetch_video(bvid, semaphore) is called on each video concurrently, all the requests
+        sharing the semaphore, a new one limited to self.concurrency unless one is given.
+        """
         if keyword == '':
             raise ValueError('Empty keyword')
         if max_n <= 0:
             raise ValueError('Invalid n number')
-        num_results = None
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+        videos_done = 0
+        danmakus_fetched = 0
+
+        async def fetch_limited(bvid: str):
+            nonlocal videos_done, danmakus_fetched
+            added = await fetch_video(bvid, semaphore)
+            videos_done += 1
+            danmakus_fetched += added
+            if progress is not None:
+                progress(videos_done, len(scheduled), danmakus_fetched)
+
+        # 已知或已安排获取的视频，同一视频可能出现在多个搜索结果页中
+        seen = set(known_bvids)
+        scheduled = []
+        fetch_tasks = []
         page = 1
-        while (len(self.danmaku_dict) < max_n and
-               (num_results is None or len(self.danmaku_dict) < num_results)):
-            search_result = await bapi.search.search_by_type(keyword,
-                                                             SearchObjectType.VIDEO,
-                                                             OrderVideo.TOTALRANK,
-                                                             page=page)
-            num_results = search_result['numResults']
-            # 计算该页应当获取的视频数
-            fetch_count = (min(max_n, num_results, len(self.danmaku_dict) +
-                               len(search_result['result'])) - len(self.danmaku_dict))
-            for i in range(fetch_count):
-                await self.fetch_from_video(search_result['result'][i]['bvid'])
-            page += 1
+        search_task = None
+        if len(seen) < max_n:
+            search_task = asyncio.ensure_future(self._search(keyword, page))
+        try:
+            while search_task is not None:
+                search_result = await search_task
+                search_task = None
+                videos = search_result.get('result') or []
+                limit = min(max_n, search_result['numResults'])
+                # 计算该页应当获取的视频
+                page_bvids = []
+                for video in videos:
+                    if len(seen) >= limit:
+                        break
+                    if video['bvid'] not in seen:
+                        seen.add(video['bvid'])
+                        page_bvids.append(video['bvid'])
+                scheduled += page_bvids
+                # 在下载本页弹幕的同时预取下一页搜索结果
+                if videos and len(seen) < limit:
+                    page += 1
+                    search_task = asyncio.ensure_future(self._search(keyword, page))
+                fetch_tasks += [asyncio.ensure_future(fetch_limited(bvid))
+                                for bvid in page_bvids]
+            await asyncio.gather(*fetch_tasks)
+        finally:
+            # 出错时取消仍在进行的请求
+            for task in fetch_tasks + ([search_task] if search_task is not None else []):
+                task.cancel()
 
     def to_list(self) -> list:
         """Combine all the danmakus of the videos and create a list"""
-        danmakus_list = []
-        for danmaku in self.danmaku_dict.values():
-            danmakus_list += danmaku
-        return danmakus_list
+        with self.store.lock:
+            strings = self.store.strings
+            return [strings[code] for columns in self.store.videos.values()
+                    for code in columns.codes]
+
+    def top_danmakus(self, max_n: int, bvid: str = None, cluster: bool = False) -> dict:
+        """Get top n danmakus of the database, or of the video of the specified bvid
+
+        If cluster is true, the variants of a danmaku are counted together
+        under the most frequent one, see top_danmaku_clusters.
+        """
+        if cluster:
+            return {text: count for text, count, _variants
+                    in self.top_danmaku_clusters(max_n, bvid)}
+        if max_n <= 0:
+            raise ValueError('Invalid n number')
+        with self.store.lock:
+            strings = self.store.strings
+            top = self.store.frequency.top(max_n, bvid)
+        return {strings[code]: count for code, count in top}
+
+    def top_danmaku_clusters(self, max_n: int, bvid: str = None) -> list:
+        """Get (representative, count, variant count) of the top n clusters of near-duplicates
 
-    def top_danmakus(self, max_n: int) -> dict:
-        """Get top n danmakus"""
+        Variants differing in repeated characters, character width, case or punctuation,
+        or likely near-duplicates by MinHash/LSH, are folded together. Clusters are computed
+        once per version of the database and scope.
+        """
         if max_n <= 0:
             raise ValueError('Invalid n number')
-        danmaku_frequency = pd.Series(self.to_list(), dtype=str).value_counts()
-        n = min(max_n, len(danmaku_frequency))
-        return danmaku_frequency.iloc[0:n].to_dict()
+        with self.store.lock:
+            strings = self.store.strings
+            version = self.store.version
+            cached = self._clusters.get(bvid)
+            if cached is not None and cached[0] == version:
+                return cached[1][:max_n]
+            text_counts = [(strings[code], count)
+                           for code, count in self.store.frequency.ranking(bvid)]
+        clusters = cluster_text_counts(text_counts)
+        self._clusters[bvid] = (version, clusters)
+        return clusters[:max_n]
+
+    def query(self, bvid: str, danmaku_filter: DanmakuFilter = DanmakuFilter(),
+              sort: str = 'index', descending: bool = False,
+              cursor: int = 0, limit: int = 100) -> tuple:
+        """Query the danmakus of the video of the specified bvid
+
+        Get (danmakus, total count, next cursor) of the danmakus meeting the filter sorted by
+        sort ('index', 'progress' or 'ctime'), where danmakus are the (index, text, attributes)
+        of at most limit danmakus from the cursor position, and the next cursor is None
+        after the last page.
+        """
+        if cursor < 0:
+            raise ValueError('Invalid cursor')
+        if limit <= 0:
+            raise ValueError('Invalid limit')
+        # 过滤在存储锁外进行，缓慢的正则表达式不会阻塞写入
+        strings, columns, rows = self.query_index.query(bvid, danmaku_filter, sort, descending)
+        danmakus = [(row, strings[columns.codes[row]], columns.attrs[row])
+                    for row in rows[cursor:cursor + limit]]
+        next_cursor = cursor + limit if cursor + limit < len(rows) else None
+        return danmakus, len(rows), next_cursor
 
     def to_excel(self, filename: str):
-        """Write danmakus and related info to Excel sheets"""
-        if len(self.danmaku_dict) == 0:
+        """Write danmakus and related info to Excel sheets
+
+        Both sheets are streamed row by row into a write-only workbook
+        straight from the columns, so memory use does not grow with the database.
+        """
+        if len(self) == 0:
             raise ValueError('Empty database')
         if filename == '':
             raise ValueError('Empty filename')
-        danmaku_dataframe = pd.DataFrame()
-        for bvid, danmakus in self.danmaku_dict.items():
-            # 根据需要增加行数
-            danmaku_dataframe = danmaku_dataframe.reindex(
-                range(max(len(danmaku_dataframe), len(danmakus))))
-            if danmaku_dataframe.empty:
-                danmaku_dataframe[bvid] = danmakus
-            else:
-                video_danmaku_dataframe = pd.DataFrame({bvid: danmakus})
-                danmaku_dataframe = pd.concat([danmaku_dataframe, video_danmaku_dataframe], axis=1)
-        danmaku_dataframe.to_excel(filename, sheet_name='danmakus', index=False)
-        del danmaku_dataframe
-        with pd.ExcelWriter(filename, mode='a', engine='openpyxl') as writer:
-            danmaku_frequency = pd.Series(self.to_list()).value_counts()
-            danmaku_frequency.name = 'Counts'
-            danmaku_frequency.to_excel(writer, sheet_name='danmakus_frequency')
-
-    def to_wordcloud(self, font_path: str = path.join('danmaku_db', 'fzht.ttf'),
-                     mask_path: str = path.join('danmaku_db', 'earth.png')) -> Image:
-        """Generate word cloud image based on danmakus"""
-        if len(self.danmaku_dict) == 0:
+        with self.store.lock:
+            # 列对象只会被整体替换或追加，字符串表在清空时也会被替换，
+            # 记录引用与长度即可得到一致的快照
+            strings = self.store.strings
+            videos = [(bvid, columns.codes, len(columns.codes))
+                      for bvid, columns in self.store.videos.items()]
+            ranking = self.store.frequency.ranking()
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+        def excel_cell(sheet, text: str):
+            """Create a write-only cell of a danmaku text"""
+            cell = WriteOnlyCell(sheet, ILLEGAL_CHARACTERS_RE.sub('', text))
+            # 以“=”开头的弹幕不应被当作公式
+            cell.data_type = 's'
+            return cell
+
+        with STAGE_SECONDS.time(stage='excel_write'):
+            workbook = Workbook(write_only=True)
+            danmaku_sheet = workbook.create_sheet('danmakus')
+            danmaku_sheet.append([bvid for bvid, _codes, _length in videos])
+            for i in range(max(length for _bvid, _codes, length in videos)):
+                danmaku_sheet.append([excel_cell(danmaku_sheet, strings[codes[i]])
+                                      if i < length else None
+                                      for _bvid, codes, length in videos])
+            frequency_sheet = workbook.create_sheet('danmakus_frequency')
+            frequency_sheet.append([None, 'Counts'])
+            for code, count in ranking:
+                frequency_sheet.append([excel_cell(frequency_sheet, strings[code]), count])
+            workbook.save(filename)
+
+    def attr_array(self, field: str, bvid: str = None) -> np.ndarray:
+        """Copy an attribute column of the video of the specified bvid, or of all the videos"""
+        with self.store.lock:
+            videos = (list(self.store.videos.values()) if bvid is None
+                      else [self.store.videos[bvid]])
+            # 复制数据，避免numpy视图阻止数组追加
+            return np.concatenate([np.frombuffer(getattr(columns.attrs.columns, field),
+                                                 dtype=getattr(DanmakuAttrColumns.typecodes, field))
+                                   for columns in videos] or
+                                  [np.zeros(0, dtype=getattr(DanmakuAttrColumns.typecodes, field))])
+
+    def playback_density(self, bucket_seconds: float = 10.0, bvid: str = None) -> list:
+        """Count the danmakus in each bucket of playback progress
+
+        Counts are of the video of the specified bvid, or of all the videos.
+        Raise ValueError if the bucket size is invalid or needs too many buckets.
+        """
+        return playback_histogram(self.attr_array('progress', bvid), bucket_seconds).tolist()
+
+    def send_time_activity(self, unit: str = 'hour', bvid: str = None, cyclic: bool = False,
+                           utc_offset: int = DEFAULT_UTC_OFFSET) -> tuple:
+        """Count the danmakus sent in each hour or day
+
+        Counts are of the video of the specified bvid, or of all the videos.
+        Get (start timestamp of the first bucket, counts) of consecutive buckets, or if cyclic
+        is true (None, counts) of the hours of the day or the days of the week from Monday.
+        """
+        start, counts = send_time_histogram(self.attr_array('ctime', bvid), unit, cyclic,
+                                            utc_offset)
+        return start, counts.tolist()
+
+    def text_counts(self) -> list:
+        """Get a snapshot of the (danmaku, count) pairs of all the distinct danmakus"""
+        with self.store.lock:
+            strings = self.store.strings
+            return [(strings[code], count) for code, count in self.store.frequency.counts.items()]
+
+    def to_wordcloud(self, font_path: str = DEFAULT_FONT_PATH,
+                     mask_path: str = DEFAULT_MASK_PATH,
+                     mask=None, scale: float = 1) -> 'Image.Image':
+        """Generate word cloud image based on danmakus
+
+        A preloaded mask image array can be given in place of mask_path.
+        Raise ValueError if the database is empty or all its words are stopwords.
+        """
+        if len(self) == 0:
             raise ValueError('Empty database')
-        excluded_words = ['将', '\n', '地', '小说', '侧', '又', '一雄', '如何', '什么', '可以', '吗', '只是', '他',
-                          '本', '们',
-                          ' ',
-                          '…', '把', '人', '很', '那么', '着', '太', '能', '给', '不是', '里', '被', '就是', '一个',
-                          '没有',
-                          '剧',
-                          '让', '/', '而', '与', '一部', '的', '我', '你', '她', '我们', '你们', '他们', '是', '在',
-                          '了', '有',
-                          '这', '那', '就', '也', '还', '但', '如果', '然后', '因为', '所以', '一', '二', '三', '四',
-                          '五',
-                          '六',
-                          '七', '八', '九', '十', '百', '千', '万', '个', '这些', '那些', '更', '最', '好', '坏',
-                          '大', '小',
-                          '高',
-                          '低', '长', '短', '新', '旧', '常', '少', '多', '全', '每', '些', '去', '来', '到', '从',
-                          '为', '以',
-                          '对',
-                          '和', '或', '及', '上', '下', '中', '前', '后', '左', '右', '内', '外', '间', '部', '种',
-                          '年', '月',
-                          '日',
-                          '时', '分', '秒', '这里', '这个', '那个', '这样', '那样', '一些', '很多', '非常', '可能', '一定',
-                          '一直',
-                          '经常',
-                          '不断', '不只', '不要', '不得', '不能', '无法', '没法', '必须', '应该', '需要', '会', '想',
-                          '要',
-                          '找',
-                          '看', '听', '说', '写', '读', '学', '做', '吃', '喝', '睡', '玩', '工作', '生活', '家庭',
-                          '朋友',
-                          '嫌',
-                          '之',
-                          '感觉', '思考', '想法', '方法', '原因', '结果', '可能性', '比较', '不同', '相同', '重要',
-                          '容易',
-                          '困难',
-                          '简单', '复杂', '正确', '错误',
-                          '，', '。', '！', '？', '；', '：', '“', '”', '‘', '’', '（', '）', '【', '】',
-                          '《', '》', '——', '—', '·', '、', '～', '@', '?', '=', '~',
-                          '啊', '吧', '呢', '都', '过', '没', '得',
-                          '追', '比', '呀', '跟', '啦', '哇', '不', '……', '…', '这不', '连', '懂', '真', '怎么',
-                          '已经', '这么', '么', '超', '好像', '想到', '再', '变', '的话', '啊啊', '还是', '才',
-                          '为什么', '还有',
-                          '别', '次', '事', '用', '条', '开', '两', '打', '哦', '只', '头', '哪', '男', '女', '段',
-                          '啥', '自',
-                          '谁', '撅', '快', '最后', '等', '开', '它', '噗', '嗷', '噢', '哼', '唉', '啦', '嘞']
-        excluded_words += list(string.punctuation + string.digits + string.ascii_letters)
-        seg = pkuseg.pkuseg(model_name='web')
-        word_frequency = (pd.Series([[word for word in seg.cut(d) if word not in excluded_words]
-                                     for d in self.to_list()])
-                          .explode(ignore_index=True).value_counts())
-        mask = imread(mask_path)
-        wordcloud = WordCloud(font_path=font_path, background_color='white', mask=mask)\
-            .generate_from_frequencies(word_frequency.to_dict())
+        # 每种弹幕只分词一次，词频按弹幕出现次数加权
+        with STAGE_SECONDS.time(stage='segment'):
+            word_frequency = self.segmenter.count_tokens(self.text_counts(), self.stopwords)
+        if not word_frequency:
+            raise ValueError('No words')
+        if mask is None:
+            from imageio.v2 import imread
+            mask = imread(mask_path)
+        from wordcloud import WordCloud
+        with STAGE_SECONDS.time(stage='layout'):
+            wordcloud = WordCloud(font_path=font_path, background_color='white', mask=mask,
+                                  scale=scale).generate_from_frequencies(word_frequency)
 
         return wordcloud.to_image()
 
+    def search(self, words, match_all: bool = True) -> dict:
+        """Get {bvid: danmaku indexes} of the danmakus containing all (or any) of the words
+
+        Words are matched against the segmentation used by to_wordcloud.
+        """
+        self.text_index.update(self.segmenter)
+        return self.text_index.search(words, match_all)
+
+    def cooccurring_words(self, word: str, max_n: int) -> dict:
+        """Get the top n words appearing in the same danmakus as word, excluding stopwords
+
+        Each word is counted once per danmaku containing both words.
+        """
+        if max_n <= 0:
+            raise ValueError('Invalid n number')
+        self.text_index.update(self.segmenter)
+        return dict(self.text_index.cooccurring(word, max_n, self.stopwords))
+
     def read_excel(self, filename: str):
         """Load danmakus from Excel sheets"""
-        danmaku_dataframe = pd.read_excel(filename, sheet_name='danmakus')
-        self.danmaku_dict = danmaku_dataframe.to_dict('list')
+        import pandas as pd
+        with STAGE_SECONDS.time(stage='excel_read'):
+            danmaku_dataframe = pd.read_excel(filename, sheet_name='danmakus')
+        self.clear()
         # 滤去NAN
-        for bvid in self.danmaku_dict.keys():
-            self.danmaku_dict[bvid] = [danmaku for danmaku in self.danmaku_dict[bvid]
-                                       if isinstance(danmaku, str)]
+        for bvid, danmakus in danmaku_dataframe.to_dict('list').items():
+            self[bvid] = [danmaku for danmaku in danmakus if isinstance(danmaku, str)]
 
-    def append(self, bvid: str, danmaku: str):
+    def save(self, filename: str):
+        """Save the database to a binary snapshot file"""
+        if filename == '':
+            raise ValueError('Empty filename')
+        with STAGE_SECONDS.time(stage='snapshot_write'):
+            write_snapshot(self.store, filename)
+
+    def load(self, filename: str, bvids=None):
+        """Load the database from a binary snapshot file, only the specified bvids if given"""
+        with STAGE_SECONDS.time(stage='snapshot_read'):
+            self.store.load(*read_snapshot(filename, bvids))
+        self.fetched_at.clear()
+        self.query_index.clear()
+        self.text_index.clear()
+
+    @staticmethod
+    def excel_to_snapshot(excel_filename: str, snapshot_filename: str):
+        """Convert an Excel file written by to_excel to a binary snapshot file"""
+        danmaku_db = DanmakuDB()
+        danmaku_db.read_excel(excel_filename)
+        danmaku_db.save(snapshot_filename)
+
+    def append(self, bvid: str, danmaku: str, attr: DanmakuAttr = DanmakuAttr()):
         """Append a danmaku to the database manually"""
-        if bvid in self.danmaku_dict.keys():
-            self.danmaku_dict[bvid].append(danmaku)
-        else:
-            self.danmaku_dict[bvid] = [danmaku]
+        self.store.append(bvid, danmaku, attr)
 
     def bvids(self) -> list:
         """Get the bvid list of the database"""
-        return list(self.danmaku_dict.keys())
+        with self.store.lock:
+            return list(self.store.videos.keys())
 
     def items(self):
         """Get K-V view of the database"""
-        return self.danmaku_dict.items()
+        with self.store.lock:
+            return [(bvid, DanmakuView(self.store, bvid)) for bvid in self.store.videos]
 
     def clear(self):
         """Clear the danmaku database"""
-        self.danmaku_dict.clear()
+        self.store.clear()
+        self.fetched_at.clear()
+        self.query_index.clear()
+        self.text_index.clear()
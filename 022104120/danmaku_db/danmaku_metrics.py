@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides counters, gauges and histograms rendered in the Prometheus text format"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# 默认的耗时分桶（秒），覆盖从单次解析到整次获取
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    """Metric class.
+
+    Metric objects are the base of counters, gauges and histograms, holding one value
+    per combination of label values. Updates are thread-safe.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        """Create a Metric object"""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'Invalid labels of metric "{self.name}"')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list:
+        """Get the (suffix, labels, value) of the samples of the metric"""
+        with self._lock:
+            return [('', dict(zip(self.labelnames, key)), value)
+                    for key, value in self._values.items()]
+
+    def clear(self):
+        """Reset all the values"""
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    """Counter class.
+
+    Counter objects count events, only ever increasing.
+    """
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase the counter of the labels by amount"""
+        if amount < 0:
+            raise ValueError('Counters can only increase')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """Get the counter of the labels"""
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """Gauge class.
+
+    Gauge objects hold values that go up and down. An unlabelled gauge can get its value
+    from a function called at rendering instead.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        """Create a Gauge object"""
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        """Set the gauge of the labels"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase the gauge of the labels by amount"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        """Decrease the gauge of the labels by amount"""
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Get the value of the unlabelled gauge by calling function at rendering"""
+        if self.labelnames:
+            raise ValueError(f'Gauge "{self.name}" has labels')
+        self._function = function
+
+    def value(self, **labels) -> float:
+        """Get the gauge of the labels"""
+        if self._function is not None:
+            return self._function()
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list:
+        """Get the (suffix, labels, value) of the samples of the metric"""
+        if self._function is not None:
+            return [('', {}, self._function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    """Histogram class.
+
+    Histogram objects count observed values, e.g. durations in seconds,
+    in cumulative buckets of the specified upper bounds.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        """Create a Histogram object"""
+        super().__init__(name, documentation, labelnames)
+        if list(buckets) != sorted(buckets) or len(buckets) == 0:
+            raise ValueError('Invalid buckets')
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        """Count a value in the histogram of the labels"""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 各分桶（最后一个为+Inf）的计数与总和
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block in seconds"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def count(self, **labels) -> int:
+        """Get the count of the values observed in the histogram of the labels"""
+        state = self._values.get(self._key(labels))
+        return sum(state[0]) if state is not None else 0
+
+    def samples(self) -> list:
+        """Get the (suffix, labels, value) of the samples of the metric"""
+        samples = []
+        with self._lock:
+            states = [(dict(zip(self.labelnames, key)), list(counts), total)
+                      for key, (counts, total) in self._values.items()]
+        for labels, counts, total in states:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(('_bucket', {**labels, 'le': _format_value(bound)}, cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """MetricsRegistry class.
+
+    MetricsRegistry objects hold metrics and render them in the Prometheus text format.
+    Collectors are functions called at rendering that return extra
+    (name, kind, documentation, [(labels, value)]) metric families.
+    """
+
+    def __init__(self):
+        """Create an empty MetricsRegistry object"""
+        self.metrics = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name: str, documentation: str, labelnames: tuple,
+                  **kwargs) -> Metric:
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, documentation, labelnames,
+                                                           **kwargs)
+            elif not isinstance(metric, metric_class) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f'Metric "{name}" is already registered differently')
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        """Get the counter of the name, creating it on first use"""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        """Get the gauge of the name, creating it on first use"""
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """Get the histogram of the name, creating it on first use"""
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def add_collector(self, collector):
+        """Call collector() at each rendering for extra metric families"""
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        """Stop calling a collector added with add_collector"""
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def render(self) -> str:
+        """Render all the metrics in the Prometheus text exposition format"""
+        families = [(metric.name, metric.kind, metric.documentation, metric.samples())
+                    for metric in list(self.metrics.values())]
+        for collector in list(self.collectors):
+            families += [(name, kind, documentation,
+                          [('', labels, value) for labels, value in samples])
+                         for name, kind, documentation, samples in collector()]
+        lines = []
+        for name, kind, documentation, samples in families:
+            documentation = documentation.replace('\\', r'\\').replace('\n', r'\n')
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines += [f'{name}{suffix}{_format_labels(labels)} {_format_value(value)}'
+                      for suffix, labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+
+# 默认共享的注册表，DanmakuDB各阶段的计时与计数都记录在这里
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    'danmaku_stage_duration_seconds',
+    'Duration of the stages of fetching and analyzing danmakus', ('stage',))
+API_REQUESTS = metrics.counter(
+    'danmaku_api_requests_total', 'Bilibili API requests by result', ('result',))
+VIDEOS_FETCHED = metrics.counter(
+    'danmaku_videos_fetched_total', 'Videos whose danmakus were fetched from the network')
+# 分段的protobuf接口只返回解析后的弹幕，不计入下载字节数
+XML_BYTES_DOWNLOADED = metrics.counter(
+    'danmaku_downloaded_xml_bytes_total',
+    'UTF-8 bytes of the downloaded danmaku XML, excluding protobuf segments')
+DANMAKUS_PARSED = metrics.counter(
+    'danmaku_parsed_total', 'Danmakus parsed from XML or protobuf segments')
+CACHE_REQUESTS = metrics.counter(
+    'danmaku_cache_requests_total', 'Danmaku cache lookups by kind and result',
+    ('kind', 'result'))
+TEXTS_SEGMENTED = metrics.counter(
+    'danmaku_segmented_texts_total', 'Distinct texts segmented into words, cache misses only')
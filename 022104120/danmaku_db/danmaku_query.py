@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides indexed filtering, sorting and cursor pagination of a video's danmakus"""
+
+import re
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import NamedTuple
+from .danmaku_store import DanmakuStore, VideoColumns
+
+# 正则表达式的最大长度，限制用户提交的表达式的编译和匹配开销
+MAX_REGEX_LENGTH = 256
+
+
+class DanmakuFilter(NamedTuple):
+    """Conditions danmakus must meet, None for no condition
+
+    Ranges include both ends.
+    """
+    contains: str = None
+    regex: str = None
+    progress_from: float = None
+    progress_to: float = None
+    ctime_from: int = None
+    ctime_to: int = None
+    mode: int = None
+    color: int = None
+    part: int = None
+
+
+class DanmakuQueryIndex:
+    """DanmakuQueryIndex class.
+
+    DanmakuQueryIndex objects keep the row orders of each video sorted by progress and
+    by send time, so that range conditions are answered by binary search. Text conditions
+    are checked once per distinct text of the video instead of once per danmaku.
+    The matching rows of the last max_results queries are kept, so that following
+    pages only slice them. Indexes are rebuilt when the video is modified.
+    """
+    sort_fields = ('index', 'progress', 'ctime')
+
+    def __init__(self, store: DanmakuStore, max_results: int = 32):
+        """Create a DanmakuQueryIndex object of the store"""
+        self.store = store
+        self.max_results = max_results
+        # (bvid, 字段) -> (列对象, 行数, 排序后的行号, 排序后的键)
+        self._orders = {}
+        self._results = OrderedDict()
+        # 只保护索引与结果的缓存，查询本身在锁外运行
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        """Get the state for pickling, without the lock"""
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        """Restore the state from pickling"""
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _order(self, bvid: str, columns: VideoColumns, length: int, field: str) -> tuple:
+        """Get the (row indexes, keys) of the first length rows of the video sorted by the field"""
+        entry = self._orders.get((bvid, field))
+        # 列对象只会被替换或追加，对象与行数不变即索引有效
+        if entry is None or entry[0] is not columns or entry[1] != length:
+            keys = getattr(columns.attrs.columns, field)
+            rows = array('I', sorted(range(length), key=keys.__getitem__))
+            entry = (columns, length, rows, [keys[row] for row in rows])
+            with self._lock:
+                self._orders[(bvid, field)] = entry
+        return entry[2], entry[3]
+
+    def _range_rows(self, bvid: str, columns: VideoColumns, length: int, field: str,
+                    low, high):
+        """Get the rows of the video whose field is within [low, high], sorted by the field"""
+        rows, keys = self._order(bvid, columns, length, field)
+        start = 0 if low is None else bisect_left(keys, low)
+        end = len(keys) if high is None else bisect_right(keys, high)
+        return rows[start:end]
+
+    @staticmethod
+    def _text_codes(strings: list, distinct_codes, danmaku_filter: DanmakuFilter):
+        """Get the set of the distinct codes meeting the text conditions, None if any"""
+        if distinct_codes is None:
+            return None
+        pattern = re.compile(danmaku_filter.regex) if danmaku_filter.regex is not None else None
+        # 每种弹幕只检查一次
+        return {code for code in distinct_codes
+                if (danmaku_filter.contains is None or danmaku_filter.contains in strings[code])
+                and (pattern is None or pattern.search(strings[code]) is not None)}
+
+    def query(self, bvid: str, danmaku_filter: DanmakuFilter = DanmakuFilter(),
+              sort: str = 'index', descending: bool = False) -> tuple:
+        """Get the rows of the video meeting the filter in the sort order
+
+        Get (string table, video columns, row indexes) of a snapshot of the video.
+        Only the snapshot is taken under the store lock, the filters run outside it.
+        Raise ValueError on an unknown sort field or a regex longer than MAX_REGEX_LENGTH,
+        and re.error on an invalid regex.
+        """
+        if sort not in self.sort_fields:
+            raise ValueError('Invalid sort field')
+        if danmaku_filter.regex is not None and len(danmaku_filter.regex) > MAX_REGEX_LENGTH:
+            raise ValueError('Regex too long')
+        with self.store.lock:
+            # 列只会被追加，字符串表在清空时会被替换，记录引用与行数即为一致的快照
+            strings = self.store.strings
+            columns = self.store.videos[bvid]
+            length = len(columns.codes)
+            distinct_codes = (None if danmaku_filter.contains is None
+                              and danmaku_filter.regex is None
+                              else list(self.store.frequency.distinct_codes(bvid)))
+        key = (bvid, danmaku_filter, sort, descending)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] is columns and cached[1] == length:
+                self._results.move_to_end(key)
+                return strings, columns, cached[2]
+
+        # 优先使用排序字段上的范围条件，其次使用任一范围条件缩小候选行
+        ranges = {'progress': (danmaku_filter.progress_from, danmaku_filter.progress_to),
+                  'ctime': (danmaku_filter.ctime_from, danmaku_filter.ctime_to)}
+        ranged = [field for field, bounds in ranges.items() if bounds != (None, None)]
+        driving = sort if sort in ranged else (ranged[0] if ranged else None)
+        if driving is not None:
+            candidates = self._range_rows(bvid, columns, length, driving, *ranges[driving])
+            if driving != sort:
+                sort_keys = None if sort == 'index' else getattr(columns.attrs.columns, sort)
+                candidates = sorted(candidates,
+                                    key=None if sort_keys is None else sort_keys.__getitem__)
+        elif sort == 'index':
+            candidates = range(length)
+        else:
+            candidates = self._order(bvid, columns, length, sort)[0]
+
+        attrs = columns.attrs.columns
+        checks = [(getattr(attrs, field), value) for field, value in
+                  (('mode', danmaku_filter.mode), ('color', danmaku_filter.color),
+                   ('part', danmaku_filter.part)) if value is not None]
+        range_checks = [(getattr(attrs, field), *ranges[field]) for field in ranged
+                        if field != driving]
+        text_codes = self._text_codes(strings, distinct_codes, danmaku_filter)
+        codes = columns.codes
+
+        def matches(row: int) -> bool:
+            return ((text_codes is None or codes[row] in text_codes)
+                    and all(column[row] == value for column, value in checks)
+                    and all((low is None or column[row] >= low)
+                            and (high is None or column[row] <= high)
+                            for column, low, high in range_checks))
+
+        if text_codes is None and not checks and not range_checks:
+            rows = array('I', candidates)
+        else:
+            rows = array('I', filter(matches, candidates))
+        if descending:
+            rows.reverse()
+
+        with self._lock:
+            self._results[key] = (columns, length, rows)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return strings, columns, rows
+
+    def clear(self):
+        """Remove all the indexes and cached results"""
+        with self._lock:
+            self._orders.clear()
+            self._results.clear()
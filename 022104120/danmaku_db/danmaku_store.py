@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides DanmakuStore class for columnar storage of danmakus"""
+
+import itertools
+import sys
+import threading
+from array import array
+from collections.abc import Sequence
+from .danmaku_xml import DanmakuAttr, DanmakuAttrColumns
+from .frequency_index import FrequencyIndex
+
+# 所有DanmakuStore共用的版本号，不同的存储或内容不会得到相同的版本号
+_versions = itertools.count(1)
+
+
+class VideoColumns:
+    """VideoColumns class.
+
+    VideoColumns objects hold the columns of the danmakus of a single video:
+    the dictionary-encoded text codes and the attribute columns.
+    """
+
+    def __init__(self, codes: array = None, attrs: DanmakuAttrColumns = None):
+        """Create a VideoColumns object"""
+        self.codes = codes if codes is not None else array('I')
+        self.attrs = attrs if attrs is not None else DanmakuAttrColumns()
+
+    def __len__(self) -> int:
+        """Count of danmakus"""
+        return len(self.codes)
+
+
+class DanmakuStore:
+    """DanmakuStore class.
+
+    DanmakuStore objects keep danmaku texts interned in a string table and
+    store each video's danmakus as typed array columns of codes into that table.
+    The frequency index is kept up to date on every modification, and version is
+    changed on every modification. Readers on other threads should hold lock.
+    """
+
+    def __init__(self):
+        """Create an empty DanmakuStore object"""
+        self.strings = []
+        self.string_codes = {}
+        self.videos = {}
+        self.frequency = FrequencyIndex()
+        self.version = next(_versions)
+        self.lock = threading.RLock()
+
+    def __getstate__(self) -> dict:
+        """Get the state for pickling, without the lock"""
+        with self.lock:
+            state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        """Restore the state from pickling"""
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def nbytes(self) -> int:
+        """Estimate the memory used by the string table and the columns in bytes"""
+        with self.lock:
+            columns_bytes = sum(column.itemsize * len(column) for columns in self.videos.values()
+                                for column in [columns.codes, *columns.attrs.columns])
+            strings = list(self.strings)
+        # 字符串表按对象大小加上列表与字典中的引用估算
+        return columns_bytes + sum(map(sys.getsizeof, strings)) + 2 * 8 * len(strings)
+
+    def intern(self, text: str) -> int:
+        """Get the code of the text, adding it to the string table if needed"""
+        code = self.string_codes.get(text)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(text)
+            self.string_codes[text] = code
+        return code
+
+    def set_video(self, bvid: str, texts, attrs: DanmakuAttrColumns = None) -> VideoColumns:
+        """Replace the danmakus of the video of the specified bvid"""
+        intern = self.intern
+        columns = VideoColumns(array('I', [intern(text) for text in texts]), attrs)
+        if attrs is None:
+            for _code in columns.codes:
+                columns.attrs.append(DanmakuAttr())
+        with self.lock:
+            self.frequency.remove_video(bvid)
+            self.videos[bvid] = columns
+            self.frequency.add(bvid, columns.codes)
+            self.version = next(_versions)
+        return columns
+
+    def append(self, bvid: str, text: str, attr: DanmakuAttr = DanmakuAttr()) -> int:
+        """Append a danmaku to the video of the specified bvid and return its code"""
+        code = self.intern(text)
+        with self.lock:
+            columns = self.videos.get(bvid)
+            if columns is None:
+                columns = self.videos[bvid] = VideoColumns()
+            # 先更新索引，以免尚未计数的视频重复计入该弹幕
+            self.frequency.add_one(bvid, code)
+            columns.codes.append(code)
+            columns.attrs.append(attr)
+            self.version = next(_versions)
+        return code
+
+    def merge_video(self, bvid: str, texts, attrs: DanmakuAttrColumns) -> int:
+        """Add the danmakus of the video of the specified bvid that it does not have yet
+
+        Danmakus are identified by their row id, or by their text, progress and
+        send time if the row id is unknown. Return the count of added danmakus.
+        """
+        with self.lock:
+            columns = self.videos.get(bvid)
+            if columns is None:
+                return len(self.set_video(bvid, texts, attrs))
+
+            def row_key(code: int, attr: DanmakuAttr):
+                return attr.row_id if attr.row_id else (code, attr.progress, attr.ctime, attr.part)
+
+            existing = columns.attrs
+            seen = set(existing.columns.row_id)
+            if 0 in seen:
+                seen.update(row_key(code, existing[i]) for i, code in enumerate(columns.codes)
+                            if existing.columns.row_id[i] == 0)
+            added_codes = []
+            for i, text in enumerate(texts):
+                code = self.intern(text)
+                attr = attrs[i]
+                key = row_key(code, attr)
+                if key in seen:
+                    continue
+                seen.add(key)
+                added_codes.append(code)
+                existing.append(attr)
+            if added_codes:
+                self.frequency.extend(bvid, added_codes)
+                columns.codes.extend(added_codes)
+                self.version = next(_versions)
+            return len(added_codes)
+
+    def load(self, strings: list, videos: dict):
+        """Replace the whole content with a string table and {bvid: VideoColumns}"""
+        string_codes = {text: code for code, text in enumerate(strings)}
+        with self.lock:
+            self.strings = strings
+            self.string_codes = string_codes
+            self.videos = videos
+            self.frequency.clear()
+            for bvid, columns in videos.items():
+                self.frequency.add(bvid, columns.codes)
+            self.version = next(_versions)
+
+    def clear(self):
+        """Remove all the danmakus and the string table"""
+        with self.lock:
+            # 替换而不是原地清空，已取得引用的读者不受影响
+            self.strings = []
+            self.string_codes = {}
+            self.videos = {}
+            self.frequency.clear()
+            self.version = next(_versions)
+
+
+class DanmakuView(Sequence):
+    """DanmakuView class.
+
+    DanmakuView objects are read-only list-like views of a video's danmaku texts.
+    """
+
+    def __init__(self, store: DanmakuStore, bvid: str):
+        """Create a view of the danmakus of the video of the specified bvid"""
+        self.store = store
+        self.bvid = bvid
+        self.columns = store.videos[bvid]
+
+    def __len__(self) -> int:
+        """Count of danmakus"""
+        return len(self.columns.codes)
+
+    def __getitem__(self, index):
+        """Get the danmaku text at the index, or a list of texts for a slice"""
+        strings = self.store.strings
+        if isinstance(index, slice):
+            return [strings[code] for code in self.columns.codes[index]]
+        return strings[self.columns.codes[index]]
+
+    def __iter__(self):
+        """Iterate over the danmaku texts"""
+        strings = self.store.strings
+        return (strings[code] for code in self.columns.codes)
+
+    def __contains__(self, text) -> bool:
+        """Check whether the video contains the danmaku text"""
+        code = self.store.string_codes.get(text)
+        return code is not None and code in self.columns.codes
+
+    def __eq__(self, other) -> bool:
+        """Compare the danmaku texts with another sequence"""
+        if isinstance(other, (Sequence, list)) and not isinstance(other, str):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f'DanmakuView({self.bvid!r}, {list(self)!r})'
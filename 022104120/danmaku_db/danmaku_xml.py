@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides incremental parsing of danmaku XML and compact storage of danmaku attributes"""
+
+import json
+from array import array
+from typing import Iterator, NamedTuple
+import xml.etree.ElementTree as xmlReader
+
+
+class DanmakuAttr(NamedTuple):
+    """Attributes of a danmaku taken from the "p" attribute of the XML element"""
+    progress: float = 0.0
+    mode: int = 1
+    color: int = 0xffffff
+    ctime: int = 0
+    row_id: int = 0
+    part: int = 0
+
+
+class DanmakuAttrColumns:
+    """DanmakuAttrColumns class.
+
+    DanmakuAttrColumns objects store danmaku attributes column by column in typed arrays.
+    """
+    typecodes = DanmakuAttr(progress='f', mode='B', color='I', ctime='q', row_id='q', part='H')
+
+    def __init__(self, columns=None):
+        """Create a DanmakuAttrColumns object, optionally from a sequence of columns
+
+        Columns that are already arrays of the right type are used without copying,
+        and missing trailing columns are filled with the default attribute values.
+        """
+        columns = list(columns or [[]])
+        row_count = len(columns[0])
+        # 旧版本缓存的数据缺少后加入的列
+        columns += [[default] * row_count for default in DanmakuAttr()[len(columns):]]
+        self.columns = DanmakuAttr(*(
+            column if isinstance(column, array) and column.typecode == typecode
+            else array(typecode, column)
+            for typecode, column in zip(self.typecodes, columns)))
+
+    def __len__(self) -> int:
+        """Count of danmakus"""
+        return len(self.columns.progress)
+
+    def __getitem__(self, index: int) -> DanmakuAttr:
+        """Get the attributes of the danmaku at the specified index"""
+        return DanmakuAttr(*(column[index] for column in self.columns))
+
+    def append(self, attr: DanmakuAttr):
+        """Append the attributes of a danmaku"""
+        for column, value in zip(self.columns, attr):
+            column.append(value)
+
+    def to_lists(self) -> list:
+        """Get the columns as plain lists"""
+        return [column.tolist() for column in self.columns]
+
+
+def parse_attr(p_attr: str) -> DanmakuAttr:
+    """Parse the "p" attribute of a danmaku element"""
+    # p属性依次为：出现时间、模式、字号、颜色、发送时间戳、弹幕池、用户哈希、弹幕ID、屏蔽等级
+    fields = p_attr.split(',')
+    if len(fields) < 5:
+        return DanmakuAttr()
+    return DanmakuAttr(float(fields[0]), int(fields[1]), int(fields[3]), int(fields[4]),
+                       int(fields[7]) if len(fields) > 7 else 0)
+
+
+def parse_danmaku_object(danmaku, part: int = 0) -> tuple[str, DanmakuAttr]:
+    """Get (text, attributes) of a danmaku object of bilibili_api, e.g. from get_danmakus"""
+    # 大会员专属颜色没有颜色值
+    color = int(danmaku.color, 16) if danmaku.color != 'special' else 0xffffff
+    return parse_text(danmaku.text), DanmakuAttr(float(danmaku.dm_time), int(danmaku.mode), color,
+                                                 int(danmaku.send_time), max(danmaku.id_, 0), part)
+
+
+def parse_text(text: str) -> str:
+    """Get the actual content of a danmaku text"""
+    # 特殊处理高级弹幕，其内容为一个数组，弹幕实际内容在4号元素
+    # 只有形如数组的弹幕才尝试解析JSON
+    if len(text) > 1 and text[0] == '[' and text[-1] == ']':
+        try:
+            advanced_danmaku = json.loads(text)
+        except json.decoder.JSONDecodeError:
+            return text
+        if isinstance(advanced_danmaku, list) and len(advanced_danmaku) > 4:
+            return str(advanced_danmaku[4])
+    return text
+
+
+def parse_danmaku_xml(danmaku_xml: str,
+                      chunk_size: int = 64 * 1024) -> Iterator[tuple[str, DanmakuAttr]]:
+    """Incrementally parse danmaku XML and yield (text, attributes) of each danmaku"""
+    parser = xmlReader.XMLPullParser(events=('start', 'end'))
+    root = None
+    for start in range(0, len(danmaku_xml), chunk_size):
+        parser.feed(danmaku_xml[start:start + chunk_size])
+        for event, element in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = element
+            elif element.tag == 'd':
+                yield parse_text(element.text or ''), parse_attr(element.get('p', ''))
+        # 丢弃已解析的元素，避免构建完整的树
+        if root is not None:
+            del root[:]
+    parser.close()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides vectorized histograms of danmaku playback progress and send time"""
+
+import math
+import numpy as np
+
+# 哔哩哔哩使用的时区（UTC+8）
+DEFAULT_UTC_OFFSET = 8 * 3600
+SEND_TIME_UNITS = {'hour': 3600, 'day': 24 * 3600}
+# 直方图的最大桶数，防止过小的桶大小耗尽内存
+MAX_BUCKETS = 100000
+
+
+def playback_histogram(progress: np.ndarray, bucket_seconds: float,
+                       max_buckets: int = MAX_BUCKETS) -> np.ndarray:
+    """Count the danmakus in each bucket_seconds long bucket of playback progress
+
+    Raise ValueError if more than max_buckets buckets would be needed.
+    """
+    if not math.isfinite(bucket_seconds) or bucket_seconds <= 0:
+        raise ValueError('Invalid bucket size')
+    if len(progress) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if float(progress.max()) / bucket_seconds >= max_buckets:
+        raise ValueError('Too many buckets')
+    # 非负数截断即为向下取整，比浮点数的整除快得多
+    buckets = np.maximum(progress.astype(np.float64) / bucket_seconds, 0).astype(np.int64)
+    return np.bincount(buckets)
+
+
+def send_time_histogram(ctime: np.ndarray, unit: str = 'hour', cyclic: bool = False,
+                        utc_offset: int = DEFAULT_UTC_OFFSET) -> tuple:
+    """Count the danmakus sent in each hour or day
+
+    Get (start timestamp of the first bucket, counts) of consecutive buckets, or if cyclic
+    is true (None, counts) of the 24 hours of the day or the 7 days of the week from Monday,
+    in the local time of utc_offset.
+    """
+    if unit not in SEND_TIME_UNITS:
+        raise ValueError('Invalid time unit')
+    unit_seconds = SEND_TIME_UNITS[unit]
+    # 发送时间未知（如从Excel读取）的弹幕不计入
+    ctime = ctime[ctime > 0]
+    buckets = (ctime + utc_offset) // unit_seconds
+    if cyclic:
+        # 1970年1月1日是星期四
+        period, shift = (24, 0) if unit == 'hour' else (7, 3)
+        return None, np.bincount((buckets + shift) % period, minlength=period)
+    if len(buckets) == 0:
+        return None, np.zeros(0, dtype=np.int64)
+    first = buckets.min()
+    return int(first * unit_seconds - utc_offset), np.bincount(buckets - first)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides FrequencyIndex class for incrementally counting danmaku frequency"""
+
+from collections import Counter
+
+
+class FrequencyIndex:
+    """FrequencyIndex class.
+
+    FrequencyIndex objects count the text codes of the whole database and of each video
+    as danmakus are added and removed. Added videos are only counted when the counts
+    are first needed, and the ranking of each scope is sorted once after a modification
+    and reused, so repeated top-k queries only slice the ranking.
+    """
+
+    def __init__(self):
+        """Create an empty FrequencyIndex object"""
+        self._counts = Counter()
+        self.video_counts = {}
+        # 尚未计数的视频的弹幕编码列
+        self._pending = {}
+        # 各范围（None表示整个数据库）已排序的频率表，修改后失效
+        self._rankings = {}
+
+    @property
+    def counts(self) -> Counter:
+        """Counts of the codes over the whole database"""
+        self._flush()
+        return self._counts
+
+    def _flush(self):
+        for bvid in list(self._pending):
+            self._flush_video(bvid)
+
+    def _flush_video(self, bvid: str):
+        codes = self._pending.pop(bvid, None)
+        if codes is not None:
+            video_counts = self.video_counts[bvid] = Counter(codes)
+            self._counts.update(video_counts)
+
+    def add(self, bvid: str, codes):
+        """Count the codes of the video of the specified bvid, replacing its previous counts"""
+        self.remove_video(bvid)
+        self._pending[bvid] = codes
+        self._rankings.pop(bvid, None)
+        self._rankings.pop(None, None)
+
+    def add_one(self, bvid: str, code: int):
+        """Count a single code added to the video of the specified bvid"""
+        self.extend(bvid, (code,))
+
+    def extend(self, bvid: str, codes):
+        """Count the codes added to the video of the specified bvid"""
+        # 按加入顺序计数，使同频弹幕的排序保持稳定
+        self._flush()
+        video_counts = self.video_counts.get(bvid)
+        if video_counts is None:
+            video_counts = self.video_counts[bvid] = Counter()
+        for code in codes:
+            video_counts[code] += 1
+            self._counts[code] += 1
+        self._rankings.pop(bvid, None)
+        self._rankings.pop(None, None)
+
+    def remove_video(self, bvid: str):
+        """Remove the counts of the video of the specified bvid"""
+        self._pending.pop(bvid, None)
+        video_counts = self.video_counts.pop(bvid, None)
+        if video_counts is not None:
+            self._counts.subtract(video_counts)
+            for code in video_counts:
+                if self._counts[code] <= 0:
+                    del self._counts[code]
+        self._rankings.pop(bvid, None)
+        self._rankings.pop(None, None)
+
+    def distinct_codes(self, bvid: str):
+        """Get the distinct codes of the video of the specified bvid"""
+        self._flush_video(bvid)
+        return self.video_counts.get(bvid, Counter()).keys()
+
+    def ranking(self, bvid: str = None) -> list:
+        """Get all the (code, count) pairs of the scope sorted by count in descending order"""
+        ranking = self._rankings.get(bvid)
+        if ranking is None:
+            if bvid is None:
+                counts = self.counts
+            else:
+                self._flush_video(bvid)
+                counts = self.video_counts.get(bvid, Counter())
+            ranking = self._rankings[bvid] = counts.most_common()
+        return ranking
+
+    def top(self, k: int, bvid: str = None) -> list:
+        """Get the top k (code, count) pairs of the whole database or of the specified video"""
+        return self.ranking(bvid)[:k]
+
+    def clear(self):
+        """Remove all the counts"""
+        self._counts.clear()
+        self.video_counts.clear()
+        self._pending.clear()
+        self._rankings.clear()
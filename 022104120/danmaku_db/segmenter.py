@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides Segmenter class for cached and parallel word segmentation of danmakus"""
+
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from .danmaku_metrics import TEXTS_SEGMENTED
+
+# 每个进程中已加载的分词模型
+_models = {}
+# 模型名 -> 创建其他模型的工厂，未注册的模型名为pkuseg模型
+_factories = {}
+_models_lock = threading.Lock()
+
+
+def register_model(model_name: str, factory):
+    """Register a segmentation model, created by calling factory() on first use
+
+    The model has a cut(text) method returning the words. factory must be picklable
+    (e.g. a module-level class or function), so that worker processes can create
+    the model as well, whatever the start method of the processes.
+    """
+    with _models_lock:
+        _factories[model_name] = factory
+        _models.pop(model_name, None)
+
+
+def get_model(model_name: str = 'web'):
+    """Get the model of the specified name, loading it on first use
+
+    Models not registered with register_model are pkuseg models.
+    """
+    model = _models.get(model_name)
+    if model is None:
+        with _models_lock:
+            model = _models.get(model_name)
+            if model is None:
+                factory = _factories.get(model_name)
+                if factory is not None:
+                    model = _models[model_name] = factory()
+                else:
+                    # 按需导入，避免拖慢服务器启动
+                    import spacy_pkuseg as pkuseg  # pylint: disable=import-outside-toplevel
+                    model = _models[model_name] = pkuseg.pkuseg(model_name=model_name)
+    return model
+
+
+def _init_worker(model_name: str, factory):
+    """Initialize a worker process, registering the model created by factory if given"""
+    if factory is not None:
+        register_model(model_name, factory)
+
+
+def _cut_batch(model_name: str, texts: list) -> list:
+    """Segment a batch of texts, used by the worker processes"""
+    model = get_model(model_name)
+    return [tuple(model.cut(text)) for text in texts]
+
+
+class Segmenter:
+    """Segmenter class.
+
+    Segmenter objects segment danmakus into words with a resident pkuseg model.
+    Each distinct text is segmented once and its tokens are memoized across calls,
+    and large batches of unseen texts are fanned out to a process pool.
+    """
+
+    def __init__(self, model_name: str = 'web', processes: int = None,
+                 parallel_threshold: int = 20000, chunk_size: int = 2000,
+                 max_cache_size: int = 1000000):
+        """Create a Segmenter object
+
+        processes is the size of the process pool (None for the CPU count, 1 to disable it),
+        which is only used when at least parallel_threshold texts need to be segmented.
+        """
+        self.model_name = model_name
+        self.processes = processes
+        self.parallel_threshold = parallel_threshold
+        self.chunk_size = chunk_size
+        self.max_cache_size = max_cache_size
+        self.token_cache = {}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _pool_executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # 子进程不一定由fork创建，需传入注册的模型工厂
+            self._pool = ProcessPoolExecutor(self.processes, initializer=_init_worker,
+                                             initargs=(self.model_name,
+                                                       _factories.get(self.model_name)))
+        return self._pool
+
+    def warm_up(self):
+        """Load the segmentation model in advance"""
+        get_model(self.model_name)
+
+    def cut(self, text: str) -> tuple:
+        """Segment a text into a tuple of words"""
+        tokens = self.token_cache.get(text)
+        if tokens is None:
+            tokens = tuple(get_model(self.model_name).cut(text))
+            self._remember(text, tokens)
+        return tokens
+
+    def _remember(self, text: str, tokens: tuple):
+        TEXTS_SEGMENTED.inc()
+        if len(self.token_cache) >= self.max_cache_size:
+            self.token_cache.clear()
+        self.token_cache[text] = tokens
+
+    def segment(self, texts):
+        """Make sure all the texts are segmented and their tokens are cached"""
+        with self._lock:
+            missing = [text for text in dict.fromkeys(texts) if text not in self.token_cache]
+            if len(missing) >= self.parallel_threshold and self.processes != 1:
+                chunks = [missing[i:i + self.chunk_size]
+                          for i in range(0, len(missing), self.chunk_size)]
+                results = self._pool_executor().map(_cut_batch, [self.model_name] * len(chunks),
+                                                    chunks)
+                for chunk, chunk_tokens in zip(chunks, results):
+                    for text, tokens in zip(chunk, chunk_tokens):
+                        self._remember(text, tokens)
+            else:
+                for text in missing:
+                    self.cut(text)
+
+    def count_tokens(self, text_counts, excluded=frozenset()) -> Counter:
+        """Count the words of the (text, count) pairs, weighted by the count of each text"""
+        text_counts = list(text_counts)
+        self.segment(text for text, _count in text_counts)
+        word_frequency = Counter()
+        for text, count in text_counts:
+            tokens = self.token_cache.get(text)
+            if tokens is None:
+                tokens = self.cut(text)
+            for token in tokens:
+                if token not in excluded:
+                    word_frequency[token] += count
+        return word_frequency
+
+    def close(self):
+        """Shut down the process pool"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+# 默认共享的分词器，使模型与分词缓存在多个DanmakuDB之间复用
+default_segmenter = Segmenter()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides a compact binary snapshot format of DanmakuStore objects
+
+A snapshot consists of:
+    - the magic bytes and a header of the column description length, the string count,
+      the string blob length and the video count
+    - the column description, "name:typecode" pairs separated by commas
+    - the string table, as string_count + 1 byte offsets followed by the NUL separated
+      UTF-8 blob
+    - the video directory, the length prefixed bvid, the row count and the data offset
+      of each video
+    - the column data of each video, every column stored contiguously
+All the numbers are little-endian. Videos can be located by the directory without
+reading the column data of the others, but loading copies the columns into memory.
+"""
+
+import mmap
+import struct
+import sys
+from array import array
+from .danmaku_xml import DanmakuAttr, DanmakuAttrColumns
+from .danmaku_store import DanmakuStore, VideoColumns
+
+MAGIC = b'DMKSNAP\x01'
+HEADER = struct.Struct('<IQQQ')
+BVID_LENGTH = struct.Struct('<H')
+VIDEO_ENTRY = struct.Struct('<QQ')
+COLUMNS = (('codes', 'I'),) + tuple(zip(DanmakuAttr._fields, DanmakuAttrColumns.typecodes))
+
+
+def _to_little_endian(column: array) -> bytes:
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _from_little_endian(typecode: str, data) -> array:
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def write_snapshot(store: DanmakuStore, filename: str):
+    """Write the content of the store to a snapshot file"""
+    with store.lock:
+        strings = list(store.strings)
+        videos = [(bvid, columns.codes[:], [column[:] for column in columns.attrs.columns])
+                  for bvid, columns in store.videos.items()]
+    blob = '\x00'.join(strings).encode('utf-8')
+    offsets = array('Q', [0])
+    position = 0
+    for text in strings:
+        position += len(text.encode('utf-8')) + 1
+        offsets.append(position)
+    columns_desc = ','.join(f'{name}:{typecode}' for name, typecode in COLUMNS).encode('utf-8')
+    bvids = [bvid.encode('utf-8') for bvid, _codes, _attrs in videos]
+    data_offset = (len(MAGIC) + HEADER.size + len(columns_desc) + offsets.itemsize * len(offsets)
+                   + len(blob) + sum(BVID_LENGTH.size + len(bvid) + VIDEO_ENTRY.size
+                                     for bvid in bvids))
+    with open(filename, 'wb') as snapshot_file:
+        snapshot_file.write(MAGIC)
+        snapshot_file.write(HEADER.pack(len(columns_desc), len(strings), len(blob), len(videos)))
+        snapshot_file.write(columns_desc)
+        snapshot_file.write(_to_little_endian(offsets))
+        snapshot_file.write(blob)
+        for bvid, (_bvid, codes, attrs) in zip(bvids, videos):
+            snapshot_file.write(BVID_LENGTH.pack(len(bvid)) + bvid)
+            snapshot_file.write(VIDEO_ENTRY.pack(len(codes), data_offset))
+            data_offset += sum(column.itemsize * len(column) for column in [codes] + attrs)
+        for _bvid, codes, attrs in videos:
+            for column in [codes] + attrs:
+                snapshot_file.write(_to_little_endian(column))
+
+
+def read_snapshot(filename: str, bvids=None) -> tuple:
+    """Read a snapshot file and get its (string table, {bvid: VideoColumns})
+
+    Only the columns of the videos of the specified bvids are read if bvids is given,
+    with a string table of only the texts these videos use. The file is memory-mapped
+    while reading so that only these sections are loaded, but the columns are copied
+    into arrays, which stay appendable once the file is closed.
+    """
+    with open(filename, 'rb') as snapshot_file, \
+            mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+        if snapshot[:len(MAGIC)] != MAGIC:
+            raise ValueError('Invalid snapshot file')
+        position = len(MAGIC)
+        desc_length, string_count, blob_length, video_count = HEADER.unpack_from(snapshot,
+                                                                                position)
+        position += HEADER.size
+        file_columns = [column.split(':') for column in
+                        snapshot[position:position + desc_length].decode('utf-8').split(',')]
+        position += desc_length
+        offsets = _from_little_endian('Q', snapshot[position:position + 8 * (string_count + 1)])
+        position += 8 * (string_count + 1)
+        blob_start = position
+        position += blob_length
+        directory = {}
+        for _i in range(video_count):
+            (bvid_length,) = BVID_LENGTH.unpack_from(snapshot, position)
+            position += BVID_LENGTH.size
+            bvid = snapshot[position:position + bvid_length].decode('utf-8')
+            position += bvid_length
+            directory[bvid] = VIDEO_ENTRY.unpack_from(snapshot, position)
+            position += VIDEO_ENTRY.size
+
+        videos = {}
+        for bvid in (directory if bvids is None else [bvid for bvid in bvids if bvid in directory]):
+            row_count, data_offset = directory[bvid]
+            columns = {}
+            for name, typecode in file_columns:
+                length = array(typecode).itemsize * row_count
+                columns[name] = _from_little_endian(typecode,
+                                                    snapshot[data_offset:data_offset + length])
+                data_offset += length
+            # 快照中缺少的列以默认值填充
+            attrs = DanmakuAttrColumns([columns[name] if name in columns else
+                                        array(typecode, [default]) * row_count
+                                        for (name, typecode), default in
+                                        zip(COLUMNS[1:], DanmakuAttr())])
+            videos[bvid] = VideoColumns(columns['codes'], attrs)
+
+        if bvids is None:
+            strings = snapshot[blob_start:blob_start + blob_length].decode('utf-8').split('\x00')
+            if string_count == 0:
+                strings = []
+            elif len(strings) != string_count:
+                # 弹幕中含有NUL字符时按偏移逐条解码
+                strings = [snapshot[blob_start + offsets[i]:blob_start + offsets[i + 1] - 1]
+                           .decode('utf-8') for i in range(string_count)]
+        else:
+            # 只保留这些视频用到的弹幕，并按新的字符串表重新编号
+            used_codes = sorted(set().union(*(columns.codes for columns in videos.values())))
+            strings = [snapshot[blob_start + offsets[code]:blob_start + offsets[code + 1] - 1]
+                       .decode('utf-8') for code in used_codes]
+            new_codes = {code: new_code for new_code, code in enumerate(used_codes)}
+            videos = {bvid: VideoColumns(array('I', map(new_codes.__getitem__, columns.codes)),
+                                         columns.attrs)
+                      for bvid, columns in videos.items()}
+    return strings, videos
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides loading of stopword lists excluded from word clouds"""
+
+import string
+from functools import lru_cache
+from os import path
+
+DEFAULT_STOPWORDS_PATH = path.join(path.dirname(__file__), 'stopwords.txt')
+# 标点、数字、英文字母与空白字符始终排除
+BUILTIN_STOPWORDS = frozenset(string.punctuation + string.digits + string.ascii_letters
+                              + string.whitespace)
+
+
+@lru_cache(maxsize=None)
+def _compile_stopwords(filename: str, _mtime: float, extra_words: frozenset) -> frozenset:
+    with open(filename, encoding='utf-8') as stopwords_file:
+        stopwords = frozenset(line.strip() for line in stopwords_file if line.strip() != '')
+    return stopwords | BUILTIN_STOPWORDS | extra_words
+
+
+def load_stopwords(filename: str = DEFAULT_STOPWORDS_PATH, extra_words=()) -> frozenset:
+    """Load a stopword file with one word per line and compile it into a frozenset
+
+    The file is only read again when it is modified. The built-in stopwords
+    and extra_words are added to the result.
+    """
+    if filename == '':
+        raise ValueError('Empty filename')
+    return _compile_stopwords(path.abspath(filename), path.getmtime(filename),
+                              frozenset(extra_words))
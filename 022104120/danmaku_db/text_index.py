@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Provides TextIndex class, an inverted index from words to danmakus"""
+
+import threading
+from array import array
+from collections import Counter
+from .danmaku_store import DanmakuStore
+from .segmenter import Segmenter
+
+
+class TextIndex:
+    """TextIndex class.
+
+    TextIndex objects map the words of danmakus to the texts containing them,
+    and the texts of each video to the indexes of their danmakus, so that the postings
+    of a word are the (bvid, index) of the danmakus containing it. Each distinct text
+    is segmented once. update should be called before querying, it only indexes
+    the texts and danmakus added since the last update.
+    """
+
+    def __init__(self, store: DanmakuStore):
+        """Create an empty TextIndex object of the store"""
+        self.store = store
+        # 词 -> 包含该词的弹幕编码集合
+        self.word_codes = {}
+        # 弹幕编码 -> 去重后的词
+        self.code_words = {}
+        # bvid -> (列对象, 已索引行数, {弹幕编码: 行号数组})
+        self._postings = {}
+        self._lock = threading.RLock()
+
+    def __getstate__(self) -> dict:
+        """Get the state for pickling, without the lock"""
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        """Restore the state from pickling"""
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def update(self, segmenter: Segmenter):
+        """Index the texts and danmakus added since the last update, segmenting with segmenter"""
+        with self._lock:
+            with self.store.lock:
+                strings = self.store.strings
+                videos = {}
+                for bvid, columns in self.store.videos.items():
+                    entry = self._postings.get(bvid)
+                    # 列对象未被替换时只索引追加的行
+                    if entry is None or entry[0] is not columns or entry[1] > len(columns):
+                        entry = (columns, 0, {})
+                    # 锁内只复制新增行的编码，倒排表在锁外建立，以免阻塞写入
+                    videos[bvid] = (entry, columns.codes[entry[1]:])
+            for bvid in [bvid for bvid in self._postings if bvid not in videos]:
+                del self._postings[bvid]
+            new_codes = set()
+            for bvid, ((columns, indexed, postings), new_rows) in videos.items():
+                for row, code in enumerate(new_rows, indexed):
+                    rows = postings.get(code)
+                    if rows is None:
+                        rows = postings[code] = array('I')
+                        if code not in self.code_words:
+                            new_codes.add(code)
+                    rows.append(row)
+                self._postings[bvid] = (columns, indexed + len(new_rows), postings)
+            new_texts = [(code, strings[code]) for code in new_codes]
+        segmenter.segment(text for _code, text in new_texts)
+        with self._lock:
+            for code, text in new_texts:
+                words = self.code_words[code] = tuple(dict.fromkeys(segmenter.cut(text)))
+                for word in words:
+                    self.word_codes.setdefault(word, set()).add(code)
+
+    def matching_codes(self, words, match_all: bool = True) -> set:
+        """Get the codes of the texts containing all (or any) of the words"""
+        with self._lock:
+            code_sets = [self.word_codes.get(word, set()) for word in words]
+            if not code_sets:
+                return set()
+            if match_all:
+                return set.intersection(*code_sets)
+            return set.union(*code_sets)
+
+    def search(self, words, match_all: bool = True) -> dict:
+        """Get {bvid: sorted danmaku indexes} of the danmakus containing all (or any) words"""
+        codes = self.matching_codes(words, match_all)
+        result = {}
+        with self._lock:
+            for bvid, (_columns, _indexed, postings) in self._postings.items():
+                rows = [row for code in codes.intersection(postings) for row in postings[code]]
+                if rows:
+                    result[bvid] = sorted(rows)
+        return result
+
+    def cooccurring(self, word: str, max_n: int, excluded=frozenset()) -> list:
+        """Get the top n (word, count) pairs of the words appearing in the same danmakus as word
+
+        Each word is counted once per danmaku containing both words.
+        """
+        codes = self.matching_codes([word])
+        cooccurrence = Counter()
+        with self.store.lock:
+            counts = self.store.frequency.counts
+            code_counts = [(code, counts.get(code, 0)) for code in codes]
+        with self._lock:
+            for code, count in code_counts:
+                # 被替换或清除的视频的弹幕文本仍在索引中，但已不再出现
+                if count == 0:
+                    continue
+                for other in self.code_words[code]:
+                    if other != word and other not in excluded:
+                        cooccurrence[other] += count
+        return cooccurrence.most_common(max_n)
+
+    def clear(self):
+        """Remove all the postings"""
+        with self._lock:
+            self.word_codes.clear()
+            self.code_words.clear()
+            self._postings.clear()
@@ -3,21 +3,34 @@
 
 """Entrypoint of the analyzer"""
 
+import argparse
 import asyncio
 from analyzer_server import AnalyzerServer
 
 
-async def main():
+async def main(profiling: bool = False, warm_up: bool = True,
+               cache_filename: str = 'danmaku_cache.sqlite3'):
     """Async entrypoint"""
-    server = AnalyzerServer()
+    server = AnalyzerServer(profiling=profiling, warm_up=warm_up, cache_filename=cache_filename)
     await server.run()
     print('本地服务器已启动，请访问“http://localhost:8080/ui/main”以使用该工具。')
+    if profiling:
+        print('已启用性能采样，请访问“http://localhost:8080/debug/profile?seconds=10”以采样。')
     print('按下“Ctrl+C”以停止服务器运行...')
     await asyncio.Event().wait()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bilibili danmaku analyzer')
+    parser.add_argument('--profiling', action='store_true',
+                        help='enable the sampling profiler endpoint /debug/profile')
+    parser.add_argument('--no-warm-up', action='store_true',
+                        help='do not preload the analysis modules and models after startup')
+    parser.add_argument('--cache', default='danmaku_cache.sqlite3',
+                        help='danmaku cache file shared with the batch analyzer, "" to disable it')
+    args = parser.parse_args()
     try:
-        asyncio.get_event_loop().run_until_complete(main())
+        asyncio.get_event_loop().run_until_complete(main(args.profiling, not args.no_warm_up,
+                                                     args.cache))
     except KeyboardInterrupt:
         pass
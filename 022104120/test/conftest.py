@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Shared fixtures and stubs of the tests"""
+
+import pytest
+import bilibili_api as bapi
+from benchmark import StubBilibili, FixedCorpus
+
+TEST_STUB_XML = ('<?xml version="1.0" encoding="UTF-8"?>'
+                 '<i><chatserver>chat.bilibili.com</chatserver>'
+                 '<d p="1.5,1,25,16777215,1693000000,0,abcdef01,1001,10">Testing danmaku</d>'
+                 '<d p="3.0,1,25,16777215,1693000100,0,abcdef02,1002,10">Testing danmaku</d>'
+                 '<d p="5.0,7,25,16777215,1693000200,0,abcdef03,1003,10">'
+                 '[0,0,"1-1",4.5,"Advanced danmaku",0,0,0,0,500,0,1]</d></i>')
+
+
+class StubModel:
+    """StubModel class.
+
+    Local stand-in of the pkuseg model, splitting texts by spaces
+    """
+    def __init__(self):
+        self.cut_count = 0
+
+    def cut(self, text: str) -> list:
+        """Stub of pkuseg.cut"""
+        self.cut_count += 1
+        return text.split(' ')
+
+
+@pytest.fixture
+def stub_api(monkeypatch):
+    """Fixture, replaces bilibili_api calls with a local stub"""
+    stub = StubBilibili(FixedCorpus(45, TEST_STUB_XML), latency=0.01, durations=(60,))
+    monkeypatch.setattr(bapi.search, 'search_by_type', stub.search_by_type)
+    monkeypatch.setattr(bapi.video, 'Video', stub.video)
+    return stub
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Test module for analyzer_api"""
+
+import asyncio
+import json
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from danmaku_db import DanmakuDB, Segmenter, register_model
+from analyzer_server.analyzer_api import ApiRoutes, ApiHandler
+from analyzer_server.dataset_registry import DatasetRegistry
+from analyzer_server.wordcloud_renderer import WordcloudRenderer
+from analyzer_server.worker_pool import WorkerPool
+from .conftest import StubModel
+
+TEST_KEYWORD = '让子弹飞'
+
+
+class TestAnalyzerApi:
+    """TestAnalyzerApi class.
+
+    Test class for analyzer_api
+    """
+    @pytest_asyncio.fixture
+    async def client(self, monkeypatch, stub_api):
+        """Fixture, returns a client of the API fetching from the stub"""
+        register_model('stub', StubModel)
+        segmenter = Segmenter(model_name='stub', processes=1)
+        monkeypatch.setattr(ApiHandler, 'cache', None)
+        monkeypatch.setattr(ApiHandler, 'registry',
+                            DatasetRegistry(lambda: DanmakuDB(segmenter=segmenter)))
+        monkeypatch.setattr(ApiHandler, 'pool', WorkerPool())
+        monkeypatch.setattr(ApiHandler, 'renderer', WordcloudRenderer(pool=ApiHandler.pool))
+        app = web.Application()
+        app.router.add_routes(ApiRoutes)
+        async with TestClient(TestServer(app)) as test_client:
+            yield test_client
+
+    @staticmethod
+    async def get_json(client: TestClient, url: str, **params) -> dict:
+        """Get the JSON response of the API"""
+        response = await client.get(url, params=params)
+        return await response.json()
+
+    @pytest.mark.asyncio
+    async def test_fetch_wait_stub(self, client):
+        """Test fetch API waiting for the job"""
+        result = await self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD, n=5, wait='true')
+        assert result['code'] == 0 and result['status'] == 'done'
+        assert result['dataset'] == f'{TEST_KEYWORD}:5' and result['videos_done'] == 5
+        assert result['danmakus'] == 15
+        result = await self.get_json(client, '/api/top_danmakus', n=1)
+        assert result['top_danmakus'] == [{'danmaku': 'Testing danmaku', 'count': 10}]
+        result = await self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD, n=0)
+        assert result['code'] == 4
+
+    @pytest.mark.asyncio
+    async def test_fetch_events_stub(self, client):
+        """Test fetch_status and fetch_events APIs following a background job"""
+        result = await self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD, n=5)
+        assert result['code'] == 0 and result['dataset'] == f'{TEST_KEYWORD}:5'
+        job = result['job']
+        result = await self.get_json(client, '/api/fetch_status', job=job)
+        assert result['code'] == 0 and result['status'] == 'running'
+        response = await client.get('/api/fetch_events', params={'job': job, 'interval': 0})
+        assert response.headers['Content-Type'] == 'text/event-stream'
+        events = [json.loads(line[len('data: '):]) for line in (await response.text()).split('\n')
+                  if line.startswith('data: ')]
+        assert events[-1]['status'] == 'done' and events[-1]['videos_done'] == 5
+        assert all(event['status'] == 'running' for event in events[:-1])
+        result = await self.get_json(client, '/api/fetch_status', job=job)
+        assert result['status'] == 'done' and result['danmakus'] == 15
+        for url in ('/api/fetch_status', '/api/fetch_events', '/api/fetch_cancel'):
+            assert (await self.get_json(client, url, job='missing'))['code'] == 7
+
+    @pytest.mark.asyncio
+    async def test_fetch_cancel_stub(self, client, stub_api):
+        """Test cancelling a fetch job another client is waiting for"""
+        stub_api.latency = 0.5
+        job = (await self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD, n=5))['job']
+        # 相同数据集的等待请求合并到同一任务
+        waiting = asyncio.ensure_future(self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD,
+                                                      n=5, wait='true'))
+        await asyncio.sleep(0.1)
+        result = await self.get_json(client, '/api/fetch_cancel', job=job)
+        assert result['code'] == 0 and result['job'] == job
+        result = await waiting
+        assert result['code'] == 0 and result['job'] == job and result['status'] == 'cancelled'
+        result = await self.get_json(client, '/api/fetch_status', job=job)
+        assert result['status'] == 'cancelled'
+
+    @pytest.mark.asyncio
+    async def test_fetch_replace_stub(self, client, stub_api):
+        """Test fetching other search results into a dataset being fetched"""
+        stub_api.latency = 0.2
+        first = await self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD, n=5,
+                                    dataset='shared')
+        stub_api.latency = 0.01
+        result = await self.get_json(client, '/api/fetch', keyword='other', n=3,
+                                     dataset='shared', wait='true')
+        assert result['status'] == 'done' and result['job'] != first['job']
+        result = await self.get_json(client, '/api/fetch_status', job=first['job'])
+        assert result['status'] == 'cancelled'
+        (info,) = (await self.get_json(client, '/api/datasets'))['datasets']
+        assert info['keyword'] == 'other' and info['video_count'] == 3
+        assert info['job'] != first['job']
+
+    @pytest.mark.asyncio
+    async def test_density_stub(self, client):
+        """Test density API rejecting invalid buckets"""
+        await self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD, n=5, wait='true')
+        result = await self.get_json(client, '/api/density', bucket=2)
+        assert result['code'] == 0 and result['counts'] == [5, 5, 5]
+        for bucket in ('0', 'nan', 'inf', '0.00001'):
+            assert (await self.get_json(client, '/api/density', bucket=bucket))['code'] == 8
+
+    @pytest.mark.asyncio
+    async def test_danmakus_stub(self, client, stub_api):
+        """Test danmakus API querying in the worker pool"""
+        await self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD, n=5, wait='true')
+        bvid = stub_api.corpus.bvid(0)
+        result = await self.get_json(client, '/api/danmakus', bvid=bvid, regex='^Adv',
+                                     sort='progress')
+        assert result['code'] == 0 and result['total_count'] == 1
+        assert result['data'][0]['danmaku'] == 'Advanced danmaku'
+        result = await self.get_json(client, '/api/worker_stats')
+        assert result['jobs']['query']['count'] == 1
+        for params in ({'regex': '('}, {'regex': 'a' * 1000}, {'sort': 'missing'}):
+            result = await self.get_json(client, '/api/danmakus', bvid=bvid, **params)
+            assert result['code'] == 8
+
+    @pytest.mark.asyncio
+    async def test_db_data_stub(self, client, stub_api):
+        """Test db_data API paging the danmakus of a video"""
+        await self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD, n=2, wait='true')
+        bvid = stub_api.corpus.bvid(0)
+        result = await self.get_json(client, '/api/db_data', bvid=bvid, size=2, page=2)
+        assert result['code'] == 0 and result['page_count'] == 2
+        assert result['data'] == ['Advanced danmaku'] and result['total_count'] == 3
+        ApiHandler.registry.get(None).db['BVempty'] = []
+        result = await self.get_json(client, '/api/db_data', bvid='BVempty', size=0, page=1)
+        assert result['code'] == 0 and result['page_count'] == 0 and result['data'] == []
+
+    @pytest.mark.asyncio
+    async def test_wordcloud_stub(self, client):
+        """Test wordcloud API caching the image and revalidating it by its ETag"""
+        for dataset in ('words', 'stopwords'):
+            await self.get_json(client, '/api/fetch', keyword=TEST_KEYWORD, n=2,
+                                dataset=dataset, wait='true')
+        response = await client.get('/api/wordcloud', params={'dataset': 'words'})
+        assert response.status == 200 and response.content_type == 'image/png'
+        etag = response.headers['ETag']
+        png = await response.read()
+        response = await client.get('/api/wordcloud', params={'dataset': 'words'})
+        assert response.headers['ETag'] == etag and await response.read() == png
+        response = await client.get('/api/wordcloud', params={'dataset': 'words'},
+                                    headers={'If-None-Match': etag})
+        assert response.status == 304
+        # 缓存命中时不再渲染
+        result = await self.get_json(client, '/api/worker_stats')
+        assert result['jobs']['wordcloud']['count'] == 1
+        ApiHandler.registry.get('words').db.append('BVnew', 'Testing danmaku')
+        response = await client.get('/api/wordcloud', params={'dataset': 'words'},
+                                    headers={'If-None-Match': etag})
+        assert response.status == 200 and response.headers['ETag'] != etag
+        ApiHandler.registry.get('stopwords').db.stopwords = frozenset(
+            ['Testing', 'Advanced', 'danmaku'])
+        result = await self.get_json(client, '/api/wordcloud', dataset='stopwords')
+        assert result['code'] == 9
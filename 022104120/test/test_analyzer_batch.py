@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Test module for analyzer_batch"""
+
+import os
+import json
+import pytest
+from danmaku_db import DanmakuDB, DanmakuCache
+from analyzer_batch import BatchRunner
+
+
+class TestAnalyzerBatch:
+    """TestAnalyzerBatch class.
+
+    Test class for analyzer_batch
+    """
+    @pytest.mark.asyncio
+    async def test_batch_runner_stub(self, stub_api, tmp_path):
+        """Test BatchRunner fetching and analyzing several keywords with a shared cache"""
+        summaries = []
+        runner = BatchRunner(str(tmp_path), n=5, top_n=2, formats=('top', 'snapshot'),
+                             concurrency=3, workers=0, prefetch=0,
+                             cache=DanmakuCache(str(tmp_path / 'cache.sqlite3')),
+                             progress=summaries.append)
+        result = await runner.run(['a/b', '', 'a:b', '# comment', 'a/b'])
+        assert result['done'] == 2 and result['failed'] == 0 and len(summaries) == 2
+        assert [summary['directory'] for summary in result['keywords']] == [
+            str(tmp_path / 'a_b'), str(tmp_path / 'a_b_2')]
+        assert len(stub_api.fetched_bvids) == 5 and stub_api.max_in_flight <= 3
+        with open(tmp_path / 'a_b_2' / 'top_danmakus.json', encoding='utf-8') as top_file:
+            assert json.load(top_file)['top_danmakus'] == [
+                {'danmaku': 'Testing danmaku', 'count': 10},
+                {'danmaku': 'Advanced danmaku', 'count': 5}]
+        danmaku_db = DanmakuDB()
+        danmaku_db.load(str(tmp_path / 'a_b' / 'danmakus.snapshot'))
+        assert len(danmaku_db) == 5 and os.path.exists(tmp_path / 'summary.json')
+        stub_api.corpus.video_count = 0
+        result = await BatchRunner(str(tmp_path), workers=0).run(['c'])
+        assert result['failed'] == 1 and result['keywords'][0]['error'] == 'Empty database'
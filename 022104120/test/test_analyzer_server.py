@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Test module for analyzer_server"""
+
+import asyncio
+import threading
+import pytest
+import pytest_asyncio
+from aiohttp.test_utils import TestClient, TestServer
+from danmaku_db import DanmakuDB
+from analyzer_server import AnalyzerServer
+from analyzer_server.analyzer_api import ApiHandler
+from analyzer_server.dataset_registry import DatasetRegistry
+from analyzer_server.worker_pool import WorkerPool, PoolSaturatedError
+
+TEST_KEYWORD = '让子弹飞'
+
+
+class TestAnalyzerServer:
+    """TestAnalyzerServer class.
+
+    Test class for analyzer_server
+    """
+    @pytest_asyncio.fixture
+    async def client(self, tmp_path, monkeypatch, stub_api):
+        """Fixture, returns a client of an AnalyzerServer fetching from the stub"""
+        (tmp_path / 'assets').mkdir()
+        (tmp_path / 'index.html').write_text('<html></html>', encoding='utf-8')
+        monkeypatch.setattr(AnalyzerServer, 'ui_path', str(tmp_path))
+        # AnalyzerServer会替换ApiHandler的类属性，测试结束后恢复
+        for name in ('cache', 'pool', 'renderer'):
+            monkeypatch.setattr(ApiHandler, name, getattr(ApiHandler, name))
+        monkeypatch.setattr(ApiHandler, 'registry',
+                            DatasetRegistry(lambda: DanmakuDB(cache=ApiHandler.cache)))
+        server = AnalyzerServer(profiling=True, warm_up=False, cache_filename='')
+        async with TestClient(TestServer(server.app_server)) as test_client:
+            yield test_client
+
+    @pytest.mark.asyncio
+    async def test_server_metrics_stub(self, client):
+        """Test the metrics of the requests, the worker pool and the datasets"""
+        response = await client.get('/api/fetch', params={'keyword': TEST_KEYWORD, 'n': 5,
+                                                          'wait': 'true'})
+        assert response.status == 200 and (await response.json())['code'] == 0
+        response = await client.get('/api/top_danmakus', params={'n': 1})
+        assert (await response.json())['code'] == 0
+        assert (await client.get('/missing')).status == 404
+        response = await client.get('/metrics')
+        assert response.status == 200
+        lines = (await response.text()).splitlines()
+        assert 'analyzer_datasets 1' in lines
+        assert any(line.startswith(f'analyzer_dataset_bytes{{dataset="{TEST_KEYWORD}:5"}} ')
+                   for line in lines)
+        assert ('analyzer_http_request_duration_seconds_count'
+                '{method="GET",route="/api/fetch",status="200"} 1') in lines
+        assert ('analyzer_http_request_duration_seconds_count'
+                '{method="GET",route="unmatched",status="404"} 1') in lines
+        assert 'analyzer_worker_jobs_total{job="top_danmakus"} 1' in lines
+        assert 'analyzer_worker_pending_jobs 0' in lines
+
+    @pytest.mark.asyncio
+    async def test_server_profile(self, client):
+        """Test capturing a profile of the server"""
+        response = await client.get('/debug/profile', params={'seconds': 0.1, 'format': 'top',
+                                                              'idle': 'true'})
+        assert response.status == 200
+        assert (await response.text()).startswith('# ')
+        response = await client.get('/debug/profile', params={'seconds': 0})
+        assert response.status == 400
+
+    @pytest.mark.asyncio
+    async def test_worker_pool_cancel(self):
+        """Test a cancelled caller keeping the slot of its job until the job finishes"""
+        pool = WorkerPool(max_workers=1, max_queue=0)
+        release = threading.Event()
+        task = asyncio.ensure_future(pool.run('wait', release.wait, 5))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.sleep(0.05)
+        assert pool.pending == 1
+        with pytest.raises(PoolSaturatedError):
+            await pool.run('wait', release.wait, 5)
+        release.set()
+        for _i in range(100):
+            if pool.pending == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert pool.pending == 0 and await pool.run('sum', sum, [1, 2]) == 3
@@ -4,8 +4,21 @@
 """Test module for danmaku_db"""
 
 import os
+import sys
+import multiprocessing
+import pickle
+import subprocess
+import importlib
 import pytest
-from danmaku_db import DanmakuDB
+from danmaku_db import DanmakuDB, DanmakuCache, DanmakuFilter, Segmenter, register_model, \
+    load_stopwords
+from danmaku_db import MetricsRegistry, metrics, warm_up
+from danmaku_db import segmenter as segmenter_module
+from danmaku_db import danmaku_metrics
+from danmaku_db.danmaku_xml import DanmakuAttr, DanmakuAttrColumns, parse_danmaku_xml, parse_text
+from .conftest import TEST_STUB_XML, StubModel
+
+danmaku_db_module = importlib.import_module('danmaku_db.danmaku_db')
 
 TEST_VALID_BVID1 = 'BV1j4411W7F7'
 TEST_VALID_BVID2 = 'BV1yt4y1Q7SS'
@@ -27,6 +40,12 @@ class TestDanmakuDB:
         """Fixture, returns DanmakuDB"""
         return DanmakuDB()
 
+    @pytest.fixture
+    def stub_segmenter(self):
+        """Fixture, returns a Segmenter using a stub model"""
+        register_model('stub', StubModel)
+        return Segmenter(model_name='stub', processes=1)
+
     def test_append(self, danmaku_db):
         """Test append function"""
         danmaku_db.append(TEST_VALID_BVID1, 'Testing danmaku1')
@@ -40,8 +59,79 @@ class TestDanmakuDB:
         danmaku_db.append(TEST_VALID_BVID1, 'Testing danmaku')
         assert TEST_VALID_BVID1 in danmaku_db.bvids()
         assert len(danmaku_db) == 1 and 'Testing danmaku' in danmaku_db[TEST_VALID_BVID1]
+        strings = danmaku_db.store.strings
         danmaku_db.clear()
-        assert len(danmaku_db) == 0
+        assert len(danmaku_db) == 0 and len(danmaku_db.store.strings) == 0
+        # 已取得的字符串表不被清空，正在导出的线程不受影响
+        assert strings == ['Testing danmaku']
+
+    def test_columnar_view(self, danmaku_db):
+        """Test columnar storage views"""
+        danmaku_db[TEST_VALID_BVID1] = ['Testing danmaku1', 'Testing danmaku2', 'Testing danmaku1']
+        danmaku_db.append(TEST_VALID_BVID2, 'Testing danmaku1')
+        view = danmaku_db[TEST_VALID_BVID1]
+        assert view == ['Testing danmaku1', 'Testing danmaku2', 'Testing danmaku1']
+        assert view[1:] == ['Testing danmaku2', 'Testing danmaku1']
+        assert view[-1] == 'Testing danmaku1'
+        assert len(danmaku_db.store.strings) == 2 and TEST_VALID_BVID2 in danmaku_db
+        assert [bvid for bvid, _danmakus in danmaku_db.items()] == [TEST_VALID_BVID1,
+                                                                    TEST_VALID_BVID2]
+        assert danmaku_db.to_list() == list(view) + ['Testing danmaku1']
+
+    def test_pickle(self, tmp_path):
+        """Test pickling DanmakuDB for worker processes"""
+        danmaku_db = DanmakuDB(cache=DanmakuCache(str(tmp_path / 'cache.sqlite3')))
+        danmaku_db[TEST_VALID_BVID1] = ['Testing danmaku1', 'Testing danmaku1']
+        unpickled_db = pickle.loads(pickle.dumps(danmaku_db))
+        assert unpickled_db.cache is None and unpickled_db.segmenter is danmaku_db.segmenter
+        assert unpickled_db.top_danmakus(1) == {'Testing danmaku1': 2}
+        unpickled_db.append(TEST_VALID_BVID1, 'Testing danmaku2')
+        assert len(unpickled_db[TEST_VALID_BVID1]) == 3
+
+    def test_query(self, danmaku_db):
+        """Test query function with filters, sorting and cursor pagination"""
+        for i in range(10):
+            danmaku_db.append(TEST_VALID_BVID1, f'Testing danmaku{i % 3}',
+                              DanmakuAttr(float(9 - i), 1 + i % 2, 255, 1000 + i, 100 + i))
+        danmakus, total_count, cursor = danmaku_db.query(TEST_VALID_BVID1, limit=4)
+        assert [index for index, _text, _attr in danmakus] == [0, 1, 2, 3]
+        assert total_count == 10 and cursor == 4
+        danmakus, total_count, cursor = danmaku_db.query(
+            TEST_VALID_BVID1, DanmakuFilter(contains='danmaku1', progress_to=7.0), 'progress')
+        assert [(index, text) for index, text, _attr in danmakus] == [(7, 'Testing danmaku1'),
+                                                                     (4, 'Testing danmaku1')]
+        assert total_count == 2 and cursor is None
+        danmakus, total_count, cursor = danmaku_db.query(
+            TEST_VALID_BVID1, DanmakuFilter(regex=r'[02]$', mode=1, ctime_from=1002), 'ctime',
+            descending=True, limit=2)
+        assert [index for index, _text, _attr in danmakus] == [8, 6] and total_count == 3
+        danmakus, _total_count, cursor = danmaku_db.query(
+            TEST_VALID_BVID1, DanmakuFilter(regex=r'[02]$', mode=1, ctime_from=1002), 'ctime',
+            descending=True, cursor=cursor, limit=2)
+        assert [index for index, _text, _attr in danmakus] == [2] and cursor is None
+        danmaku_db.append(TEST_VALID_BVID1, 'Testing danmaku0', DanmakuAttr(100.0))
+        assert danmaku_db.query(TEST_VALID_BVID1, sort='progress', descending=True)[0][0][0] == 10
+
+    def test_density(self, danmaku_db):
+        """Test playback_density and send_time_activity functions"""
+        assert danmaku_db.playback_density() == []
+        # 2023-08-26 00:00:00 UTC+8 为星期六
+        midnight = 1692979200
+        for progress, ctime in ((1.5, midnight + 60), (12.0, midnight + 7200), (35.0, midnight)):
+            danmaku_db.append(TEST_VALID_BVID1, 'Testing danmaku',
+                              DanmakuAttr(progress, ctime=ctime))
+        danmaku_db.append(TEST_VALID_BVID2, 'Testing danmaku',
+                          DanmakuAttr(5.0, ctime=midnight + 86400))
+        assert danmaku_db.playback_density() == [2, 1, 0, 1]
+        assert danmaku_db.playback_density(20, TEST_VALID_BVID1) == [2, 1]
+        assert danmaku_db.send_time_activity('hour', TEST_VALID_BVID1) == (midnight, [2, 0, 1])
+        danmaku_db.append(TEST_VALID_BVID2, 'Testing danmaku')
+        assert danmaku_db.send_time_activity('day') == (midnight, [3, 1])
+        assert danmaku_db.send_time_activity('day', cyclic=True)[1] == [0, 0, 0, 0, 0, 3, 1]
+        assert danmaku_db.send_time_activity('hour', cyclic=True)[1][:3] == [3, 0, 1]
+        for bucket in (0, float('nan'), float('inf'), 1e-4):
+            with pytest.raises(ValueError):
+                danmaku_db.playback_density(bucket)
 
     @pytest.mark.asyncio
     async def test_fetch_valid(self, danmaku_db):
@@ -75,6 +165,173 @@ class TestDanmakuDB:
         await danmaku_db.fetch_from_search_result(TEST_KEYWORD, 30)
         assert len(danmaku_db) == 30 and len(danmaku_db[danmaku_db.bvids()[0]]) > 10
 
+    @pytest.mark.asyncio
+    async def test_fetch_search_stub(self, stub_api):
+        """Test concurrent fetch_from_search_result function with stub API"""
+        danmaku_db = DanmakuDB(concurrency=4)
+        await danmaku_db.fetch_from_search_result(TEST_KEYWORD, 30)
+        assert len(danmaku_db) == 30 and len(stub_api.fetched_bvids) == 30
+        assert stub_api.searched_pages == [1, 2] and stub_api.max_in_flight <= 4
+        assert danmaku_db['BVstub0'] == ['Testing danmaku', 'Testing danmaku', 'Advanced danmaku']
+
+    @pytest.mark.asyncio
+    async def test_fetch_search_stub_duplicates(self, danmaku_db, stub_api, monkeypatch):
+        """Test fetch_from_search_result function counting the distinct videos of the pages"""
+        search_page = stub_api.corpus.search_page
+
+        def shifted_search_page(page: int) -> dict:
+            # 第2页重复第1页的最后5个视频
+            result = search_page(page)
+            if page == 2:
+                result['result'] = search_page(1)['result'][-5:] + result['result']
+            return result
+
+        monkeypatch.setattr(stub_api.corpus, 'search_page', shifted_search_page)
+        await danmaku_db.fetch_from_search_result(TEST_KEYWORD, 30)
+        assert len(danmaku_db) == 30 and len(stub_api.fetched_bvids) == 30
+        assert 'BVstub29' in danmaku_db and stub_api.searched_pages == [1, 2]
+
+    def test_parse_danmaku_xml(self):
+        """Test incremental danmaku XML parsing"""
+        danmakus = list(parse_danmaku_xml(TEST_STUB_XML, chunk_size=16))
+        assert [d for d, _attr in danmakus] == ['Testing danmaku', 'Testing danmaku',
+                                               'Advanced danmaku']
+        assert danmakus[0][1] == DanmakuAttr(1.5, 1, 16777215, 1693000000, 1001)
+        assert parse_text('[not json]') == '[not json]'
+
+    @pytest.mark.asyncio
+    async def test_fetch_search_stub_num_results(self, danmaku_db, stub_api):
+        """Test fetch_from_search_result function when n exceeds numResults"""
+        await danmaku_db.fetch_from_search_result(TEST_KEYWORD, 100)
+        assert len(danmaku_db) == 45 and stub_api.searched_pages == [1, 2, 3]
+
+    @pytest.mark.asyncio
+    async def test_fetch_search_cached(self, stub_api, tmp_path):
+        """Test fetch_from_search_result function served from DanmakuCache"""
+        cache = DanmakuCache(str(tmp_path / 'cache.sqlite3'))
+        await DanmakuDB(cache=cache).fetch_from_search_result(TEST_KEYWORD, 30)
+        danmaku_db = DanmakuDB(cache=cache)
+        await danmaku_db.fetch_from_search_result(TEST_KEYWORD, 30)
+        assert len(danmaku_db) == 30 and len(stub_api.fetched_bvids) == 30
+        assert stub_api.searched_pages == [1, 2] and cache.hits == 32
+        assert danmaku_db.attrs('BVstub0')[2] == (5.0, 7, 16777215, 1693000200, 1003, 0)
+
+    @pytest.mark.asyncio
+    async def test_refresh_search_stub(self, danmaku_db, stub_api):
+        """Test refresh_from_search_result function merging new danmakus by row id"""
+        await danmaku_db.fetch_from_search_result(TEST_KEYWORD, 30)
+        await danmaku_db.refresh_from_search_result(TEST_KEYWORD, 45)
+        assert len(danmaku_db) == 45 and len(stub_api.fetched_bvids) == 45
+        stub_api.corpus.xml = TEST_STUB_XML.replace(
+            '</i>', '<d p="7.0,1,25,16777215,1693000300,0,abcdef04,1004,10">New danmaku</d></i>')
+        progress = []
+        await danmaku_db.refresh_from_search_result(TEST_KEYWORD, 45, 0,
+                                                    lambda *args: progress.append(args))
+        assert len(stub_api.fetched_bvids) == 90 and progress[-1] == (45, 45, 45)
+        assert danmaku_db['BVstub0'] == ['Testing danmaku', 'Testing danmaku',
+                                         'Advanced danmaku', 'New danmaku']
+        assert danmaku_db.attrs('BVstub0')[3].row_id == 1004
+        assert danmaku_db.top_danmakus(5) == {'Testing danmaku': 90, 'Advanced danmaku': 45,
+                                              'New danmaku': 45}
+
+    @pytest.mark.asyncio
+    async def test_fetch_parts_stub(self, stub_api):
+        """Test fetching all the parts of videos, long ones from the segmented endpoint"""
+        stub_api.durations = (60, 3600, 60)
+        danmaku_db = DanmakuDB(concurrency=4, parts=None)
+        await danmaku_db.fetch_from_search_result(TEST_KEYWORD, 10)
+        assert len(stub_api.fetched_parts) == 30 and stub_api.max_in_flight == 4
+        assert list(danmaku_db.attrs('BVstub0').columns.part) == [0] * 3 + [1] * 3 + [2] * 3
+        assert danmaku_db.attrs('BVstub0')[5] == (5.0, 7, 16777215, 1693000200, 1003, 1)
+        assert danmaku_db['BVstub0'][3:6] == ['Testing danmaku', 'Testing danmaku',
+                                              'Advanced danmaku']
+        danmaku_db = DanmakuDB(parts=(2, 5))
+        await danmaku_db.fetch_from_video('BVstub0')
+        assert stub_api.fetched_parts[-1] == 102 and len(danmaku_db['BVstub0']) == 3
+        # 缺少分P列的旧数据以默认值填充
+        assert DanmakuAttrColumns([[1.5], [1], [255], [100], [7]])[0].part == 0
+
+    @pytest.mark.asyncio
+    async def test_fetch_segments_timeout_stub(self, stub_api, monkeypatch):
+        """Test scaling the timeout of segmented fetches by the segment count"""
+        stub_api.durations = (60, 3600)
+        timeouts = []
+        with_retry = danmaku_db_module._with_retry  # pylint: disable=protected-access
+
+        async def recording_with_retry(coro_factory, timeout, retries, backoff):
+            timeouts.append(timeout)
+            return await with_retry(coro_factory, timeout, retries, backoff)
+        monkeypatch.setattr(danmaku_db_module, '_with_retry', recording_with_retry)
+        await DanmakuDB(timeout=2.0, parts=None).fetch_from_video('BVstub0')
+        # 获取分P列表与XML各一次，3600秒的分P共10段
+        assert sorted(timeouts) == [2.0, 2.0, 20.0]
+
+    @pytest.mark.asyncio
+    async def test_fetch_metrics_stub(self, stub_api, tmp_path):
+        """Test the stage timers and counters recorded when fetching"""
+        parsed = danmaku_metrics.DANMAKUS_PARSED.value()
+        fetched = danmaku_metrics.VIDEOS_FETCHED.value()
+        hits = danmaku_metrics.CACHE_REQUESTS.value(kind='danmakus', result='hit')
+        network = danmaku_metrics.STAGE_SECONDS.count(stage='network')
+        cache = DanmakuCache(str(tmp_path / 'cache.sqlite3'))
+        await DanmakuDB(cache=cache).fetch_from_search_result(TEST_KEYWORD, 10)
+        await DanmakuDB(cache=cache).fetch_from_search_result(TEST_KEYWORD, 10)
+        assert danmaku_metrics.DANMAKUS_PARSED.value() - parsed == 30
+        assert danmaku_metrics.VIDEOS_FETCHED.value() - fetched == 10
+        assert danmaku_metrics.CACHE_REQUESTS.value(kind='danmakus', result='hit') - hits == 10
+        assert danmaku_metrics.STAGE_SECONDS.count(stage='network') - network == 11
+        assert len(stub_api.fetched_bvids) == 10
+        assert 'danmaku_stage_duration_seconds_bucket{stage="parse",le="+Inf"}' in metrics.render()
+
+    def test_metrics_registry(self):
+        """Test rendering metrics in the Prometheus text format"""
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'Test counter', ('kind',))
+        counter.inc(kind='a')
+        counter.inc(2, kind='b"')
+        histogram = registry.histogram('test_seconds', 'Test histogram', buckets=(0.1, 1.0))
+        histogram.observe(0.5)
+        histogram.observe(2)
+        registry.gauge('test_gauge', 'Test gauge').set_function(lambda: 1.5)
+        registry.add_collector(lambda: [('test_collected', 'gauge', 'Collected', [({}, 3)])])
+        assert registry.counter('test_total', 'Test counter', ('kind',)) is counter
+        with pytest.raises(ValueError):
+            registry.gauge('test_total', 'Test gauge')
+        with pytest.raises(ValueError):
+            counter.inc(kind='a', other='b')
+        assert registry.render().split('\n') == [
+            '# HELP test_total Test counter', '# TYPE test_total counter',
+            'test_total{kind="a"} 1', 'test_total{kind="b\\""} 2',
+            '# HELP test_seconds Test histogram', '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 0', 'test_seconds_bucket{le="1"} 1',
+            'test_seconds_bucket{le="+Inf"} 2', 'test_seconds_sum 2.5', 'test_seconds_count 2',
+            '# HELP test_gauge Test gauge', '# TYPE test_gauge gauge', 'test_gauge 1.5',
+            '# HELP test_collected Collected', '# TYPE test_collected gauge',
+            'test_collected 3', '']
+
+    def test_cache_eviction(self, tmp_path):
+        """Test DanmakuCache TTL and size-bounded eviction"""
+        cache = DanmakuCache(str(tmp_path / 'cache.sqlite3'), ttl=0, max_bytes=1)
+        cache.put_danmakus(TEST_VALID_BVID1, ['Testing danmaku'], [])
+        assert cache.get_danmakus(TEST_VALID_BVID1) is None and cache.total_bytes() == 0
+        cache = DanmakuCache(str(tmp_path / 'cache.sqlite3'), max_bytes=10 ** 6)
+        cache.put_danmakus(TEST_VALID_BVID1, ['Testing danmaku'], [])
+        cache.put_search(TEST_KEYWORD, 1, {'numResults': 0, 'result': []})
+        assert cache.get_danmakus(TEST_VALID_BVID1) == [['Testing danmaku'], []]
+        cache.max_bytes = cache.total_bytes() - 1
+        cache.put_danmakus(TEST_VALID_BVID2, [], [])
+        assert cache.get_search(TEST_KEYWORD, 1) is None
+        assert cache.get_danmakus(TEST_VALID_BVID1) is not None
+        # 过期条目按purge_interval定期清理
+        cache = DanmakuCache(str(tmp_path / 'purge.sqlite3'), ttl=0, purge_interval=3600)
+        cache.put_danmakus(TEST_VALID_BVID1, ['Testing danmaku'], [])
+        size = cache.total_bytes()
+        cache.put_danmakus(TEST_VALID_BVID2, ['Testing danmaku'], [])
+        assert cache.get_danmakus(TEST_VALID_BVID1) is None and cache.total_bytes() == 2 * size
+        cache.purge_interval = 0
+        cache.put_danmakus(TEST_VALID_BVID1, ['Testing danmaku'], [])
+        assert cache.total_bytes() == size
+
     @pytest.mark.xfail
     @pytest.mark.asyncio
     async def test_fetch_search_empty(self, danmaku_db):
@@ -93,6 +350,33 @@ class TestDanmakuDB:
         await danmaku_db.fetch_from_video(TEST_VALID_BVID1)
         assert len(danmaku_db.top_danmakus(10)) == 10
 
+    def test_top_danmakus_incremental(self, danmaku_db):
+        """Test top_danmakus function after incremental modifications"""
+        danmaku_db[TEST_VALID_BVID1] = ['Testing danmaku1', 'Testing danmaku2', 'Testing danmaku1']
+        danmaku_db.append(TEST_VALID_BVID2, 'Testing danmaku2')
+        assert danmaku_db.top_danmakus(1) == {'Testing danmaku1': 2}
+        danmaku_db.append(TEST_VALID_BVID2, 'Testing danmaku2')
+        assert danmaku_db.top_danmakus(1) == {'Testing danmaku2': 3}
+        assert danmaku_db.top_danmakus(5, TEST_VALID_BVID1) == {'Testing danmaku1': 2,
+                                                                'Testing danmaku2': 1}
+        danmaku_db[TEST_VALID_BVID2] = ['Testing danmaku3']
+        assert danmaku_db.top_danmakus(5) == {'Testing danmaku1': 2, 'Testing danmaku2': 1,
+                                              'Testing danmaku3': 1}
+        version = danmaku_db.version
+        danmaku_db.clear()
+        assert danmaku_db.top_danmakus(5) == {} and danmaku_db.version > version
+
+    def test_top_danmakus_cluster(self, danmaku_db):
+        """Test top_danmakus function folding near-duplicate variants"""
+        danmaku_db[TEST_VALID_BVID1] = ['哈哈哈哈', '哈哈哈哈哈', '哈哈哈哈', '2333', '23333',
+                                        'ＡＷＳＬ', 'awsl!', '前方高能预警了', '前方高能预警了啊']
+        danmaku_db[TEST_VALID_BVID2] = ['233']
+        assert danmaku_db.top_danmakus(4, cluster=True) == {'哈哈哈哈': 3, '2333': 3, 'ＡＷＳＬ': 2,
+                                                            '前方高能预警了': 2}
+        assert danmaku_db.top_danmaku_clusters(1, TEST_VALID_BVID1) == [('哈哈哈哈', 3, 2)]
+        danmaku_db.append(TEST_VALID_BVID2, '2333333')
+        assert danmaku_db.top_danmakus(1, cluster=True) == {'2333': 4}
+
     @pytest.mark.xfail
     @pytest.mark.asyncio
     async def test_top_danmakus_invalid_n(self, danmaku_db):
@@ -112,6 +396,52 @@ class TestDanmakuDB:
         assert os.path.exists(TEST_EXCEL_FILENAME)
         os.unlink(TEST_EXCEL_FILENAME)
 
+    def test_to_excel_round_trip(self, danmaku_db, tmp_path):
+        """Test streaming to_excel function and reading the result back"""
+        excel_filename = str(tmp_path / TEST_EXCEL_FILENAME)
+        danmaku_db[TEST_VALID_BVID1] = ['=。=', 'Testing danmaku1', 'Testing danmaku1']
+        danmaku_db[TEST_VALID_BVID2] = ['Testing danmaku2']
+        danmaku_db.to_excel(excel_filename)
+        read_db = DanmakuDB()
+        read_db.read_excel(excel_filename)
+        assert read_db.bvids() == [TEST_VALID_BVID1, TEST_VALID_BVID2]
+        assert read_db[TEST_VALID_BVID1] == ['=。=', 'Testing danmaku1', 'Testing danmaku1']
+        assert read_db[TEST_VALID_BVID2] == ['Testing danmaku2']
+
+    def test_snapshot(self, danmaku_db, tmp_path):
+        """Test save and load functions with full and partial loading"""
+        snapshot_filename = str(tmp_path / 'danmakus.dmk')
+        danmaku_db[TEST_VALID_BVID1] = ['Testing danmaku1', 'Testing danmaku2', 'Testing danmaku1']
+        danmaku_db.append(TEST_VALID_BVID2, 'Testing danmaku3', DanmakuAttr(1.5, 4, 255, 100, 7))
+        danmaku_db.save(snapshot_filename)
+        loaded_db = DanmakuDB()
+        loaded_db.load(snapshot_filename)
+        assert loaded_db.bvids() == [TEST_VALID_BVID1, TEST_VALID_BVID2]
+        assert loaded_db[TEST_VALID_BVID1] == danmaku_db[TEST_VALID_BVID1]
+        assert loaded_db.attrs(TEST_VALID_BVID2)[0] == (1.5, 4, 255, 100, 7, 0)
+        assert loaded_db.top_danmakus(1) == {'Testing danmaku1': 2}
+        loaded_db.load(snapshot_filename, [TEST_VALID_BVID2])
+        assert loaded_db.bvids() == [TEST_VALID_BVID2]
+        assert loaded_db.to_list() == ['Testing danmaku3']
+        loaded_db.append(TEST_VALID_BVID2, 'Testing danmaku1')
+        assert loaded_db.top_danmakus(5) == {'Testing danmaku3': 1, 'Testing danmaku1': 1}
+        # 部分加载后的字符串表只含用到的弹幕，可以再次保存
+        assert len(loaded_db.store.strings) == 2
+        loaded_db.save(snapshot_filename)
+        loaded_db.load(snapshot_filename)
+        assert loaded_db.to_list() == ['Testing danmaku3', 'Testing danmaku1']
+
+    def test_excel_to_snapshot(self, tmp_path):
+        """Test converting an Excel file to a snapshot"""
+        snapshot_filename = str(tmp_path / 'danmakus.dmk')
+        DanmakuDB.excel_to_snapshot(TEST_EXCEL_READ_FILENAME, snapshot_filename)
+        excel_db = DanmakuDB()
+        excel_db.read_excel(TEST_EXCEL_READ_FILENAME)
+        snapshot_db = DanmakuDB()
+        snapshot_db.load(snapshot_filename)
+        assert snapshot_db.bvids() == excel_db.bvids()
+        assert snapshot_db.top_danmakus(10) == excel_db.top_danmakus(10)
+
     @pytest.mark.xfail
     def test_to_excel_empty_db(self, danmaku_db):
         """Test invalid to_excel function call"""
@@ -138,3 +468,72 @@ class TestDanmakuDB:
         danmaku_db.to_wordcloud().save(TEST_WORDCLOUD_FILENAME)
         assert os.path.exists(TEST_WORDCLOUD_FILENAME)
         os.unlink(TEST_WORDCLOUD_FILENAME)
+
+    def test_segmenter_count_tokens(self, stub_segmenter):
+        """Test Segmenter segments each distinct text once and weights the counts"""
+        word_frequency = stub_segmenter.count_tokens([('Testing danmaku', 3), ('danmaku 的', 2)],
+                                                     excluded={'的'})
+        assert word_frequency == {'Testing': 3, 'danmaku': 5}
+        stub_segmenter.count_tokens([('Testing danmaku', 1)])
+        assert segmenter_module.get_model('stub').cut_count == 2
+
+    def test_segmenter_processes(self, stub_segmenter, monkeypatch):
+        """Test segmenting in worker processes started by spawn with a registered model"""
+        spawn_context = multiprocessing.get_context('spawn')
+        monkeypatch.setattr(multiprocessing, 'get_context', lambda _method=None: spawn_context)
+        segmenter = Segmenter(model_name='stub', processes=2, parallel_threshold=2, chunk_size=1)
+        try:
+            segmenter.segment(['red apple', 'blue car'])
+        finally:
+            segmenter.close()
+        assert segmenter.token_cache == {'red apple': ('red', 'apple'), 'blue car': ('blue', 'car')}
+        assert segmenter_module.get_model('stub').cut_count == 0
+
+    def test_search(self, stub_segmenter):
+        """Test search and cooccurring_words functions with incremental updates"""
+        danmaku_db = DanmakuDB(segmenter=stub_segmenter, stopwords=frozenset(['the']))
+        danmaku_db[TEST_VALID_BVID1] = ['red apple', 'green apple', 'red the car', 'red apple']
+        danmaku_db[TEST_VALID_BVID2] = ['blue car']
+        assert danmaku_db.search(['apple']) == {TEST_VALID_BVID1: [0, 1, 3]}
+        assert danmaku_db.search(['red', 'apple']) == {TEST_VALID_BVID1: [0, 3]}
+        assert danmaku_db.search(['green', 'car'], match_all=False) == {TEST_VALID_BVID1: [1, 2],
+                                                                         TEST_VALID_BVID2: [0]}
+        assert danmaku_db.cooccurring_words('red', 5) == {'apple': 2, 'car': 1}
+        cut_count = segmenter_module.get_model('stub').cut_count
+        danmaku_db.append(TEST_VALID_BVID2, 'red car')
+        assert danmaku_db.search(['car']) == {TEST_VALID_BVID1: [2], TEST_VALID_BVID2: [0, 1]}
+        assert danmaku_db.cooccurring_words('red', 5) == {'apple': 2, 'car': 2}
+        # 只有新的弹幕文本需要分词
+        assert segmenter_module.get_model('stub').cut_count == cut_count + 1
+        danmaku_db[TEST_VALID_BVID1] = ['green tea']
+        assert danmaku_db.search(['green']) == {TEST_VALID_BVID1: [0]}
+        assert danmaku_db.cooccurring_words('red', 5) == {'car': 1}
+
+    def test_to_wordcloud_stub(self, stub_segmenter):
+        """Test to_wordcloud function with a stub segmentation model"""
+        danmaku_db = DanmakuDB(segmenter=stub_segmenter)
+        danmaku_db[TEST_VALID_BVID1] = ['Testing danmaku', '弹幕 测试', '弹幕 测试']
+        assert danmaku_db.to_wordcloud().size[0] > 0
+
+    def test_lazy_imports(self, stub_segmenter):
+        """Test that the heavy analysis modules are only imported on first use or warm-up"""
+        heavy_modules = ['bilibili_api', 'wordcloud', 'PIL', 'imageio', 'pandas', 'openpyxl',
+                         'spacy_pkuseg']
+        imported = subprocess.run(
+            [sys.executable, '-c', 'import sys, danmaku_db; '
+             f'print(",".join(m for m in {heavy_modules!r} if m in sys.modules))'],
+            capture_output=True, text=True, check=True).stdout.strip()
+        assert imported == ''
+        warm_up(stub_segmenter)
+        assert all(module in sys.modules for module in heavy_modules[:-1])
+
+    def test_load_stopwords(self, stub_segmenter, tmp_path):
+        """Test loading a custom stopword file"""
+        stopwords_filename = str(tmp_path / 'stopwords.txt')
+        with open(stopwords_filename, 'w', encoding='utf-8') as stopwords_file:
+            stopwords_file.write('弹幕\n\n')
+        stopwords = load_stopwords(stopwords_filename, ['测试'])
+        assert {'弹幕', '测试', 'a', '1', '!'} <= stopwords and '的' not in stopwords
+        assert load_stopwords(stopwords_filename, ['测试']) is stopwords
+        assert '的' in load_stopwords()
+        assert stub_segmenter.count_tokens([('弹幕 测试 a 的', 2)], stopwords) == {'的': 2}
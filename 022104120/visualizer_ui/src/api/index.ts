@@ -5,29 +5,71 @@ interface DanmakuFrequency {
     count: number
 }
 
+interface FetchJob {
+    dataset: string,
+    job: string
+}
+
+interface FetchProgress {
+    job: string,
+    dataset: string,
+    status: string,
+    error: string | null,
+    videos_done: number,
+    videos_scheduled: number,
+    danmakus: number
+}
+
+const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms))
+
 export default {
-    async fetch(keyword: string, n: number){
-        await request({
+    async fetch(keyword: string, n: number): Promise<FetchJob>{
+        const response = await request({
             url: '/fetch',
             method: 'get',
             params: { keyword, n }
         })
+        return response.data
+    },
+
+    async fetchStatus(job: string): Promise<FetchProgress>{
+        const response = await request({
+            url: '/fetch_status',
+            method: 'get',
+            params: { job }
+        })
+        return response.data
+    },
+
+    async waitFetch(job: string, onProgress: (progress: FetchProgress) => void,
+                    interval: number = 500): Promise<FetchProgress>{
+        for (;;) {
+            const progress = await this.fetchStatus(job)
+            onProgress(progress)
+            if (progress.status === 'done') {
+                return progress
+            }
+            if (progress.status !== 'running') {
+                throw new Error(progress.error ?? progress.status)
+            }
+            await sleep(interval)
+        }
     },
 
-    async topDanmakus(n: number): Promise<[DanmakuFrequency]>{
+    async topDanmakus(dataset: string, n: number): Promise<[DanmakuFrequency]>{
         const response = await request({
             url: '/top_danmakus',
             method: 'get',
-            params: { n }
+            params: { dataset, n }
         })
         return response.data.top_danmakus
     },
 
-    async exportExcel(filename: string){
+    async exportExcel(dataset: string, filename: string){
         await request({
             url: '/export_excel',
             method: 'get',
-            params: { filename }
+            params: { dataset, filename }
         })
     }
 }
\ No newline at end of file